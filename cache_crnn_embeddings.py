@@ -0,0 +1,104 @@
+import os
+import json
+import torch
+import numpy as np
+from pathlib import Path
+from tqdm import tqdm
+import argparse
+
+from data.maestro import MaestroMultiTask, embedding_path, load_embedding_meta
+from train_llama_mt_on_crnn import get_model
+
+
+def cache_embeddings(args):
+
+    # Arguments
+    hop_seconds = args.hop_seconds
+
+    # Default parameters
+    device = "cuda"
+    batch_size = 16
+    segment_seconds = 10.
+    splits = ["train", "validation", "test"]
+
+    root = "/home/nkcemeka/Documents/Datasets/maestro-v3.0.0"
+    emb_dir = Path("./embeddings", "CRnn_Note_pedal")
+
+    # Load checkpoint
+    enc_model_name = "CRnn"
+    checkpoint_path = Path("Note_pedal.pth")
+    enc_model = get_model(enc_model_name)
+    enc_model.load_state_dict2(torch.load(checkpoint_path)["model"])
+    enc_model.to(device)
+    enc_model.eval()
+
+    # MaestroMultiTask reads the segment starts of the store from its meta
+    meta = {"segment_seconds": segment_seconds, "hop_seconds": hop_seconds}
+
+    if Path(emb_dir, "meta.json").exists():
+        assert load_embedding_meta(emb_dir) == meta, "{} holds embeddings of other segments".format(emb_dir)
+    else:
+        Path(emb_dir).mkdir(parents=True, exist_ok=True)
+        with open(Path(emb_dir, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=4)
+
+    for split in splits:
+
+        # Audio is loaded exactly as for training
+        dataset = MaestroMultiTask(
+            root=root,
+            split=split,
+            segment_seconds=segment_seconds,
+            fields=["audio"]
+        )
+
+        for audio_filename, duration in tqdm(zip(dataset.audio_filenames, dataset.durations), total=dataset.audios_num):
+
+            emb_path = embedding_path(emb_dir, audio_filename)
+
+            if emb_path.exists():
+                continue
+
+            Path(emb_path).parent.mkdir(parents=True, exist_ok=True)
+
+            audio_path = Path(root, audio_filename)
+            segments_num = int(np.ceil(duration / hop_seconds))
+            embs = None
+
+            # Write to a temporary file so that interrupted files are redone
+            tmp_path = Path(str(emb_path) + ".tmp")
+
+            for bgn in range(0, segments_num, batch_size):
+
+                segments = [
+                    dataset.load_audio(audio_path, k * hop_seconds)
+                    for k in range(bgn, min(bgn + batch_size, segments_num))
+                ]
+                segments = torch.Tensor(np.stack(segments, axis=0)).to(device)
+
+                with torch.no_grad():
+                    emb = enc_model(segments)["onoffvel_emb_h"].data.cpu().numpy()
+                    # shape: (batch_size, frames_num, emb_dim)
+
+                if embs is None:
+                    embs = np.lib.format.open_memmap(
+                        tmp_path,
+                        mode="w+",
+                        dtype=np.float16,
+                        shape=(segments_num,) + emb.shape[1 :]
+                    )
+
+                embs[bgn : bgn + len(emb)] = emb
+
+            embs.flush()
+            del embs
+            os.replace(tmp_path, emb_path)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hop_seconds', type=float, default=10.)
+    args = parser.parse_args()
+
+    cache_embeddings(args)
@@ -1,20 +1,227 @@
 import numpy as np
 import torch
-import librosa
-import os
 
 
-def collate_fn(list_data_dict):
+def collate_fn(list_data_dict, roll_format="dense", pack_len=None):
+    """
+        Collate items into a batch. Every array is copied once, straight
+        into a tensor allocated for its key (see empty_batch), as float32
+        audio and int32 tokens, masks and indexes.
+    """
     data_dict = {}
 
+    if isinstance(list_data_dict[0], list):
+        # Several segments per read of a file (see
+        # MaestroMultiTask.load_segments), each an item of the batch
+        list_data_dict = [dd for dds in list_data_dict for dd in dds]
+
+    if "token" in list_data_dict[0] and isinstance(list_data_dict[0]["token"], list):
+        # Items with one sequence per task (see MaestroMultiTask). Every
+        # sequence becomes a row of its own, sharing the audio of its item
+        token_dicts = [
+            {"token": token, "mask": mask}
+            for dd in list_data_dict for token, mask in zip(dd["token"], dd["mask"])
+        ]
+        audio_indexes = [n for n, dd in enumerate(list_data_dict) for _ in dd["token"]]
+    else:
+        token_dicts = list_data_dict
+        audio_indexes = None
+
+    if pack_len is not None:
+        # Pack the token sequences of several items into rows of at
+        # most pack_len tokens, see pack_tokens
+        data_dict.update(pack_tokens(token_dicts, pack_len, audio_indexes))
+    elif audio_indexes is not None:
+        data_dict["audio_index"] = torch.tensor(audio_indexes, dtype=torch.int32)
+
     for key in list_data_dict[0].keys():
-        try:
-            if key in ["token", "question_token", "answer_token", "mask"]:
-                data_dict[key] = torch.LongTensor(np.stack([dd[key] for dd in list_data_dict], axis=0))
-            elif key in ["audio", "frame_roll", "onset_roll", "offset_roll", "velocity_roll", "ped_frame_roll", "ped_onset_roll", "ped_offset_roll"]:
-                data_dict[key] = torch.Tensor(np.stack([dd[key] for dd in list_data_dict], axis=0))
-            else:
-                data_dict[key] = [dd[key] for dd in list_data_dict]
-        except:
-            from IPython import embed; embed(using=False); os._exit(0)
+        if key in ["token", "mask"] and pack_len is not None:
+            continue
+        elif key in ["token", "mask"]:
+            data_dict[key] = pad_stack([dd[key] for dd in token_dicts])
+        elif key in ["question_token", "answer_token"]:
+            data_dict[key] = pad_stack([dd[key] for dd in list_data_dict])
+        elif key in ["frame_roll", "onset_roll", "offset_roll", "velocity_roll"] and roll_format == "compact":
+            data_dict[key] = stack([dd[key] for dd in list_data_dict], torch.from_numpy(list_data_dict[0][key]).dtype)
+        elif key in ["frame_roll", "onset_roll", "offset_roll", "velocity_roll"] and roll_format == "sparse":
+            # (nnz, 4) rows of (batch index, frame, pitch, value)
+            data_dict[key] = torch.from_numpy(np.concatenate([
+                np.concatenate((np.full((len(dd[key]), 1), n, dtype=np.int16), dd[key]), axis=1)
+                for n, dd in enumerate(list_data_dict)
+            ], axis=0))
+        elif key in ["onoffvel_emb_h"]:
+            data_dict[key] = stack([dd[key] for dd in list_data_dict], torch.float16)
+        elif key in ["audio", "frame_roll", "onset_roll", "offset_roll", "velocity_roll", "ped_frame_roll", "ped_onset_roll", "ped_offset_roll"]:
+            data_dict[key] = stack([dd[key] for dd in list_data_dict], torch.float32)
+        else:
+            data_dict[key] = [dd[key] for dd in list_data_dict]
+
     return data_dict
+
+
+def empty_batch(shape, dtype):
+    """
+        Allocate an uninitialized batch tensor. In a DataLoader worker it
+        is allocated in shared memory, like torch's default_collate does,
+        so that it is not copied again to be sent to the main process.
+        Pinning is left to the DataLoader (pin_memory=True): a buffer
+        reused across batches would be overwritten while prefetched
+        batches or non_blocking copies still read it.
+
+        Args:
+            shape (tuple): shape of the batch
+            dtype (torch.dtype): dtype of the batch
+
+        Returns:
+            out (torch.Tensor): uninitialized tensor
+    """
+    if torch.utils.data.get_worker_info() is None:
+        return torch.empty(shape, dtype=dtype)
+
+    elem = torch.empty(0, dtype=dtype)
+    storage = elem._typed_storage()._new_shared(int(np.prod(shape)), device=elem.device)
+
+    return elem.new(storage).resize_(shape)
+
+
+def stack(xs, dtype):
+    """
+        Stack arrays of the same shape into a batch tensor, converting
+        them to dtype while copying.
+
+        Args:
+            xs (list): list of np.ndarray of the same shape
+            dtype (torch.dtype): dtype of the batch
+
+        Returns:
+            out (torch.Tensor): (batch_size, ...)
+    """
+    out = empty_batch((len(xs),) + np.shape(xs[0]), dtype)
+
+    for n, x in enumerate(xs):
+        out[n] = torch.from_numpy(np.asarray(x))
+
+    return out
+
+
+def pad_stack(xs, constant_value=0):
+    """
+        Stack sequences of different lengths into an int32 tensor padded
+        to the longest one. Token 0 is <pad> and a mask of 0 is not
+        supervised, so 0 pads both tokens and masks.
+
+        Args:
+            xs (list): list of 1D arrays
+            constant_value (int): padding value
+
+        Returns:
+            x (torch.Tensor): (batch_size, max_len)
+    """
+    max_len = max(len(x) for x in xs)
+    out = empty_batch((len(xs), max_len), torch.int32).fill_(constant_value)
+
+    for n, x in enumerate(xs):
+        out[n, 0 : len(x)] = torch.from_numpy(np.asarray(x))
+
+    return out
+
+
+def pack_tokens(list_data_dict, pack_len, audio_indexes=None):
+    """
+        Pack the variable length "token" and "mask" sequences of a batch
+        into as few rows of at most pack_len tokens as possible (first
+        fit decreasing).
+
+        Args:
+            list_data_dict (list): items with "token" and "mask"
+            pack_len (int): maximum number of tokens of a row
+            audio_indexes (list): optional audio index of every item,
+                defaults to the item index
+
+        Returns:
+            data (dict): {
+                "token": (rows_num, T) int32 tokens, 0 padded,
+                "mask": (rows_num, T) int32 masks, 0 padded,
+                "segment_id": (rows_num, T) slot of the sequence of each
+                    position in its row, -1 on padding,
+                "cross_index": (rows_num, S) item (i.e. audio) index of
+                    every slot of a row, -1 for unused slots,
+            }
+    """
+    lengths = [len(dd["token"]) for dd in list_data_dict]
+    assert max(lengths) <= pack_len
+
+    rows = []
+    rows_len = []
+
+    for n in sorted(range(len(lengths)), key=lambda n: -lengths[n]):
+        for r in range(len(rows)):
+            if rows_len[r] + lengths[n] <= pack_len:
+                rows[r].append(n)
+                rows_len[r] += lengths[n]
+                break
+        else:
+            rows.append([n])
+            rows_len.append(lengths[n])
+
+    T = max(rows_len)
+    S = max(len(row) for row in rows)
+
+    tokens = empty_batch((len(rows), T), torch.int32).fill_(0)
+    masks = empty_batch((len(rows), T), torch.int32).fill_(0)
+    segment_ids = empty_batch((len(rows), T), torch.int32).fill_(-1)
+    cross_index = empty_batch((len(rows), S), torch.int32).fill_(-1)
+
+    for r, row in enumerate(rows):
+        bgn = 0
+        for slot, n in enumerate(row):
+            end = bgn + lengths[n]
+            tokens[r, bgn : end] = torch.from_numpy(np.asarray(list_data_dict[n]["token"]))
+            masks[r, bgn : end] = torch.from_numpy(np.asarray(list_data_dict[n]["mask"]))
+            segment_ids[r, bgn : end] = slot
+            cross_index[r, slot] = n if audio_indexes is None else audio_indexes[n]
+            bgn = end
+
+    data = {
+        "token": tokens,
+        "mask": masks,
+        "segment_id": segment_ids,
+        "cross_index": cross_index,
+    }
+
+    return data
+
+
+def densify_roll(x, name, roll_format, shape, device):
+    """
+        Move a collated roll to device and expand it into a
+        float32 dense roll there, matching the "dense" format.
+
+        Args:
+            x (torch.Tensor): roll collated by collate_fn
+            name (str): name of the roll, e.g. "velocity_roll"
+            roll_format (str): "dense", "compact" or "sparse"
+            shape (tuple): (batch_size, frames_num, pitches_num)
+            device (str): typical cuda or cpu
+
+        Returns:
+            roll (torch.Tensor): (batch_size, frames_num, pitches_num)
+    """
+    if roll_format == "dense":
+        return x.to(device)
+
+    elif roll_format == "compact":
+        roll = x.to(device).float()
+
+    elif roll_format == "sparse":
+        x = x.to(device).long()
+        roll = torch.zeros(shape, dtype=torch.float32, device=device)
+        roll[x[:, 0], x[:, 1], x[:, 2]] = x[:, 3].float()
+
+    else:
+        raise NotImplementedError("{} is not supported!".format(roll_format))
+
+    if name == "velocity_roll":
+        roll /= 128.0
+
+    return roll
@@ -1,9 +1,31 @@
 import time
-import copy
 import math
+import struct
 import numpy as np
 import pretty_midi
 
+# Structured array of notes, times in seconds. Notes are kept in these
+# arrays everywhere and only converted to pretty_midi.Note when reading
+# or writing MIDI files.
+NOTE_DTYPE = np.dtype([
+    ("start", np.float64),
+    ("end", np.float64),
+    ("pitch", np.int64),
+    ("velocity", np.int64),
+])
+
+
+# Structured array of notes on the frame grid. Frames are integers
+# relative to a segment or a piece and are only converted to seconds
+# when writing MIDI.
+FRAME_NOTE_DTYPE = np.dtype([
+    ("onset", np.int64),
+    ("offset", np.int64),
+    ("pitch", np.int64),
+    ("velocity", np.int64),
+])
+
+
 class Pedal:
     def __init__(self, start, end):
         self.start = start
@@ -23,17 +45,16 @@ def read_single_track_midi(midi_path, extend_pedal):
             extend_pedal (bool): Extend notes based on pedals
 
         Returns:
-            notes, pedals
+            notes (np.ndarray): (notes_num,) NOTE_DTYPE array
+            pedals (list): list of Pedal
     """
-    midi_data = pretty_mid.PrettyMIDI(str(midi_path))
-    
-    assert len(midi_data.instruments) == 1
-
-    notes = midi_data.instruments[0].notes
-    control_changes = midi_data.instruments[0].control_changes
+    notes, control_changes = read_midi_notes(midi_path)
 
     # Get pedals
-    pedals = get_pedals(control_changes)
+    onsets, offsets = cc64_to_pedal_intervals(
+        control_changes["time"], control_changes["number"], control_changes["value"]
+    )
+    pedals = [Pedal(start=onset, end=offset) for onset, offset in zip(onsets.tolist(), offsets.tolist())]
 
     # Extend note offsets by pedal information
     if extend_pedal:
@@ -41,6 +62,193 @@ def read_single_track_midi(midi_path, extend_pedal):
     
     return notes, pedals
 
+
+# Number of data bytes of the channel and system messages, by status byte
+MIDI_DATA_BYTES = {status: 2 for status in range(0x80, 0xc0)}
+MIDI_DATA_BYTES.update({status: 1 for status in range(0xc0, 0xe0)})
+MIDI_DATA_BYTES.update({status: 2 for status in range(0xe0, 0xf0)})
+MIDI_DATA_BYTES.update({0xf1: 1, 0xf2: 2, 0xf3: 1, 0xf6: 0, 0xf8: 0, 0xfa: 0, 0xfb: 0, 0xfc: 0, 0xfe: 0})
+
+
+def read_midi_notes(midi_path):
+    """
+        Read the notes and control changes of a single instrument
+        MIDI file directly from the SMF bytes, without building a
+        pretty_midi object. Notes, their order and their times are
+        identical to those of pretty_midi.
+
+        Args:
+            midi_path (str): Path to MIDI file
+
+        Returns:
+            notes (np.ndarray): (notes_num,) NOTE_DTYPE array
+            control_changes (dict): "time", "number" and "value"
+                arrays of the control changes of the instrument
+    """
+    with open(midi_path, "rb") as f:
+        data = f.read()
+
+    name, size, _, tracks_num, resolution = struct.unpack(">4sLhhh", data[: 14])
+    assert name == b"MThd", "{} is not a MIDI file".format(midi_path)
+
+    if resolution < 0:
+        raise NotImplementedError("SMPTE time division is not supported!")
+
+    pos = 8 + size
+    tempos = []
+    notes = []
+    ccs = []
+    instruments = set()
+
+    for track_idx in range(tracks_num):
+
+        if pos + 8 > len(data):
+            break
+
+        name, size = struct.unpack(">4sL", data[pos : pos + 8])
+        assert name == b"MTrk"
+        pos += 8
+        end = pos + size
+
+        tick = 0
+        last_status = None
+        programs = [0] * 16
+        # (channel, pitch) -> list of (onset tick, velocity)
+        note_ons = {}
+
+        while pos < end:
+
+            # Delta time
+            byte = data[pos]
+            pos += 1
+            delta = byte & 0x7f
+            while byte >= 0x80:
+                byte = data[pos]
+                pos += 1
+                delta = (delta << 7) | (byte & 0x7f)
+            tick += delta
+
+            status = data[pos]
+            if status < 0x80:
+                # Running status
+                status = last_status
+            else:
+                pos += 1
+                if status != 0xff:
+                    # Meta messages do not set running status
+                    last_status = status
+
+            if status == 0xff or status in (0xf0, 0xf7):
+                if status == 0xff:
+                    meta_type = data[pos]
+                    pos += 1
+                byte = data[pos]
+                pos += 1
+                length = byte & 0x7f
+                while byte >= 0x80:
+                    byte = data[pos]
+                    pos += 1
+                    length = (length << 7) | (byte & 0x7f)
+                if status == 0xff and meta_type == 0x51 and track_idx == 0:
+                    tempos.append((tick, int.from_bytes(data[pos : pos + 3], "big")))
+                pos += length
+                continue
+
+            msg = status & 0xf0
+            channel = status & 0x0f
+            data_bytes = MIDI_DATA_BYTES[status]
+            value1 = data[pos] if data_bytes > 0 else 0
+            value2 = data[pos + 1] if data_bytes > 1 else 0
+            pos += data_bytes
+
+            if msg == 0xc0:
+                programs[channel] = value1
+
+            elif msg == 0x90 and value2 > 0:
+                note_ons.setdefault((channel, value1), []).append((tick, value2))
+
+            elif msg == 0x80 or msg == 0x90:
+                # One note off closes all the notes of the pitch that
+                # started before it, as pretty_midi does
+                key = (channel, value1)
+                if key in note_ons:
+                    to_close = [(on, vel) for on, vel in note_ons[key] if on != tick]
+                    to_keep = [(on, vel) for on, vel in note_ons[key] if on == tick]
+
+                    for on, vel in to_close:
+                        notes.append((on, tick, value1, vel))
+                        instruments.add((programs[channel], channel, track_idx))
+
+                    if len(to_close) > 0 and len(to_keep) > 0:
+                        note_ons[key] = to_keep
+                    else:
+                        del note_ons[key]
+
+            elif msg == 0xb0:
+                ccs.append((tick, channel, track_idx, value1, value2))
+
+        pos = end
+
+    assert len(instruments) == 1, "Expect a single instrument, got {}".format(len(instruments))
+    _, channel, track_idx = instruments.pop()
+
+    ticks_to_time = midi_ticks_to_time_func(tempos, resolution)
+
+    notes = np.array(notes, dtype=np.int64).reshape(-1, 4)
+    ccs = np.array([cc for cc in ccs if cc[1 : 3] == (channel, track_idx)], dtype=np.int64).reshape(-1, 5)
+
+    note_array = np.zeros(len(notes), dtype=NOTE_DTYPE)
+    note_array["start"] = ticks_to_time(notes[:, 0])
+    note_array["end"] = ticks_to_time(notes[:, 1])
+    note_array["pitch"] = notes[:, 2]
+    note_array["velocity"] = notes[:, 3]
+
+    control_changes = {
+        "time": ticks_to_time(ccs[:, 0]),
+        "number": ccs[:, 3],
+        "value": ccs[:, 4],
+    }
+
+    return note_array, control_changes
+
+
+def midi_ticks_to_time_func(tempos, resolution):
+    """
+        Build the function that maps MIDI ticks to seconds from the
+        tempo changes, with the same arithmetic as pretty_midi so that
+        times are bit identical.
+
+        Args:
+            tempos (list): (tick, microseconds per beat) of the set_tempo
+                events of the first track
+            resolution (int): ticks per beat
+
+        Returns:
+            ticks_to_time (function): maps an array of ticks to seconds
+    """
+    tick_scales = [(0, 60.0 / (120.0 * resolution))]
+
+    for tick, tempo in tempos:
+        tick_scale = 60.0 / ((6e7 / tempo) * resolution)
+        if tick == 0:
+            tick_scales = [(0, tick_scale)]
+        # Repeated tempos are ignored
+        elif tick_scale != tick_scales[-1][1]:
+            tick_scales.append((tick, tick_scale))
+
+    start_ticks = np.array([tick for tick, _ in tick_scales], dtype=np.int64)
+    scales = np.array([scale for _, scale in tick_scales])
+    start_times = np.zeros(len(tick_scales))
+    for i in range(1, len(tick_scales)):
+        start_times[i] = start_times[i - 1] + scales[i - 1] * (start_ticks[i] - start_ticks[i - 1])
+
+    def ticks_to_time(ticks):
+        idxes = np.searchsorted(start_ticks, ticks, side="right") - 1
+        return start_times[idxes] + scales[idxes] * (ticks - start_ticks[idxes])
+
+    return ticks_to_time
+
+
 def get_pedals(control_changes):
     """
         Get pedals from control_changes
@@ -51,29 +259,51 @@ def get_pedals(control_changes):
         Returns:
             pairs (list): list of Pedal info (onset & offset time)
     """
+    times = np.array([cc.time for cc in control_changes], dtype=np.float64)
+    numbers = np.array([cc.number for cc in control_changes], dtype=np.int64)
+    values = np.array([cc.value for cc in control_changes], dtype=np.int64)
+
+    onsets, offsets = cc64_to_pedal_intervals(times, numbers, values)
+
+    return [Pedal(start=onset, end=offset) for onset, offset in zip(onsets.tolist(), offsets.tolist())]
+
+
+def cc64_to_pedal_intervals(times, numbers, values):
+    """
+        Threshold the sustain pedal (CC64) into pedal intervals.
+        A pedal starts at the first CC64 value >= 64 and ends at
+        the next CC64 value < 64. A pedal that is still down at the
+        end ends at the time of the last control change.
+
+        Args:
+            times (np.ndarray): (N,) control change times
+            numbers (np.ndarray): (N,) control change numbers
+            values (np.ndarray): (N,) control change values
+
+        Returns:
+            onsets (np.ndarray): (P,) pedal onset times
+            offsets (np.ndarray): (P,) pedal offset times
+    """
+    times = np.asarray(times, dtype=np.float64)
+    if len(times) == 0:
+        return np.zeros(0), np.zeros(0)
 
-    onset = None
-    offset = None
-    pairs = []
+    order = np.argsort(times, kind="stable")
+    times = times[order]
+    is_pedal = np.asarray(numbers)[order] == 64
 
-    control_changes.sort(key=lambda cc: cc.time)
-    for cc in control_changes:
-        if cc.number == 64:
-            if cc.value >= 64 and onset is None:
-                onset = cc.time
-            elif cc.value < 64 and onset is not None:
-                offset = cc.time
-                pedal = Pedal(start=onset, end=offset)
-                pairs.append(pedal)
-                onset = None
-                offset = None
+    pedal_times = times[is_pedal]
+    down = np.asarray(values)[order][is_pedal] >= 64
+    prev_down = np.concatenate(([False], down[:-1]))
 
-    if onset is not None and offset is None:
-        offset = control_changes[-1].time
-        pedal = Pedal(start=onset, end=offset)
-        pairs.append(pedal)
+    onsets = pedal_times[down & ~prev_down]
+    offsets = pedal_times[~down & prev_down]
+
+    if len(offsets) < len(onsets):
+        offsets = np.append(offsets, times[-1])
+
+    return onsets, offsets
 
-    return pairs
 
 def extend_offset_by_pedal(notes, pedals):
     """
@@ -81,213 +311,321 @@ def extend_offset_by_pedal(notes, pedals):
         the pedal information
 
         Args:
-            notes: MIDI notes 
+            notes (np.ndarray): (notes_num,) NOTE_DTYPE array
             pedals (list): List of pedals
 
         Returns:
-            new_notes (list): List of new extended notes
+            new_notes (np.ndarray): (notes_num,) NOTE_DTYPE array of the
+                extended notes, sorted by onset
     """
-    notes = copy.deepcopy(notes)
-    pedals = copy.deepcopy(pedals)
-    pitches_num = 128
+    pedal_starts = np.array([pedal.start for pedal in pedals], dtype=np.float64)
+    pedal_ends = np.array([pedal.end for pedal in pedals], dtype=np.float64)
+
+    new_ends, order = extend_ends_by_pedal(notes["start"], notes["end"], notes["pitch"], pedal_starts, pedal_ends)
+
+    new_notes = notes[order]
+    new_notes["end"] = new_ends[order]
 
-    notes.sort(key=lambda note: note.end)
-    notes_dict = {pitch: [] for pitch in range(pitches_num)}
-
-    while len(pedals) > 0 and len(notes) > 0:
-        pedal = pedals[0] # Get the first pedal.
-
-        while notes:
-            note = notes[0] # Get the first note.
-            pitch = note.pitch
-            velocity = note.velocity
-
-            if 0 <= note.end < pedal.start:
-                notes_dict[pitch].append(note)
-                notes.pop(0)
-            elif pedal.start <= note.end < pedal.end:
-                new_note = pretty_midi.Note(
-                    pitch=pitch,
-                    start=note.start,
-                    end=pedal.end,
-                    velocity=velocity
-                )
-
-                notes_dict[pitch].append(new_note)
-                notes.pop(0)
-            elif pedal.end <= note.end < math.inf:
-                # In this case, the pedal is not needed
-                # since note offset comes after
-                pedals.pop(0)
-                break
-            else:
-                raise NotImplementedError
-
-    for note in notes:
-        notes_dict[note.pitch].append(note)
-
-    for pitch in notes_dict.keys():
-        len_notes = len(notes_dict[pitch])
-        if len_notes >= 2:
-            for i in range(len_notes - 1):
-                if notes_dict[pitch][i].end > notes_dict[pitch][i + 1].start:
-                    notes_dict[pitch][i].end = notes_dict[pitch][i + 1].start
-    new_notes = []
-    for pitch in notes_dict.keys():
-        new_notes.extend(notes_dict[pitch])
-
-    new_notes.sort(key=lambda note: note.start)
     return new_notes
 
 
+def extend_ends_by_pedal(starts, ends, pitches, pedal_starts, pedal_ends):
+    """
+        Extend note ends to the end of the pedal they are
+        released under, then trim each note so it does not
+        overlap the next note of the same pitch.
+
+        Pedals must be sorted and non-overlapping, as returned
+        by cc64_to_pedal_intervals.
+
+        Args:
+            starts (np.ndarray): (N,) note onset times
+            ends (np.ndarray): (N,) note offset times
+            pitches (np.ndarray): (N,) note pitches
+            pedal_starts (np.ndarray): (P,) pedal onset times
+            pedal_ends (np.ndarray): (P,) pedal offset times
+
+        Returns:
+            new_ends (np.ndarray): (N,) extended offset times, aligned with the input
+            order (np.ndarray): (N,) indexes of the notes sorted by onset
+    """
+    starts = np.asarray(starts, dtype=np.float64)
+    ends = np.asarray(ends, dtype=np.float64)
+    pitches = np.asarray(pitches)
+    pedal_starts = np.asarray(pedal_starts, dtype=np.float64)
+    pedal_ends = np.asarray(pedal_ends, dtype=np.float64)
+
+    # The first pedal that is released after the note
+    new_ends = ends.copy()
+    pedal_idxes = np.searchsorted(pedal_ends, ends, side="right")
+    in_range = pedal_idxes < len(pedal_ends)
+    under_pedal = np.zeros(len(ends), dtype=bool)
+    under_pedal[in_range] = pedal_starts[pedal_idxes[in_range]] <= ends[in_range]
+    new_ends[under_pedal] = pedal_ends[pedal_idxes[under_pedal]]
+
+    # Notes of the same pitch are visited in the order of their
+    # original offsets
+    end_rank = np.empty(len(ends), dtype=np.int64)
+    end_rank[np.argsort(ends, kind="stable")] = np.arange(len(ends))
+
+    by_pitch = np.lexsort((end_rank, pitches))
+    same_pitch = pitches[by_pitch][:-1] == pitches[by_pitch][1:]
+    curr, nxt = by_pitch[:-1][same_pitch], by_pitch[1:][same_pitch]
+    new_ends[curr] = np.minimum(new_ends[curr], starts[nxt])
+
+    order = np.lexsort((end_rank, pitches, starts))
+
+    return new_ends, order
+
+
 def write_notes_to_midi(notes, midi_path):
     """
         Write the MIDI events into a MIDI
         file.
 
         Args:
-            notes (list): List of MIDI events
+            notes (np.ndarray): (notes_num,) NOTE_DTYPE array
             midi_path (str): Path to store MIDI file
 
         Returns:
             None
     """
-    midi_data = pretty_midi.PrettyMIDI()
-    track = pretty_midi.Instrument(program=0)
-    for note in notes:
-        track.notes.append(note)
-    midi_data.instruments.append(track)
-    midi_data.write(midi_path)
+    write_midi_notes(notes, midi_path)
     print(f"Write MIDI to {midi_path}")
 
 
+def write_midi_notes(notes, midi_path, resolution=220, tempo=500000):
+    """
+        Write notes as a single piano track SMF, byte identical to
+        the file pretty_midi writes for the same notes.
+
+        Args:
+            notes (np.ndarray): (notes_num,) NOTE_DTYPE array
+            midi_path (str): Path to store MIDI file
+            resolution (int): ticks per beat
+            tempo (int): microseconds per beat
+
+        Returns:
+            None
+    """
+    tick_scale = 60.0 / ((6e7 / tempo) * resolution)
+
+    times = np.concatenate((notes["start"][:, None], notes["end"][:, None]), axis=-1).flatten()
+    ticks = np.where(times > 0, np.round(times / tick_scale), 0).astype(np.int64)
+    pitches = np.repeat(notes["pitch"], 2)
+    velocities = np.stack((notes["velocity"], np.zeros_like(notes["velocity"])), axis=-1).flatten()
+
+    # Events at the same tick are sorted by pitch and velocity so that
+    # note offs come before note ons
+    order = np.lexsort((velocities, pitches, ticks))
+    deltas = np.diff(ticks[order], prepend=0)
+
+    # Tempo track: set_tempo, time_signature 4/4, end_of_track
+    tempo_track = bytearray(b"\x00\xff\x51\x03")
+    tempo_track += tempo.to_bytes(3, "big")
+    tempo_track += b"\x00\xff\x58\x04\x04\x02\x18\x08\x01\xff\x2f\x00"
+
+    # Piano track: program_change, note_on events with running status,
+    # end_of_track
+    track = bytearray(b"\x00\xc0\x00")
+    status = b"\x90"
+    for delta, pitch, velocity in zip(deltas.tolist(), pitches[order].tolist(), velocities[order].tolist()):
+        track += encode_variable_int(delta) + status + bytes((pitch, velocity))
+        status = b""
+    track += b"\x01\xff\x2f\x00"
+
+    with open(midi_path, "wb") as f:
+        f.write(struct.pack(">4sLhhh", b"MThd", 6, 1, 2, resolution))
+        for chunk in (tempo_track, track):
+            f.write(struct.pack(">4sL", b"MTrk", len(chunk)))
+            f.write(chunk)
+
+
+def encode_variable_int(value):
+    """
+        Encode a non negative integer as a MIDI variable length quantity.
+    """
+    out = [value & 0x7f]
+    value >>= 7
+    while value > 0:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+
+    return bytes(out[:: -1])
+
+
 def time_to_grid(time, fps):
     return round(time * fps) / fps
 
-def notes_to_rolls_and_events(notes, segment_frames, segment_start, segment_end, fps, label):
 
-    seg_start = segment_start
-    seg_end = segment_end
-    seg_len = seg_end - seg_start
-    pitches_num = 128
+def time_to_frame(time, fps):
+    """
+        Round times in seconds to the nearest frame, as time_to_grid.
 
-    # Covert notes information to words.
-    frame_roll = np.zeros((segment_frames, pitches_num))
-    onset_roll = np.zeros((segment_frames, pitches_num))
-    offset_roll = np.zeros((segment_frames, pitches_num))
-    velocity_roll = np.zeros((segment_frames, pitches_num))
+        Args:
+            time (float | np.ndarray): times in seconds
+            fps (int): frames per second
 
-    events = []
-    active_notes = []
+        Returns:
+            frames (np.ndarray): int64 frame indexes
+    """
+    return np.round(np.asarray(time, dtype=np.float64) * fps).astype(np.int64)
 
-    for note in notes:
 
-        if 0 <= note.end < seg_start or seg_end < note.start < math.inf:
-            continue
+def notes_to_frame_notes(notes, fps, origin=0.):
+    """
+        Convert a NOTE_DTYPE array into a FRAME_NOTE_DTYPE array
+
+        Args:
+            notes (np.ndarray): (notes_num,) NOTE_DTYPE array
+            fps (int): frames per second
+            origin (float): time in seconds of frame 0
 
-        onset_time = note.start - seg_start
-        offset_time = note.end - seg_start
-        pitch = note.pitch
-        velocity = note.velocity
+        Returns:
+            frame_notes (np.ndarray): (notes_num,) FRAME_NOTE_DTYPE array
+    """
+    frame_notes = np.zeros(len(notes), dtype=FRAME_NOTE_DTYPE)
+    frame_notes["onset"] = time_to_frame(notes["start"] - origin, fps)
+    frame_notes["offset"] = time_to_frame(notes["end"] - origin, fps)
+    frame_notes["pitch"] = notes["pitch"]
+    frame_notes["velocity"] = notes["velocity"]
 
-        active_note = new_note = pretty_midi.Note(
-            pitch=pitch, 
-            start=onset_time, 
-            end=offset_time, 
-            velocity=velocity
-        )
-        active_notes.append(active_note)
+    return frame_notes
 
-        onset_time = time_to_grid(onset_time, fps)
-        offset_time = time_to_grid(offset_time, fps)
 
-        if offset_time == onset_time:
-            offset_time = onset_time + 0.01
+def frame_notes_to_notes(frame_notes, fps):
+    """
+        Convert a FRAME_NOTE_DTYPE array into a NOTE_DTYPE array in
+        seconds, for writing MIDI.
 
-        if onset_time < 0 and 0 <= offset_time <= seg_len:
+        Args:
+            frame_notes (np.ndarray): (notes_num,) FRAME_NOTE_DTYPE array
+            fps (int): frames per second
 
-            offset_idx = round(offset_time * fps)
-            offset_roll[offset_idx, pitch] = 1
-            frame_roll[0 : offset_idx + 1, pitch] = 1
+        Returns:
+            notes (np.ndarray): (notes_num,) NOTE_DTYPE array
+    """
+    notes = np.zeros(len(frame_notes), dtype=NOTE_DTYPE)
+    notes["start"] = frame_notes["onset"] / fps
+    # Notes can not end before they start
+    notes["end"] = np.maximum(frame_notes["onset"], frame_notes["offset"]) / fps
+    notes["pitch"] = frame_notes["pitch"]
+    notes["velocity"] = frame_notes["velocity"]
 
-            events.append({
-                "name": "note_sustain", 
-                "time": 0, 
-                "label": label,
-                "pitch": pitch, 
-                "velocity": velocity
-            })
-            events.append({
-                "name": "note_off",
-                "time": offset_time, 
-                "label": label,
-                "pitch": pitch,
-            })
+    return notes
 
-        elif onset_time < 0 and seg_len < offset_time < math.inf:
 
-            frame_roll[:, pitch] = 1
+ROLL_NAMES = ("frame_roll", "onset_roll", "offset_roll", "velocity_roll")
+ROLL_FORMATS = ("dense", "compact", "sparse")
 
-            events.append({
-                "name": "note_sustain", 
-                "time": 0, 
-                "label": label,
-                "pitch": pitch, 
-                "velocity": velocity
-            })
 
-        elif 0 <= onset_time <= seg_len and 0 <= offset_time <= seg_len:
+def notes_to_rolls_and_events(notes, segment_frames, segment_start, fps, rolls=ROLL_NAMES, roll_format="dense"):
+    """
+        Convert the notes of a segment into piano rolls and notes
+        on the frame grid of the segment.
 
-            onset_idx = round(onset_time * fps)
-            offset_idx = round(offset_time * fps)
-            onset_roll[onset_idx, pitch] = 1
-            velocity_roll[onset_idx, pitch] = velocity / 128.0
-            offset_roll[offset_idx, pitch] = 1
-            frame_roll[onset_idx : offset_idx + 1, pitch] = 1
+        Args:
+            notes (np.ndarray): (notes_num,) NOTE_DTYPE array
+            segment_frames (int): number of frames in the segment
+            segment_start (float): segment start time in seconds
+            fps (int): frames per second
+            rolls (tuple): names of the rolls to build, a subset of
+                ROLL_NAMES. Rolls not listed are not computed.
+            roll_format (str): one of ROLL_FORMATS, see format_roll
 
-            events.append({
-                "name": "note_on",
-                "time": onset_time, 
-                "label": label,
-                "pitch": pitch, 
-                "velocity": velocity
-            })
-            events.append({
-                "name": "note_off",
-                "time": offset_time, 
-                "label": label,
-                "pitch": pitch, 
-            })
+        Returns:
+            data (dict): the requested rolls and "notes", a FRAME_NOTE_DTYPE
+                array of the notes overlapping the segment. Onsets < 0 and
+                offsets >= segment_frames are outside of the segment.
+    """
 
-        elif 0 <= onset_time <= seg_len and seg_len < offset_time < math.inf:
+    pitches_num = 128
+    last_frame = segment_frames - 1
 
-            onset_idx = round(onset_time * fps)
-            onset_roll[onset_idx, pitch] = 1
-            velocity_roll[onset_idx, pitch] = velocity / 128.0
-            frame_roll[onset_idx : , pitch] = 1
+    frame_notes = notes_to_frame_notes(notes, fps, origin=segment_start)
 
-            events.append({
-                "name": "note_on",
-                "time": onset_time, 
-                "label": label,
-                "pitch": pitch, 
-                "velocity": velocity
-            })
+    active = (frame_notes["offset"] >= 0) & (frame_notes["onset"] <= last_frame)
+    frame_notes = frame_notes[active]
 
-    events.sort(key=lambda event: (event["time"], event["name"], event["label"], event["pitch"]))
-    
     data = {
-        "frame_roll": frame_roll,
-        "onset_roll": onset_roll,
-        "offset_roll": offset_roll,
-        "velocity_roll": velocity_roll,
-        "events": events,
-        "notes": active_notes,
+        "notes": frame_notes,
     }
 
+    onsets = frame_notes["onset"]
+    pitches = frame_notes["pitch"]
+    velocities = frame_notes["velocity"]
+
+    # Notes shorter than a frame last one frame in the rolls
+    offsets = np.where(frame_notes["offset"] == onsets, onsets + 1, frame_notes["offset"])
+
+    has_onset = onsets >= 0
+    has_offset = offsets <= last_frame
+
+    # Covert notes information to rolls.
+    for name in rolls:
+
+        roll = np.zeros((segment_frames, pitches_num), dtype=np.uint8)
+
+        if name == "frame_roll":
+            # Mark note spans with +1 / -1 and integrate over frames
+            diff = np.zeros((segment_frames + 1, pitches_num), dtype=np.int64)
+            np.add.at(diff, (np.maximum(onsets, 0), pitches), 1)
+            np.add.at(diff, (np.minimum(offsets, last_frame) + 1, pitches), -1)
+            roll[np.cumsum(diff[: -1], axis=0) > 0] = 1
+
+        elif name == "onset_roll":
+            roll[onsets[has_onset], pitches[has_onset]] = 1
+
+        elif name == "offset_roll":
+            roll[offsets[has_offset], pitches[has_offset]] = 1
+
+        elif name == "velocity_roll":
+            # The last note wins when several notes start at the same frame
+            cells = onsets[has_onset] * pitches_num + pitches[has_onset]
+            _, last = np.unique(cells[:: -1], return_index=True)
+            last = len(cells) - 1 - last
+            roll[onsets[has_onset][last], pitches[has_onset][last]] = velocities[has_onset][last]
+
+        data[name] = format_roll(roll, name, roll_format)
+
     return data
 
 
+def format_roll(roll, name, roll_format):
+    """
+        Convert a uint8 roll into the requested format.
+
+        Args:
+            roll (np.ndarray): (frames_num, pitches_num) uint8 roll. The
+                velocity roll holds MIDI velocities, other rolls hold 0 or 1.
+            name (str): name of the roll
+            roll_format (str):
+                "dense": float64 roll, velocities scaled by 1 / 128
+                "compact": bool roll, or uint8 MIDI velocities
+                "sparse": (nnz, 3) int16 array of (frame, pitch, value)
+
+        Returns:
+            roll (np.ndarray): roll in the requested format
+    """
+    if roll_format == "dense":
+        roll = roll.astype(np.float64)
+        if name == "velocity_roll":
+            roll /= 128.0
+        return roll
+
+    elif roll_format == "compact":
+        if name == "velocity_roll":
+            return roll
+        return roll.astype(bool)
+
+    elif roll_format == "sparse":
+        frames, pitches = np.nonzero(roll)
+        return np.stack((frames, pitches, roll[frames, pitches]), axis=-1).astype(np.int16)
+
+    else:
+        raise NotImplementedError("{} is not supported!".format(roll_format))
+
+
 def pedals_to_rolls_and_events(pedals, segment_frames, segment_start, segment_end, fps, label):
 
     seg_start = segment_start
@@ -460,15 +798,10 @@ def events_to_notes(events):
             pitch = e["pitch"]
             if len(note_on_buffer[pitch]) > 0:
                 onset_event = note_on_buffer[pitch].pop(0)
-                note = pretty_midi.Note(
-                    pitch=pitch, 
-                    start=onset_event["time"], 
-                    end=e["time"], 
-                    velocity=onset_event["velocity"],
-                )
-                notes.append(note)
+                notes.append((onset_event["time"], e["time"], pitch, onset_event["velocity"]))
     
-    notes.sort(key=lambda note: (note.start, note.pitch, note.end, note.velocity))
+    notes = np.array(notes, dtype=NOTE_DTYPE)
+    notes = notes[np.lexsort((notes["velocity"], notes["end"], notes["pitch"], notes["start"]))]
 
     return notes
 
@@ -476,21 +809,47 @@ def events_to_notes(events):
 def fix_length(x, max_len, constant_value):
     if len(x) >= max_len:
         return x[0 : max_len]
+    elif isinstance(x, np.ndarray):
+        return np.concatenate((x, np.full(max_len - len(x), constant_value, dtype=x.dtype)))
     else:
         return x + [constant_value] * (max_len - len(x))
     
 
-def notes_to_midi(notes, midi_path):
+def notes_to_array(notes):
+    """
+        Convert pretty_midi notes into a NOTE_DTYPE array
 
-    track = pretty_midi.Instrument(program=0)
-    track.is_drum = False
+        Args:
+            notes (list): list of pretty_midi.Note
 
-    for note in notes:
-        track.notes.append(note)
+        Returns:
+            notes (np.ndarray): (notes_num,) NOTE_DTYPE array
+    """
+    return np.array(
+        [(note.start, note.end, note.pitch, note.velocity) for note in notes],
+        dtype=NOTE_DTYPE
+    )
 
-    midi_data = pretty_midi.PrettyMIDI()
-    midi_data.instruments.append(track)
-    midi_data.write(midi_path)
+
+def array_to_notes(notes):
+    """
+        Convert a NOTE_DTYPE array into pretty_midi notes
+
+        Args:
+            notes (np.ndarray): (notes_num,) NOTE_DTYPE array
+
+        Returns:
+            notes (list): list of pretty_midi.Note
+    """
+    return [
+        pretty_midi.Note(velocity=velocity, pitch=pitch, start=start, end=end)
+        for start, end, pitch, velocity in notes.tolist()
+    ]
+
+
+def notes_to_midi(notes, midi_path):
+
+    write_midi_notes(notes, midi_path)
     print("Write out to {}".format(midi_path))
 
 
@@ -509,8 +868,7 @@ def mt_notes_to_midi(mt_notes, inst_map, midi_path):
             track = pretty_midi.Instrument(program=program)
             track.is_drum = False
         
-        for note in notes:
-            track.notes.append(note)
+        track.notes = array_to_notes(notes)
 
         midi_data.instruments.append(track)
     
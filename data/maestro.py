@@ -10,9 +10,73 @@ import pretty_midi
 import numpy as np
 import re
 import soundfile
+import json
 import os
 
-from data.io import read_single_track_midi, notes_to_rolls_and_events, pedals_to_rolls_and_events, events_to_notes, notes_to_midi, fix_length, time_to_grid
+from data.io import read_midi_notes, read_single_track_midi, notes_to_rolls_and_events, pedals_to_rolls_and_events, events_to_notes, notes_to_midi, fix_length, time_to_grid, ROLL_NAMES
+
+# Keys an item can contain. Pass a subset as `fields` to only compute those.
+# "onoffvel_emb_h" is served from an embedding store, see embedding_path.
+FIELDS = ("audio_path", "segment_start_time", "audio", "onoffvel_emb_h") + ROLL_NAMES + ("string", "token", "tokens_num", "mask")
+TOKEN_FIELDS = ("string", "token", "tokens_num", "mask")
+
+
+def embedding_path(emb_dir, audio_filename):
+    """
+        Path of the cached encoder embeddings of an audio file, written by
+        cache_crnn_embeddings.py. The file is a float16 .npy array of shape
+        (segments_num, frames_num, emb_dim), where segment k starts at
+        k * hop_seconds.
+    """
+    return Path(emb_dir, audio_filename).with_suffix(".npy")
+
+
+def load_embedding_meta(emb_dir):
+    """
+        Segment and hop durations (in seconds) of an embedding store,
+        written by cache_crnn_embeddings.py.
+
+        Returns:
+            meta (dict): {"segment_seconds": float, "hop_seconds": float}
+    """
+    meta_path = Path(emb_dir, "meta.json")
+    assert meta_path.exists(), "{} not found, build the store with cache_crnn_embeddings.py".format(meta_path)
+
+    with open(meta_path, "r") as f:
+        return json.load(f)
+
+
+def load_note_densities(root, midi_filenames, durations, cache_path=None):
+    """
+        Number of notes per second of each MIDI file, an estimate of the
+        number of tokens of its segments. Densities are cached to
+        cache_path and recomputed if the list of files changes.
+
+        Args:
+            root (str): dataset root
+            midi_filenames (np.ndarray): MIDI paths relative to root
+            durations (np.ndarray): durations of the pieces in seconds
+            cache_path (str): optional .npz cache
+
+        Returns:
+            densities (np.ndarray): (files_num,) notes per second
+    """
+    midi_filenames = np.asarray(midi_filenames, dtype=str)
+
+    if cache_path is not None and Path(cache_path).exists():
+        cache = np.load(cache_path)
+        if np.array_equal(cache["midi_filenames"], midi_filenames):
+            return cache["densities"]
+
+    notes_nums = np.array([len(read_midi_notes(Path(root, name))[0]) for name in midi_filenames])
+    densities = notes_nums / np.maximum(np.asarray(durations, dtype=np.float64), 1e-6)
+
+    if cache_path is not None:
+        Path(cache_path).parent.mkdir(parents=True, exist_ok=True)
+        np.savez(cache_path, midi_filenames=midi_filenames, densities=densities)
+
+    return densities
+
 
 class MaestroMultiTask:
     def __init__(
@@ -24,6 +88,11 @@ class MaestroMultiTask:
         max_token_len=None,
         task=None,
         extend_pedal=True,
+        fields=None,
+        roll_format="dense",
+        dynamic_padding=False,
+        emb_dir=None,
+        emb_hop_seconds=None,
     ):
 
         self.root = root
@@ -41,6 +110,31 @@ class MaestroMultiTask:
 
         self.extend_pedal = extend_pedal
 
+        if fields is None:
+            # Embeddings are only served with an embedding store
+            fields = [key for key in FIELDS if key != "onoffvel_emb_h" or emb_dir is not None]
+
+        self.fields = tuple(fields)
+        assert set(self.fields) <= set(FIELDS), "Unknown fields: {}".format(set(self.fields) - set(FIELDS))
+        self.roll_format = roll_format
+
+        # Only truncate tokens to max_token_len, collate_fn pads them to
+        # the longest sequence of the batch
+        self.dynamic_padding = dynamic_padding
+
+        # Store of precomputed encoder embeddings, for training with a
+        # frozen encoder
+        self.emb_dir = emb_dir
+        self.emb_hop_seconds = emb_hop_seconds
+        assert "onoffvel_emb_h" not in self.fields or emb_dir is not None
+
+        if "onoffvel_emb_h" in self.fields:
+            # The hop of the store decides the start times of its segments
+            meta = load_embedding_meta(emb_dir)
+            assert meta["segment_seconds"] == segment_seconds, "Store of {} s segments".format(meta["segment_seconds"])
+            assert emb_hop_seconds is None or emb_hop_seconds == meta["hop_seconds"], "Store of a {} s hop".format(meta["hop_seconds"])
+            self.emb_hop_seconds = meta["hop_seconds"]
+
         self.meta_csv = Path(self.root, "maestro-v3.0.0.csv")
 
         self.load_meta()
@@ -57,17 +151,68 @@ class MaestroMultiTask:
         self.audios_num = len(self.midi_filenames)
 
     def __getitem__(self, index):
+        """
+            Args:
+                index (int | tuple): file index, or (file index, segment
+                    start time) as drawn by the samplers of data.samplers.
+                    The start is random if not given. With a list of
+                    start times, a list of items of the same file is
+                    returned, see load_segments.
+        """
         # t1 = time.time()
+        if isinstance(index, tuple):
+            index, segment_start_time = index
+        else:
+            segment_start_time = None
+
+        if isinstance(segment_start_time, list):
+            return self.load_segments(index, segment_start_time)
+
+        return self.load_segment(index, segment_start_time)
+
+    def load_segments(self, index, segment_start_times):
+        """
+            Several items of one file. Its audio is decoded and resampled
+            as one window spanning all segments, and its MIDI file is
+            parsed once.
+        """
+        audio_path = Path(self.root, self.audio_filenames[index])
+        midi_path = Path(self.root, self.midi_filenames[index])
+
+        # Starts are snapped to the cached segments with embeddings, so
+        # the audio is then loaded per segment
+        if "audio" in self.fields and "onoffvel_emb_h" not in self.fields:
+            audios = self.load_audio_segments(audio_path, segment_start_times)
+        else:
+            audios = [None] * len(segment_start_times)
+
+        notes, _ = read_single_track_midi(midi_path=midi_path, extend_pedal=self.extend_pedal)
+
+        return [
+            self.load_segment(index, segment_start_time, audio=audio, notes=notes)
+            for segment_start_time, audio in zip(segment_start_times, audios)
+        ]
+
+    def load_segment(self, index, segment_start_time, audio=None, notes=None):
+
         audio_path = Path(self.root, self.audio_filenames[index])
         midi_path = Path(self.root, self.midi_filenames[index]) 
         duration = self.durations[index]
 
-        # segment_start_time = random.uniform(0, duration - self.segment_seconds)
-        segment_start_time = random.uniform(0, duration)
+        if "onoffvel_emb_h" in self.fields:
+            # Cached segments start on a grid of emb_hop_seconds
+            onoffvel_emb_h, segment_start_time = self.load_embedding(self.audio_filenames[index], segment_start_time)
+            # shape: (frames_num, emb_dim)
+        else:
+            onoffvel_emb_h = None
+            if segment_start_time is None:
+                # segment_start_time = random.uniform(0, duration - self.segment_seconds)
+                segment_start_time = random.uniform(0, duration)
 
         # Load audio.
-        audio = self.load_audio(audio_path, segment_start_time)
-        # shape: (audio_samples)
+        if "audio" in self.fields and audio is None:
+            audio = self.load_audio(audio_path, segment_start_time)
+            # shape: (audio_samples)
 
         string_processor = MaestroStringProcessor(
             label=False,
@@ -84,6 +229,7 @@ class MaestroMultiTask:
             midi_path=midi_path,
             segment_start_time=segment_start_time,
             string_processor=string_processor,
+            notes=notes,
         )
         # shape: (tokens_num,)
 
@@ -91,15 +237,10 @@ class MaestroMultiTask:
             "audio_path": audio_path,
             "segment_start_time": segment_start_time,
             "audio": audio,
-            "frame_roll": targets_dict["frame_roll"],
-            "onset_roll": targets_dict["onset_roll"],
-            "offset_roll": targets_dict["offset_roll"],
-            "velocity_roll": targets_dict["velocity_roll"],
-            "string": targets_dict["string"],
-            "token": targets_dict["token"],
-            "tokens_num": targets_dict["tokens_num"],
-            "mask": targets_dict["mask"],
+            "onoffvel_emb_h": onoffvel_emb_h,
         }
+        data.update(targets_dict)
+        data = {key: data[key] for key in self.fields}
 
         debug = False
         if debug:
@@ -146,211 +287,144 @@ class MaestroMultiTask:
 
         return audio
 
-    def load_targets(self, midi_path, segment_start_time, string_processor):
+    def load_audio_segments(self, audio_path, segment_start_times):
+        """
+            Decode and resample the window of a file spanning all
+            segments once, and cut the segments from it. Segments match
+            those of load_audio up to half a resampled sample of shift.
 
-        notes, pedals = read_single_track_midi(midi_path=midi_path, extend_pedal=self.extend_pedal)
-
-        seg_start = segment_start_time
-        seg_end = seg_start + self.segment_seconds
+            Returns:
+                audios (list): (audio_samples,) arrays
+        """
+        orig_sr = librosa.get_samplerate(audio_path)
 
-        label = "maestro-Piano"
+        window_start_sample = int(min(segment_start_times) * orig_sr)
+        window_samples = int((max(segment_start_times) + self.segment_seconds) * orig_sr) - window_start_sample
 
-        note_data = notes_to_rolls_and_events(
-            notes=notes,
-            segment_frames=self.segment_frames,
-            segment_start=seg_start,
-            segment_end=seg_end,
-            fps=self.fps,
-            label=label
+        audio, fs = torchaudio.load(
+            audio_path,
+            frame_offset=window_start_sample,
+            num_frames=window_samples
         )
+        # (channels, audio_samples)
 
-        if self.task == "onset":
-
-            strings = [
-                "<sos>",
-                "task=onset",
-            ]
-            masks = [0, 0]
-
-            active_notes = []
-            for note in note_data["notes"]:
-                if 0 <= note.start <= self.segment_seconds:
-                    active_notes.append(note)
-
-            for note in active_notes:
-
-                onset_time = time_to_grid(note.start, self.fps)
-                offset_time = time_to_grid(note.end, self.fps)
-                pitch = note.pitch
-                velocity = note.velocity
-
-                strings.extend([
-                    "time={}".format(onset_time),
-                    "pitch={}".format(pitch),
-                ])
-                masks.extend([1, 1])
+        audio = np.array(torchaudio.functional.resample(
+            waveform=torch.mean(audio, dim=0),
+            orig_freq=orig_sr,
+            new_freq=self.sample_rate
+        ))
+        # shape: (audio_samples,)
 
-            strings.extend(["<eos>"])
-            masks.extend([1])
+        audios = []
 
-        elif self.task == "offset":
+        for segment_start_time in segment_start_times:
+            bgn = round((int(segment_start_time * orig_sr) - window_start_sample) * self.sample_rate / orig_sr)
+            segment = audio[bgn : bgn + self.segment_samples]
+            audios.append(librosa.util.fix_length(data=segment, size=self.segment_samples, axis=0))
 
-            active_notes = note_data["notes"]
+        return audios
 
-            strings = ["<sos>", "task=offset"]
-            masks = [0, 0]
+    def load_embedding(self, audio_filename, segment_start_time=None):
+        """
+            Read a cached segment of encoder embeddings from the
+            memory-mapped store.
 
-            for note in active_notes:
+            Args:
+                audio_filename (str): audio path relative to root
+                segment_start_time (float): the cached segment starting
+                    at or before it is read, a random one if None
 
-                onset_time = time_to_grid(note.start, self.fps)
-                offset_time = time_to_grid(note.end, self.fps)
-                pitch = note.pitch
-                velocity = note.velocity
+            Returns:
+                emb (np.ndarray): (frames_num, emb_dim) float16 embeddings
+                segment_start_time (float): start of the segment in seconds
+        """
+        embs = np.load(embedding_path(self.emb_dir, audio_filename), mmap_mode="r")
 
-                if onset_time < 0 and 0 <= offset_time <= self.segment_seconds:
+        if segment_start_time is None:
+            k = random.randrange(len(embs))
+        else:
+            k = min(int(segment_start_time // self.emb_hop_seconds), len(embs) - 1)
 
-                    strings.extend([
-                        "name=note_sustain",
-                        "pitch={}".format(pitch),
-                        "time={}".format(offset_time)
-                    ])
+        return np.array(embs[k]), k * self.emb_hop_seconds
 
-                elif 0 <= onset_time <= offset_time <= self.segment_seconds:
-                    strings.extend([
-                        "time={}".format(onset_time),
-                        "pitch={}".format(pitch),
-                        "time={}".format(offset_time),
-                    ])
+    def load_targets(self, midi_path, segment_start_time, string_processor, notes=None):
 
-                elif 0 <= onset_time <= self.segment_seconds and self.segment_seconds < offset_time:
-                    strings.extend([
-                        "time={}".format(onset_time),
-                        "pitch={}".format(pitch),
-                        "name=note_sustain",
-                    ])
+        if notes is None:
+            notes, pedals = read_single_track_midi(midi_path=midi_path, extend_pedal=self.extend_pedal)
 
-                elif onset_time < 0 and self.segment_seconds < offset_time:
+        seg_start = segment_start_time
 
-                    strings.extend([
-                        "name=note_sustain",
-                        "pitch={}".format(pitch),
-                        "name=note_sustain",
-                    ])
+        note_data = notes_to_rolls_and_events(
+            notes=notes,
+            segment_frames=self.segment_frames,
+            segment_start=seg_start,
+            fps=self.fps,
+            rolls=[name for name in ROLL_NAMES if name in self.fields],
+            roll_format=self.roll_format
+        )
 
-                masks.extend([0, 0, 1])
+        targets_dict = {name: note_data[name] for name in ROLL_NAMES if name in self.fields}
 
-            strings.extend(["<eos>"])
-            masks.extend([1])
+        if not any(key in self.fields for key in TOKEN_FIELDS):
+            return targets_dict
 
-        elif self.task == "velocity":
+        if isinstance(self.task, str):
+            targets_dict.update(self.load_task_tokens(note_data["notes"], self.task))
+            return targets_dict
 
-            strings = [
-                "<sos>",
-                "task=velocity",
-            ]
-            masks = [0, 0]
+        # Several tasks: one sequence per task from the same segment, so
+        # that a single encoder forward serves all of them
+        tasks_dicts = [self.load_task_tokens(note_data["notes"], task) for task in self.task]
 
-            active_notes = []
-            for note in note_data["notes"]:
-                if 0 <= note.start <= self.segment_seconds:
-                    active_notes.append(note)
+        for key in TOKEN_FIELDS:
+            targets_dict[key] = [task_dict[key] for task_dict in tasks_dicts]
 
-            for note in active_notes:
+        return targets_dict
 
-                onset_time = time_to_grid(note.start, self.fps)
-                offset_time = time_to_grid(note.end, self.fps)
-                pitch = note.pitch
-                velocity = note.velocity
+    def load_task_tokens(self, notes, task):
 
-                strings.extend([
-                    "time={}".format(onset_time),
-                    "pitch={}".format(pitch),
-                    "velocity={}".format(velocity)
-                ])
-                masks.extend([0, 0, 1])
+        if task in ["onset", "velocity"]:
+            # Only notes starting in the segment
+            notes = notes[notes["onset"] >= 0]
 
-            strings.extend(["<eos>"])
-            masks.extend([1])
-            
-        elif self.task == "flatten":
-            active_notes = note_data["notes"]
-
-            strings = ["<sos>", "task=flatten"]
-            masks = [0, 0]
-
-            for note in active_notes:
-                onset_time = time_to_grid(note.start, self.fps)
-                offset_time = time_to_grid(note.end, self.fps)
-                pitch = note.pitch
-                velocity = note.velocity
-
-                if onset_time < 0 and 0 <= offset_time <= self.segment_seconds:
-                    strings.extend([
-                        "name=note_sustain",
-                        "pitch={}".format(pitch),
-                        "time={}".format(offset_time),
-                        "velocity={}".format(velocity)
-                    ])
-                elif 0 <= onset_time <= offset_time <= self.segment_seconds:
-                    strings.extend([
-                        "time={}".format(onset_time),
-                        "pitch={}".format(pitch),
-                        "time={}".format(offset_time),
-                        "velocity={}".format(velocity)
-                    ])
-                elif 0 <= onset_time <= self.segment_seconds and self.segment_seconds < offset_time:
-                    strings.extend([
-                        "time={}".format(onset_time),
-                        "pitch={}".format(pitch),
-                        "name=note_sustain",
-                        "velocity={}".format(velocity)
-                    ])
-                elif onset_time < 0 and self.segment_seconds < offset_time:
-                    strings.extend([
-                        "name=note_sustain",
-                        "pitch={}".format(pitch),
-                        "name=note_sustain",
-                        "velocity={}".format(velocity)
-                    ])
-
-                masks.extend([1, 1, 1, 1])
-
-            strings.extend(["<eos>"])
-            masks.extend([1])
+        tokens, masks = self.tokenizer.notes_to_tokens(
+            task=task,
+            onset_frames=notes["onset"],
+            offset_frames=notes["offset"],
+            pitches=notes["pitch"],
+            velocities=notes["velocity"],
+            segment_frames=self.segment_frames,
+        )
+        tokens_num = len(tokens)
 
+        if "string" in self.fields:
+            strings = self.tokenizer.tokens_to_strings(tokens).tolist()
         else:
-            raise NotImplementedError
-
-        #
-        tokens = self.tokenizer.strings_to_tokens(strings)
-        tokens_num = len(tokens)
+            strings = None
 
-        tokens = np.array(fix_length(
-            x=tokens,
-            max_len=self.max_token_len,
-            constant_value=self.tokenizer.stoi("<pad>")
-        ))
-        masks = np.array(fix_length(
-            x=masks,
-            max_len=self.max_token_len,
-            constant_value=0
-        ))
+        if self.dynamic_padding:
+            tokens = tokens[0 : self.max_token_len]
+            masks = masks[0 : self.max_token_len]
+        else:
+            tokens = fix_length(
+                x=tokens,
+                max_len=self.max_token_len,
+                constant_value=self.tokenizer.stoi("<pad>")
+            )
+            masks = fix_length(
+                x=masks,
+                max_len=self.max_token_len,
+                constant_value=0
+            )
 
-        targets_dict = {
-            "frame_roll": note_data["frame_roll"],
-            "onset_roll": note_data["onset_roll"],
-            "offset_roll": note_data["offset_roll"],
-            "velocity_roll": note_data["velocity_roll"],
-            "ped_frame_roll": None, # pedal_data["frame_roll"],
-            "ped_onset_roll": None, # pedal_data["onset_roll"],
-            "ped_offset_roll": None, # pedal_data["offset_roll"],
+        tokens_dict = {
             "string": strings,
             "token": tokens,
             "tokens_num": tokens_num,
             "mask": masks
         }
 
-        return targets_dict
+        return tokens_dict
 
 
 class MaestroMultiTask_hft:
@@ -363,6 +437,9 @@ class MaestroMultiTask_hft:
             max_token_len=None,
             task=None,
             extend_pedal=True,
+            fields=None,
+            roll_format="dense",
+            dynamic_padding=False,
     ):
 
         self.root = root
@@ -380,6 +457,15 @@ class MaestroMultiTask_hft:
 
         self.extend_pedal = extend_pedal
 
+        self.fields = tuple(key for key in FIELDS if key != "onoffvel_emb_h") if fields is None else tuple(fields)
+        assert set(self.fields) <= set(FIELDS), "Unknown fields: {}".format(set(self.fields) - set(FIELDS))
+        assert "onoffvel_emb_h" not in self.fields, "Cached embeddings are not supported by MaestroMultiTask_hft"
+        self.roll_format = roll_format
+
+        # Only truncate tokens to max_token_len, collate_fn pads them to
+        # the longest sequence of the batch
+        self.dynamic_padding = dynamic_padding
+
         self.meta_csv = Path(self.root, "maestro-v3.0.0.csv")
 
         self.load_meta()
@@ -396,19 +482,31 @@ class MaestroMultiTask_hft:
         self.audios_num = len(self.midi_filenames)
 
     def __getitem__(self, index):
+        # index is a file index or (file index, segment start time), see
+        # MaestroMultiTask.__getitem__
+        if isinstance(index, tuple):
+            index, segment_start_time = index
+        else:
+            segment_start_time = None
+
         audio_path = Path(self.root, self.audio_filenames[index])
         midi_path = Path(self.root, self.midi_filenames[index])
         duration = self.durations[index]
 
-        segment_start_time = random.uniform(0, duration)
+        if segment_start_time is None:
+            segment_start_time = random.uniform(0, duration)
+
         if segment_start_time <= 0.256:
             segment_start_time = 0.0
         elif segment_start_time < 0.512:
             segment_start_time = 0.512
 
         # Load audio.
-        audio = self.load_audio(audio_path, segment_start_time)
-        # shape: (audio_samples)
+        if "audio" in self.fields:
+            audio = self.load_audio(audio_path, segment_start_time)
+            # shape: (audio_samples)
+        else:
+            audio = None
 
         string_processor = MaestroStringProcessor(
             label=False,
@@ -432,15 +530,9 @@ class MaestroMultiTask_hft:
             "audio_path": audio_path,
             "segment_start_time": segment_start_time,
             "audio": audio,
-            "frame_roll": targets_dict["frame_roll"],
-            "onset_roll": targets_dict["onset_roll"],
-            "offset_roll": targets_dict["offset_roll"],
-            "velocity_roll": targets_dict["velocity_roll"],
-            "string": targets_dict["string"],
-            "token": targets_dict["token"],
-            "tokens_num": targets_dict["tokens_num"],
-            "mask": targets_dict["mask"],
         }
+        data.update(targets_dict)
+        data = {key: data[key] for key in self.fields}
 
         debug = False
         if debug:
@@ -504,156 +596,63 @@ class MaestroMultiTask_hft:
         notes, pedals = read_single_track_midi(midi_path=midi_path, extend_pedal=self.extend_pedal)
 
         seg_start = segment_start_time
-        seg_end = seg_start + self.segment_seconds
-
-        label = "maestro-Piano"
 
         note_data = notes_to_rolls_and_events(
             notes=notes,
             segment_frames=self.segment_frames,
             segment_start=seg_start,
-            segment_end=seg_end,
             fps=self.fps,
-            label=label
+            rolls=[name for name in ROLL_NAMES if name in self.fields],
+            roll_format=self.roll_format
         )
 
-        if self.task == "onset":
-
-            strings = [
-                "<sos>",
-                "task=onset",
-            ]
-            masks = [0, 0]
-
-            active_notes = []
-            for note in note_data["notes"]:
-                if 0 <= note.start <= self.segment_seconds:
-                    active_notes.append(note)
+        targets_dict = {name: note_data[name] for name in ROLL_NAMES if name in self.fields}
 
-            for note in active_notes:
-                onset_time = time_to_grid(note.start, self.fps)
-                offset_time = time_to_grid(note.end, self.fps)
-                pitch = note.pitch
-                velocity = note.velocity
+        if not any(key in self.fields for key in TOKEN_FIELDS):
+            return targets_dict
 
-                strings.extend([
-                    "time={}".format(onset_time),
-                    "pitch={}".format(pitch),
-                ])
-                masks.extend([1, 1])
+        notes = note_data["notes"]
 
-            strings.extend(["<eos>"])
-            masks.extend([1])
+        if self.task in ["onset", "velocity"]:
+            # Only notes starting in the segment
+            notes = notes[notes["onset"] >= 0]
 
-        elif self.task == "offset":
-
-            active_notes = note_data["notes"]
-
-            strings = ["<sos>", "task=offset"]
-            masks = [0, 0]
-
-            for note in active_notes:
-
-                onset_time = time_to_grid(note.start, self.fps)
-                offset_time = time_to_grid(note.end, self.fps)
-                pitch = note.pitch
-                velocity = note.velocity
-
-                if onset_time < 0 and 0 <= offset_time <= self.segment_seconds:
-
-                    strings.extend([
-                        "name=note_sustain",
-                        "pitch={}".format(pitch),
-                        "time={}".format(offset_time)
-                    ])
-
-                elif 0 <= onset_time <= offset_time <= self.segment_seconds:
-                    strings.extend([
-                        "time={}".format(onset_time),
-                        "pitch={}".format(pitch),
-                        "time={}".format(offset_time),
-                    ])
-
-                elif 0 <= onset_time <= self.segment_seconds and self.segment_seconds < offset_time:
-                    strings.extend([
-                        "time={}".format(onset_time),
-                        "pitch={}".format(pitch),
-                        "name=note_sustain",
-                    ])
-
-                elif onset_time < 0 and self.segment_seconds < offset_time:
-
-                    strings.extend([
-                        "name=note_sustain",
-                        "pitch={}".format(pitch),
-                        "name=note_sustain",
-                    ])
-
-                masks.extend([0, 0, 1])
-
-            strings.extend(["<eos>"])
-            masks.extend([1])
-
-        elif self.task == "velocity":
-
-            strings = [
-                "<sos>",
-                "task=velocity",
-            ]
-            masks = [0, 0]
-
-            active_notes = []
-            for note in note_data["notes"]:
-                if 0 <= note.start <= self.segment_seconds:
-                    active_notes.append(note)
-
-            for note in active_notes:
-                onset_time = time_to_grid(note.start, self.fps)
-                offset_time = time_to_grid(note.end, self.fps)
-                pitch = note.pitch
-                velocity = note.velocity
-
-                strings.extend([
-                    "time={}".format(onset_time),
-                    "pitch={}".format(pitch),
-                    "velocity={}".format(velocity)
-                ])
-                masks.extend([0, 0, 1])
-
-            strings.extend(["<eos>"])
-            masks.extend([1])
+        tokens, masks = self.tokenizer.notes_to_tokens(
+            task=self.task,
+            onset_frames=notes["onset"],
+            offset_frames=notes["offset"],
+            pitches=notes["pitch"],
+            velocities=notes["velocity"],
+            segment_frames=self.segment_frames,
+        )
+        tokens_num = len(tokens)
 
+        if "string" in self.fields:
+            strings = self.tokenizer.tokens_to_strings(tokens).tolist()
         else:
-            raise NotImplementedError
-
-        #
-        tokens = self.tokenizer.strings_to_tokens(strings)
-        tokens_num = len(tokens)
+            strings = None
 
-        tokens = np.array(fix_length(
-            x=tokens,
-            max_len=self.max_token_len,
-            constant_value=self.tokenizer.stoi("<pad>")
-        ))
-        masks = np.array(fix_length(
-            x=masks,
-            max_len=self.max_token_len,
-            constant_value=0
-        ))
+        if self.dynamic_padding:
+            tokens = tokens[0 : self.max_token_len]
+            masks = masks[0 : self.max_token_len]
+        else:
+            tokens = fix_length(
+                x=tokens,
+                max_len=self.max_token_len,
+                constant_value=self.tokenizer.stoi("<pad>")
+            )
+            masks = fix_length(
+                x=masks,
+                max_len=self.max_token_len,
+                constant_value=0
+            )
 
-        targets_dict = {
-            "frame_roll": note_data["frame_roll"],
-            "onset_roll": note_data["onset_roll"],
-            "offset_roll": note_data["offset_roll"],
-            "velocity_roll": note_data["velocity_roll"],
-            "ped_frame_roll": None,  # pedal_data["frame_roll"],
-            "ped_onset_roll": None,  # pedal_data["onset_roll"],
-            "ped_offset_roll": None,  # pedal_data["offset_roll"],
+        targets_dict.update({
             "string": strings,
             "token": tokens,
             "tokens_num": tokens_num,
             "mask": masks
-        }
+        })
 
         return targets_dict
 
@@ -0,0 +1,192 @@
+import random
+import numpy as np
+
+
+class Sampler:
+    def __init__(self, dataset_size, rank=0, world_size=1, seed=None, durations=None):
+        """
+            Infinite sampler of shuffled dataset indexes.
+
+            For distributed training, every rank shuffles the indexes
+            with the same seed and yields every world_size-th index of
+            the permutation, starting at rank, so that ranks see
+            disjoint items.
+
+            With durations, (index, segment start time) pairs are
+            yielded instead, with starts drawn uniformly in the files by
+            the same seeded generator. The DataLoader workers then only
+            load what the sampler decided, so samples are reproducible
+            and do not depend on the random state of the workers.
+
+            Args:
+                dataset_size (int): number of items
+                rank (int): rank of the process
+                world_size (int): number of processes
+                seed (int): seed of the shuffles, shared by all ranks
+                durations (np.ndarray): optional (dataset_size,) durations
+                    of the files in seconds
+        """
+        assert world_size == 1 or seed is not None, "Ranks must share a seed"
+
+        self.indexes = list(range(dataset_size))
+        self.rank = rank
+        self.world_size = world_size
+        self.random = random.Random(seed)
+        self.durations = durations
+
+        self.shuffle()
+
+        # Number of indexes to skip, see resume
+        self.start = 0
+
+    def resume(self, start):
+        """
+            Skip the first start indexes of the next iteration, to continue
+            an interrupted run. The sampler must be newly created with the
+            seed of that run.
+        """
+        self.start = start
+
+    def shuffle(self):
+
+        self.random.shuffle(self.indexes)
+
+        if self.durations is not None:
+            # Drawn for all ranks, so that the generators stay in step
+            self.starts = [self.random.uniform(0, self.durations[index]) for index in self.indexes]
+
+    def __iter__(self):
+
+        pointer = self.rank
+        n = 0
+
+        while True:
+
+            if pointer >= len(self.indexes):
+                self.shuffle()
+                pointer = self.rank
+
+            if self.durations is None:
+                index = self.indexes[pointer]
+            else:
+                index = (self.indexes[pointer], self.starts[pointer])
+
+            pointer += self.world_size
+
+            if n >= self.start:
+                yield index
+
+            n += 1
+
+
+class BucketBatchSampler:
+    def __init__(self, lengths, batch_size, buckets_num=8, rank=0, world_size=1, seed=None, durations=None, segments_per_file=1, window_seconds=None):
+        """
+            Infinite batch sampler that draws every batch from one bucket
+            of items of similar length, so that dynamically padded
+            batches carry few <pad> tokens.
+
+            Items are sorted by lengths (e.g. note densities of the
+            files) and split into buckets_num buckets. A bucket is
+            picked with probability proportional to its size, and each
+            bucket is shuffled and visited like Sampler.
+
+            For distributed training, all ranks draw the same global
+            batch of world_size * batch_size items with the same seed
+            and each yields its own slice of it.
+
+            With durations, batches hold (index, segment start time)
+            pairs drawn by the same seeded generator, see Sampler.
+
+            With segments_per_file > 1, a batch holds batch_size /
+            segments_per_file files, each an (index, segment start times)
+            pair of segments_per_file starts drawn in a random window of
+            window_seconds of the file. The dataset then reads these
+            segments of a file at once, see MaestroMultiTask.load_segments.
+
+            Args:
+                lengths (np.ndarray): (dataset_size,) length estimate of each item
+                batch_size (int): number of items per batch and rank
+                buckets_num (int): number of buckets
+                rank (int): rank of the process
+                world_size (int): number of processes
+                seed (int): seed of the shuffles, shared by all ranks
+                durations (np.ndarray): optional (dataset_size,) durations
+                    of the files in seconds
+                segments_per_file (int): number of segments read per file
+                window_seconds (float): span of the segments of a file,
+                    the whole file if None
+        """
+        assert world_size == 1 or seed is not None, "Ranks must share a seed"
+        assert segments_per_file == 1 or durations is not None, "Segments are drawn from durations"
+        assert batch_size % segments_per_file == 0
+
+        self.batch_size = batch_size // segments_per_file
+        self.durations = durations
+        self.segments_per_file = segments_per_file
+        self.window_seconds = window_seconds
+        self.rank = rank
+        self.world_size = world_size
+        self.random = random.Random(seed)
+
+        order = np.argsort(lengths, kind="stable")
+        self.buckets = [bucket.tolist() for bucket in np.array_split(order, buckets_num) if len(bucket) > 0]
+        self.weights = [len(bucket) for bucket in self.buckets]
+
+        for bucket in self.buckets:
+            self.random.shuffle(bucket)
+
+        # Number of batches to skip, see resume
+        self.start = 0
+
+    def resume(self, start):
+        """
+            Skip the first start batches of the next iteration, to continue
+            an interrupted run. The sampler must be newly created with the
+            seed of that run.
+        """
+        self.start = start
+
+    def __iter__(self):
+
+        pointers = [0] * len(self.buckets)
+        n = 0
+
+        while True:
+
+            k = self.random.choices(range(len(self.buckets)), weights=self.weights)[0]
+            bucket = self.buckets[k]
+
+            batch = []
+
+            while len(batch) < self.batch_size * self.world_size:
+
+                if pointers[k] == len(bucket):
+                    self.random.shuffle(bucket)
+                    pointers[k] = 0
+
+                batch.append(bucket[pointers[k]])
+                pointers[k] += 1
+
+            if self.segments_per_file > 1:
+                batch = [(index, self.draw_starts(self.durations[index])) for index in batch]
+            elif self.durations is not None:
+                batch = [(index, self.random.uniform(0, self.durations[index])) for index in batch]
+
+            if n >= self.start:
+                yield batch[self.rank * self.batch_size : (self.rank + 1) * self.batch_size]
+
+            n += 1
+
+    def draw_starts(self, duration):
+        """
+            Draw segments_per_file sorted segment start times in a random
+            window of window_seconds of a file.
+        """
+        if self.window_seconds is None:
+            window_start, window_seconds = 0., duration
+        else:
+            window_start = self.random.uniform(0, max(duration - self.window_seconds, 0.))
+            window_seconds = min(self.window_seconds, duration)
+
+        return sorted(window_start + self.random.uniform(0, window_seconds) for _ in range(self.segments_per_file))
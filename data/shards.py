@@ -0,0 +1,441 @@
+import os
+import json
+import random
+import shutil
+import itertools
+import numpy as np
+import torch
+from pathlib import Path
+
+from data.samplers import Sampler
+
+
+# Shards hold segments written by pack_maestro_shards.py (a whole split)
+# or write_segments (fixed validation segments). A shard is a directory of:
+#   <array>.npy: (segments_num, ...) float16 arrays of the segments, i.e.
+#       "audio" 16 kHz audio and / or "onoffvel_emb_h" cached embeddings
+#   token.npy: (tokens_num,) int16 tokens of all segments and tasks
+#   mask.npy: (tokens_num,) int8 masks of the tokens
+#   index.npz: offsets (segments_num, tasks_num + 1) of the tokens of
+#       every task of a segment in token.npy, file_index (segments_num,)
+#       and segment_start_time (segments_num,) of every segment
+# meta.json of the shards directory lists the tasks, arrays and shards,
+# and the settings the segments were written with, if any.
+
+
+class ShardWriter:
+    def __init__(self, shards_dir, tasks, sample_rate, segment_seconds, segments_per_shard=512, config=None):
+        """
+            Write segments with pre-tokenized targets of every task into
+            shards of segments_per_shard segments.
+
+            Args:
+                shards_dir (str): directory of the shards
+                tasks (list): tasks of the token sequences of a segment
+                sample_rate (int): sample rate of the audio
+                segment_seconds (float): duration of a segment
+                segments_per_shard (int): number of segments of a shard
+                config (dict): optional settings of the segments, written
+                    to meta.json, see load_segments_config
+        """
+        self.shards_dir = Path(shards_dir)
+        self.tasks = list(tasks)
+        self.sample_rate = sample_rate
+        self.segment_seconds = segment_seconds
+        self.segments_per_shard = segments_per_shard
+        self.config = config
+
+        self.shards = []
+        self.segments_num = 0
+        self.arrays = None
+        self.clear()
+
+        self.shards_dir.mkdir(parents=True, exist_ok=True)
+
+    def clear(self):
+
+        self.segments = []
+        self.tokens = []
+        self.masks = []
+        self.file_indexes = []
+        self.segment_start_times = []
+
+    def write(self, tokens, masks, file_index, segment_start_time, **arrays):
+        """
+            Args:
+                tokens (list): (tokens_num,) tokens of every task
+                masks (list): (tokens_num,) masks of every task
+                file_index (int): index of the file in its split
+                segment_start_time (float): start of the segment in seconds
+                arrays (dict): arrays of the segment, e.g. audio:
+                    (segment_samples,), the same for all segments
+        """
+        assert len(tokens) == len(masks) == len(self.tasks)
+
+        if self.arrays is None:
+            self.arrays = sorted(arrays.keys())
+
+        assert sorted(arrays.keys()) == self.arrays
+
+        self.segments.append({key: x.astype(np.float16) for key, x in arrays.items()})
+        self.tokens.append(tokens)
+        self.masks.append(masks)
+        self.file_indexes.append(file_index)
+        self.segment_start_times.append(segment_start_time)
+
+        if len(self.segments) == self.segments_per_shard:
+            self.flush()
+
+    def flush(self):
+
+        if len(self.segments) == 0:
+            return
+
+        name = "shard={:05d}".format(len(self.shards))
+        shard_dir = Path(self.shards_dir, name)
+
+        # Write to a temporary directory so that interrupted shards are redone
+        tmp_dir = Path(self.shards_dir, name + ".tmp")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir()
+
+        lengths = np.array([[len(x) for x in tokens] for tokens in self.tokens])
+        offsets = np.zeros((len(self.segments), len(self.tasks) + 1), dtype=np.int64)
+        offsets[:, 1 :] = np.cumsum(lengths, axis=1)
+        offsets += np.concatenate(([0], np.cumsum(lengths.sum(axis=1))[0 : -1]))[:, None]
+
+        for key in self.arrays:
+            np.save(Path(tmp_dir, "{}.npy".format(key)), np.stack([data[key] for data in self.segments], axis=0))
+
+        np.save(Path(tmp_dir, "token.npy"), np.concatenate([x for tokens in self.tokens for x in tokens]).astype(np.int16))
+        np.save(Path(tmp_dir, "mask.npy"), np.concatenate([x for masks in self.masks for x in masks]).astype(np.int8))
+        np.savez(
+            Path(tmp_dir, "index.npz"),
+            offsets=offsets,
+            file_index=np.array(self.file_indexes),
+            segment_start_time=np.array(self.segment_start_times)
+        )
+
+        shutil.rmtree(shard_dir, ignore_errors=True)
+        os.replace(tmp_dir, shard_dir)
+
+        self.shards.append(name)
+        self.segments_num += len(self.segments)
+        self.clear()
+
+    def close(self):
+
+        self.flush()
+
+        meta = {
+            "tasks": self.tasks,
+            "sample_rate": self.sample_rate,
+            "segment_seconds": self.segment_seconds,
+            "arrays": self.arrays,
+            "segments_num": self.segments_num,
+            "shards": self.shards,
+            "config": self.config,
+        }
+
+        with open(Path(self.shards_dir, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=4)
+
+
+def draw_segments(durations, segments_num, seed):
+    """
+        Fixed (file index, segment start time) pairs, drawn like the
+        training segments, see Sampler.
+
+        Args:
+            durations (np.ndarray): (files_num,) durations in seconds
+            segments_num (int): number of segments
+            seed (int): seed of the draw
+
+        Returns:
+            segments (list): (file index, segment start time) pairs
+    """
+    sampler = Sampler(dataset_size=len(durations), seed=seed, durations=durations)
+
+    return list(itertools.islice(iter(sampler), segments_num))
+
+
+def write_segments(dataset, segments, shards_dir, segments_per_shard=512, config=None):
+    """
+        Write fixed segments of a MaestroMultiTask dataset, e.g. a
+        validation set, into shards. Shards already in shards_dir are
+        removed.
+
+        Args:
+            dataset (MaestroMultiTask): dataset with "token", "mask" and
+                "audio" or "onoffvel_emb_h" fields
+            segments (list): (file index, segment start time) pairs
+            shards_dir (str): directory of the shards
+            segments_per_shard (int): number of segments of a shard
+            config (dict): settings of the segments, see
+                load_segments_config
+    """
+    tasks = [dataset.task] if isinstance(dataset.task, str) else dataset.task
+
+    shutil.rmtree(shards_dir, ignore_errors=True)
+
+    writer = ShardWriter(
+        shards_dir=shards_dir,
+        tasks=tasks,
+        sample_rate=dataset.sample_rate,
+        segment_seconds=dataset.segment_seconds,
+        segments_per_shard=segments_per_shard,
+        config=config
+    )
+
+    for index, segment_start_time in segments:
+
+        data = dataset[(index, segment_start_time)]
+
+        if isinstance(dataset.task, str):
+            tokens, masks = [data["token"]], [data["mask"]]
+        else:
+            tokens, masks = data["token"], data["mask"]
+
+        writer.write(
+            tokens=tokens,
+            masks=masks,
+            file_index=index,
+            segment_start_time=segment_start_time,
+            **{key: data[key] for key in ["audio", "onoffvel_emb_h"] if key in data}
+        )
+
+    writer.close()
+
+
+def load_segments_config(shards_dir):
+    """
+        Settings the segments of shards_dir were written with, e.g. the
+        fields, seed and number of validation segments, so that shards
+        written by a run with other settings are rewritten. None if
+        there are no shards.
+    """
+    meta_path = Path(shards_dir, "meta.json")
+
+    if not meta_path.exists():
+        return None
+
+    with open(meta_path, "r") as f:
+        return json.load(f).get("config")
+
+
+class Shard:
+    def __init__(self, shard_dir, arrays):
+        """
+            Memory-mapped shard, see ShardWriter.
+
+            Args:
+                shard_dir (str): directory of the shard
+                arrays (list): names of the arrays of the segments
+        """
+        self.arrays = {key: np.load(Path(shard_dir, "{}.npy".format(key)), mmap_mode="r") for key in arrays}
+        self.tokens = np.load(Path(shard_dir, "token.npy"), mmap_mode="r")
+        self.masks = np.load(Path(shard_dir, "mask.npy"), mmap_mode="r")
+
+        index = np.load(Path(shard_dir, "index.npz"))
+        self.offsets = index["offsets"]
+        self.segment_start_times = index["segment_start_time"]
+
+    def __len__(self):
+
+        return len(self.offsets)
+
+    def read(self, n, task_indexes, fields, max_token_len=None):
+        """
+            Read segment n, with the token sequences of every task of
+            task_indexes. Arrays are kept float16.
+        """
+        data = {"segment_start_time": self.segment_start_times[n]}
+
+        for key in self.arrays:
+            if key in fields:
+                data[key] = np.array(self.arrays[key][n])
+
+        if "token" in fields or "mask" in fields:
+            bgns = [self.offsets[n, k] for k in task_indexes]
+            ends = [self.offsets[n, k + 1] for k in task_indexes]
+
+            if max_token_len is not None:
+                ends = [min(end, bgn + max_token_len) for bgn, end in zip(bgns, ends)]
+
+            data["token"] = [np.array(self.tokens[bgn : end]) for bgn, end in zip(bgns, ends)]
+            data["mask"] = [np.array(self.masks[bgn : end]) for bgn, end in zip(bgns, ends)]
+
+        return data
+
+
+def decode_segment(data, task, fields):
+    """
+        Item of a segment read by Shard.read, like those of
+        MaestroMultiTask: float32 audio, and one token sequence for a
+        single task.
+    """
+    if "audio" in data:
+        data["audio"] = data["audio"].astype(np.float32)
+
+    if isinstance(task, str) and "token" in data:
+        data["token"] = data["token"][0]
+        data["mask"] = data["mask"][0]
+
+    return {key: data[key] for key in fields}
+
+
+def load_meta(shards_dir, task):
+
+    with open(Path(shards_dir, "meta.json"), "r") as f:
+        meta = json.load(f)
+
+    task = meta["tasks"] if task is None else task
+    tasks = [task] if isinstance(task, str) else task
+    task_indexes = [meta["tasks"].index(task) for task in tasks]
+
+    return meta, task, task_indexes
+
+
+class ShardSegments(torch.utils.data.Dataset):
+    def __init__(self, shards_dir, task=None, max_token_len=None, fields=("audio", "token", "mask")):
+        """
+            Random access to the segments of shards, e.g. the fixed
+            validation segments written by write_segments.
+
+            Args:
+                shards_dir (str): directory of the shards
+                task (str | list): task(s) of the token sequences, all
+                    written tasks if None
+                max_token_len (int): optional truncation of the tokens
+                fields (list): subset of the arrays, "token", "mask" and
+                    "segment_start_time"
+        """
+        self.shards_dir = shards_dir
+        self.max_token_len = max_token_len
+        self.fields = tuple(fields)
+
+        self.meta, self.task, self.task_indexes = load_meta(shards_dir, task)
+
+        # Shards are memory-mapped on first access, see __getitem__
+        self.shards = None
+
+    def __getitem__(self, index):
+
+        if self.shards is None:
+            # Opened in the process (e.g. DataLoader worker) reading them
+            self.shards = [Shard(Path(self.shards_dir, shard), self.meta["arrays"]) for shard in self.meta["shards"]]
+            self.bgns = np.cumsum([0] + [len(shard) for shard in self.shards])
+
+        k = np.searchsorted(self.bgns, index, side="right") - 1
+        data = self.shards[k].read(index - self.bgns[k], self.task_indexes, self.fields, self.max_token_len)
+
+        return decode_segment(data, self.task, self.fields)
+
+    def __len__(self):
+
+        return self.meta["segments_num"]
+
+
+class MaestroShards(torch.utils.data.IterableDataset):
+    def __init__(
+        self,
+        shards_dir,
+        task=None,
+        max_token_len=None,
+        fields=("audio", "token", "mask"),
+        shuffle_buffer_size=128,
+        rank=0,
+        world_size=1,
+        seed=None
+    ):
+        """
+            Infinite stream of the segments of shards written by
+            ShardWriter, with items like those of MaestroMultiTask.
+
+            Every rank and DataLoader worker reads its own shards of a
+            seeded shuffle of the shards, each sequentially, and yields
+            segments at random from a buffer of shuffle_buffer_size
+            segments. With fewer shards than ranks * workers, shards are
+            split into contiguous parts, read by different workers.
+            Buffers hold float16 audio, i.e. about 320 kB per 10 s
+            segment and worker.
+
+            Args:
+                shards_dir (str): directory of the shards
+                task (str | list): task(s) of the token sequences, all
+                    written tasks if None
+                max_token_len (int): optional truncation of the tokens
+                fields (list): subset of the arrays, "token", "mask" and
+                    "segment_start_time"
+                shuffle_buffer_size (int): number of segments to shuffle
+                rank (int): rank of the process
+                world_size (int): number of processes
+                seed (int): seed of the shuffles, shared by all ranks
+        """
+        assert world_size == 1 or seed is not None, "Ranks must share a seed"
+
+        self.shards_dir = shards_dir
+        self.max_token_len = max_token_len
+        self.fields = tuple(fields)
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+
+        self.meta, self.task, self.task_indexes = load_meta(shards_dir, task)
+
+        # Offset of the seeds, see resume
+        self.start = 0
+
+    def resume(self, start):
+        """
+            Reseed the streams with start, so that a resumed run does not
+            replay the segments of the interrupted one. Unlike the
+            samplers of data.samplers, the stream of the interrupted run
+            is not continued exactly.
+        """
+        self.start = start
+
+    def __iter__(self):
+
+        worker_info = torch.utils.data.get_worker_info()
+
+        if worker_info is None:
+            workers_num, worker_id = 1, 0
+        else:
+            workers_num, worker_id = worker_info.num_workers, worker_info.id
+
+        # Every (rank, worker) pair reads its own parts of the shards
+        streams_num = self.world_size * workers_num
+        stream = self.rank * workers_num + worker_id
+
+        # Parts of the shards, at least one per stream
+        parts_num = -(-streams_num // len(self.meta["shards"]))
+        parts = [(shard, part) for shard in self.meta["shards"] for part in range(parts_num)]
+
+        # Shared by all streams, so that they split the same shuffle
+        shards_random = random.Random("{}-{}".format(self.seed, self.start))
+        buffer_random = random.Random("{}-{}-{}".format(self.seed, self.start, stream))
+
+        buffer = []
+
+        while True:
+
+            shards_random.shuffle(parts)
+
+            for shard, part in parts[stream : : streams_num]:
+
+                shard = Shard(Path(self.shards_dir, shard), self.meta["arrays"])
+
+                for n in range(part * len(shard) // parts_num, (part + 1) * len(shard) // parts_num):
+
+                    # Sequential reads of the shard
+                    data = shard.read(n, self.task_indexes, self.fields, self.max_token_len)
+
+                    if len(buffer) < self.shuffle_buffer_size:
+                        buffer.append(data)
+                        continue
+
+                    k = buffer_random.randrange(len(buffer))
+                    yield decode_segment(buffer[k], self.task, self.fields)
+                    buffer[k] = data
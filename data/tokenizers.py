@@ -1,6 +1,8 @@
 import re
 import numpy as np
 
+from data.io import FRAME_NOTE_DTYPE
+
 class BaseTokenizer:
     def __init__(self, strings):
         """
@@ -39,8 +41,7 @@ class BaseTokenizer:
             Returns:
                 token (int): token index
         """
-        if string in self.strings:
-            return self.string_to_token[string]
+        return self.string_to_token.get(string)
 
 
 class SpecialTokenizer(BaseTokenizer):
@@ -218,6 +219,20 @@ class TaskTokenizer(BaseTokenizer):
         BaseTokenizer.__init__(self, strings)
         self.vocab_size = 100
 
+# Start of each sub-tokenizer's partition in the global ID space.
+SPECIAL_OFFSET = 0
+NAME_OFFSET = 4
+TIME_OFFSET = 104
+MAESTRO_LABEL_OFFSET = 6105
+SLAKH2100_LABEL_OFFSET = 6106
+GTZAN_LABEL_OFFSET = 6122
+PITCH_OFFSET = 6132
+VELOCITY_OFFSET = 6260
+BEAT_OFFSET = 6388
+TASK_OFFSET = 6404
+VOCAB_SIZE = 6504
+
+
 class Tokenizer:
     def __init__(self, verbose=False):
         self.tokenizers = [
@@ -236,6 +251,35 @@ class Tokenizer:
         ]
 
         self.vocab_size = np.sum([tokenizer.vocab_size for tokenizer in self.tokenizers])
+        self.frames_per_second = next(t for t in self.tokenizers if isinstance(t, TimeTokenizer)).frames_per_second
+
+        # IDs (0 - 3) for <pad>, <sos>...etc
+        # IDs (4 - 103) for name=
+        # IDs (104 - 6104) for time=
+        # ...
+        # In summary, 4 for name= is the global token ID, 
+        # however, its local idx is 0
+        self.offsets = np.cumsum([0] + [tokenizer.vocab_size for tokenizer in self.tokenizers[:-1]])
+        assert self.offsets.tolist() == [
+            SPECIAL_OFFSET, NAME_OFFSET, TIME_OFFSET, MAESTRO_LABEL_OFFSET, SLAKH2100_LABEL_OFFSET,
+            GTZAN_LABEL_OFFSET, PITCH_OFFSET, VELOCITY_OFFSET, BEAT_OFFSET, TASK_OFFSET
+        ] and self.vocab_size == VOCAB_SIZE
+
+        # Lookup tables over the full vocabulary. IDs reserved by a
+        # sub-tokenizer without a string map to None.
+        self.token_to_string = np.full(self.vocab_size, None, dtype=object)
+        for offset, tokenizer in zip(self.offsets, self.tokenizers):
+            for token in range(tokenizer.vocab_size):
+                try:
+                    self.token_to_string[offset + token] = tokenizer.itos(token)
+                except KeyError:
+                    pass
+
+        self.string_to_token = {string: token for token, string in enumerate(self.token_to_string) if string is not None}
+
+        # Times formatted with two decimals, e.g. "time=0.10"
+        for token in range(TimeTokenizer().vocab_size):
+            self.string_to_token.setdefault("time={:.2f}".format(token / 100), TIME_OFFSET + token)
 
         if verbose:
             print("Vocab size: {}".format(self.vocab_size))
@@ -245,51 +289,201 @@ class Tokenizer:
     def itos(self, token):
         assert 0 <= token < self.vocab_size
 
-        for tokenizer in self.tokenizers:
-            if token >= tokenizer.vocab_size:
-                token -= tokenizer.vocab_size
-            else:
-                break
-            
-        return tokenizer.itos(token)
+        string = self.token_to_string[token]
+
+        if string is None:
+            raise KeyError(token)
+
+        return string
 
     def stoi(self, string):
-        
-        start_token = 0
 
-        for tokenizer in self.tokenizers:
+        token = self.string_to_token.get(string)
+
+        if token is not None:
+            return token
+
+        # Strings outside of the table, e.g. off-grid times, are
+        # parsed by the sub-tokenizers.
+        for offset, tokenizer in zip(self.offsets, self.tokenizers):
             
             token = tokenizer.stoi(string)
             
             if token is not None:
-                return start_token + token
-            else:
-                # we do the below because we are partitioning
-                # the ID space:
-                # IDs (0 - 3) for <pad>, <sos>...etc
-                # IDs (4 - 103) for name=
-                # IDs (104 - 6104) for time=
-                # This means for itos, we do the reverse...
-                # In summary, 4 for name= is the global token ID, 
-                # however, its local idx is 0
-                start_token += tokenizer.vocab_size
+                return int(offset) + token
 
         raise NotImplementedError("{} is not supported!".format(string))
 
     def strings_to_tokens(self, strings):
+        """
+            Args:
+                strings (list | np.ndarray): (N,) strings
 
-        tokens = []
+            Returns:
+                tokens (np.ndarray): (N,) int64 tokens
+        """
+        get = self.string_to_token.get
+        tokens = [get(string) for string in strings]
 
-        for string in strings:
-            tokens.append(self.stoi(string))
+        if None in tokens:
+            tokens = [self.stoi(string) for string in strings]
 
-        return tokens
+        return np.array(tokens, dtype=np.int64)
 
     def tokens_to_strings(self, tokens):
+        """
+            Args:
+                tokens (list | np.ndarray): (N,) tokens
+
+            Returns:
+                strings (np.ndarray): (N,) strings
+        """
+        tokens = np.asarray(tokens, dtype=np.int64)
+        assert np.all((0 <= tokens) & (tokens < self.vocab_size))
 
-        strings = []
+        strings = self.token_to_string[tokens]
 
-        for token in tokens:
-            strings.append(self.itos(token))
+        if None in strings:
+            raise KeyError(tokens[np.equal(strings, None)][0])
 
         return strings
+
+    def notes_to_tokens(self, task, onset_frames, offset_frames, pitches, velocities, segment_frames):
+        """
+            Encode the notes of a segment into tokens without
+            building strings.
+
+            For "onset" and "velocity" all notes are encoded as notes
+            starting in the segment, select them before calling. For
+            "offset" and "flatten", onsets before frame 0 and offsets
+            after the last frame are encoded as name=note_sustain.
+
+            Args:
+                task (str): "onset", "offset", "velocity" or "flatten"
+                onset_frames (np.ndarray): (N,) onset frames relative to the segment
+                offset_frames (np.ndarray): (N,) offset frames relative to the segment
+                pitches (np.ndarray): (N,) MIDI pitches
+                velocities (np.ndarray): (N,) MIDI velocities
+                segment_frames (int): number of frames in the segment
+
+            Returns:
+                tokens (np.ndarray): (tokens_num,) int64 tokens, from <sos> to <eos>
+                masks (np.ndarray): (tokens_num,) int64 loss masks
+        """
+        onset_frames = np.asarray(onset_frames, dtype=np.int64)
+        offset_frames = np.asarray(offset_frames, dtype=np.int64)
+        pitches = np.asarray(pitches, dtype=np.int64)
+        velocities = np.asarray(velocities, dtype=np.int64)
+
+        sustain = self.stoi("name=note_sustain")
+
+        if task == "onset":
+            columns = [TIME_OFFSET + onset_frames, PITCH_OFFSET + pitches]
+            note_masks = [1, 1]
+
+        elif task == "offset":
+            columns = [
+                np.where(onset_frames < 0, sustain, TIME_OFFSET + onset_frames),
+                PITCH_OFFSET + pitches,
+                np.where(offset_frames > segment_frames - 1, sustain, TIME_OFFSET + offset_frames),
+            ]
+            note_masks = [0, 0, 1]
+
+        elif task == "velocity":
+            columns = [TIME_OFFSET + onset_frames, PITCH_OFFSET + pitches, VELOCITY_OFFSET + velocities]
+            note_masks = [0, 0, 1]
+
+        elif task == "flatten":
+            columns = [
+                np.where(onset_frames < 0, sustain, TIME_OFFSET + onset_frames),
+                PITCH_OFFSET + pitches,
+                np.where(offset_frames > segment_frames - 1, sustain, TIME_OFFSET + offset_frames),
+                VELOCITY_OFFSET + velocities,
+            ]
+            note_masks = [1, 1, 1, 1]
+
+        else:
+            raise NotImplementedError
+
+        notes_num = len(pitches)
+
+        tokens = np.concatenate((
+            [self.stoi("<sos>"), self.stoi("task={}".format(task))],
+            np.stack(columns, axis=-1).reshape(-1),
+            [self.stoi("<eos>")],
+        )).astype(np.int64)
+
+        masks = np.concatenate((
+            [0, 0],
+            np.tile(note_masks, notes_num),
+            [1],
+        )).astype(np.int64)
+
+        return tokens, masks
+
+    def tokens_to_notes(self, tokens, task, velocity=100, duration=10):
+        """
+            Decode generated tokens into notes without building strings.
+
+            Each time token starts a note, the last pitch (and velocity)
+            token after it completes the note. Decoding stops at the first
+            <eos>; without <eos> the last, unterminated note is dropped.
+
+            Args:
+                tokens (np.ndarray): (N,) tokens after the task token
+                task (str): "onset" (time, pitch) or "velocity" (time, pitch, velocity)
+                velocity (int): velocity of the notes of the "onset" task
+                duration (int): duration of the notes in frames
+
+            Returns:
+                notes (np.ndarray): (notes_num,) FRAME_NOTE_DTYPE array sorted by
+                    (onset, pitch, offset, velocity)
+        """
+        tokens = np.asarray(tokens, dtype=np.int64)
+
+        eos = np.flatnonzero(tokens == self.stoi("<eos>"))
+        if len(eos) > 0:
+            tokens = tokens[: eos[0]]
+
+        is_time = (TIME_OFFSET <= tokens) & (tokens < MAESTRO_LABEL_OFFSET)
+        event_idxes = np.cumsum(is_time) - 1
+        events_num = np.sum(is_time)
+
+        if len(eos) == 0:
+            events_num = max(events_num - 1, 0)
+
+        frames = tokens[is_time][: events_num] - TIME_OFFSET
+        pitches = self._last_in_event(tokens, event_idxes, events_num, PITCH_OFFSET, VELOCITY_OFFSET)
+
+        if task == "onset":
+            velocities = np.full(events_num, velocity)
+        elif task == "velocity":
+            velocities = self._last_in_event(tokens, event_idxes, events_num, VELOCITY_OFFSET, BEAT_OFFSET)
+        else:
+            raise NotImplementedError
+
+        valid = (pitches >= 0) & (velocities >= 0)
+
+        notes = np.zeros(np.sum(valid), dtype=FRAME_NOTE_DTYPE)
+        notes["onset"] = frames[valid]
+        notes["offset"] = frames[valid] + duration
+        notes["pitch"] = pitches[valid]
+        notes["velocity"] = velocities[valid]
+
+        notes = notes[np.lexsort((notes["velocity"], notes["offset"], notes["pitch"], notes["onset"]))]
+
+        return notes
+
+    def _last_in_event(self, tokens, event_idxes, events_num, begin, end):
+        """
+            Local value of the last token in [begin, end) of each event,
+            or -1 if an event has no such token.
+        """
+        values = np.full(events_num, -1, dtype=np.int64)
+
+        selected = (begin <= tokens) & (tokens < end) & (0 <= event_idxes) & (event_idxes < events_num)
+        idxes = event_idxes[selected]
+        last = np.append(idxes[1:] != idxes[:-1], True)[: len(idxes)]
+        values[idxes[last]] = tokens[selected][last] - begin
+
+        return values
@@ -18,10 +18,11 @@ from train_llama_mt_off_crnn import get_model
 import mir_eval
 import re
 from models.crnn import CRnn
-from data.tokenizers import Tokenizer
+from data.tokenizers import Tokenizer, TIME_OFFSET, PITCH_OFFSET, MAESTRO_LABEL_OFFSET
 from models.enc_dec import EncDecConfig, EncDecPos
+from models.pytorch_utils import autocast, load_model_states
 from data.maestro import MaestroStringProcessor
-from data.io import events_to_notes, notes_to_midi, read_single_track_midi, write_notes_to_midi, fix_length
+from data.io import events_to_notes, notes_to_midi, read_single_track_midi, write_notes_to_midi, fix_length, read_midi_notes, notes_to_frame_notes, frame_notes_to_notes
 
 
 def inference_in_batch(args):
@@ -34,25 +35,33 @@ def inference_in_batch(args):
     segment_seconds = 10.
     device = "cuda"
     sample_rate = 16000
+    fps = 100
     top_k = 1
+    # "float32", "bfloat16" or "float16" autocast
+    precision = "float32"
     batch_size = 4
     frames_num = 1001
     max_token_len = 1536
     segment_samples = int(segment_seconds * sample_rate)
+    segment_frames = int(segment_seconds * fps)
 
     tokenizer = Tokenizer()
 
     # Load checkpoint
     enc_model = CRnn()
-    checkpoint_path = Path("checkpoints/train_llama_mt_off_crnn/AudioLlama/step=40000_encoder.pth") 
-    enc_model.load_state_dict(torch.load(checkpoint_path))
+    checkpoint_path = Path("checkpoints/train_llama_mt_off_crnn/AudioLlama/step=40000.pth")
+    model_state, enc_model_state = load_model_states(checkpoint_path)
+    if enc_model_state is not None:
+        enc_model.load_state_dict(enc_model_state)
+    else:
+        # The decoder was trained on the frozen pretrained encoder
+        enc_model.load_state_dict2(torch.load(Path("Note_pedal.pth"))["model"])
     enc_model.to(device)
 
     for param in enc_model.parameters():
         param.requires_grad = False
 
     # Load checkpoint
-    checkpoint_path = Path("checkpoints/train_llama_mt_off_crnn/AudioLlama/step=40000.pth")
     config = EncDecConfig(
         block_size=max_token_len + 1, 
         vocab_size=tokenizer.vocab_size, 
@@ -63,7 +72,7 @@ def inference_in_batch(args):
         audio_n_embd=1536
     )
     model = EncDecPos(config)
-    model.load_state_dict(torch.load(checkpoint_path))
+    model.load_state_dict(model_state)
     model.to(device)
 
     # Data
@@ -120,13 +129,13 @@ def inference_in_batch(args):
         
         # 
         onset_midi_path = Path(onset_midis_dir, "{}.mid".format(Path(audio_path).stem))
-        onset_midi_data = pretty_midi.PrettyMIDI(str(onset_midi_path))
-        pred_onset_notes = onset_midi_data.instruments[0].notes
+        pred_onset_notes, _ = read_midi_notes(onset_midi_path)
+        pred_onset_notes = notes_to_frame_notes(pred_onset_notes, fps)
 
         #
         # seg_notes = []
-        all_notes = []
-        sustain_notes = []
+        all_indexes = []
+        sustain_indexes = []
 
         while bgn < audio_samples:
 
@@ -136,12 +145,12 @@ def inference_in_batch(args):
             segments = librosa.util.frame(segment, frame_length=segment_samples, hop_length=segment_samples).T
 
             bgn_sec = bgn / sample_rate
-            end_sec = bgn_sec + segment_seconds
+            bgn_frame = bgn * fps // sample_rate
             print("Processing: {:.1f} s".format(bgn_sec))
 
             segments = torch.Tensor(segments).to(device)
 
-            with torch.no_grad():
+            with torch.no_grad(), autocast(device, precision):
                 enc_model.eval()
                 audio_emb = enc_model(segments)["onoffvel_emb_h"]
 
@@ -150,19 +159,19 @@ def inference_in_batch(args):
                 "<sos>",
                 "task=offset",
             ]
-            tokens = tokenizer.strings_to_tokens(strings)
+            tokens = tokenizer.strings_to_tokens(strings).tolist()
 
             # Process sustain notes
             # still_sustain_notes = []
-            for note in sustain_notes:
+            for i in sustain_indexes:
                 token = tokenizer.stoi("name=note_sustain")
                 tokens.append(token)
-                token = tokenizer.stoi("pitch={}".format(note.pitch))
+                token = PITCH_OFFSET + pred_onset_notes["pitch"][i]
                 tokens.append(token)
                 tokens = np.array(tokens)[None, :]
                 tokens = torch.LongTensor(tokens).to(device)
 
-                with torch.no_grad():
+                with torch.no_grad(), autocast(device, precision):
                     model.eval()
                     pred_tokens = model.generate_in_batch(
                         audio_emb=audio_emb, 
@@ -172,20 +181,18 @@ def inference_in_batch(args):
                     ).data.cpu().numpy()
                     pred_token = pred_tokens[0][-1]
 
-                string = tokenizer.itos(pred_token)
-                if "time" in string:
-                    offset_time = float(re.search('time=(.*)', string).group(1))
-                    note.end = bgn_sec + offset_time
-                    all_notes.append(note)
+                if TIME_OFFSET <= pred_token < MAESTRO_LABEL_OFFSET:
+                    pred_onset_notes["offset"][i] = bgn_frame + pred_token - TIME_OFFSET
+                    all_indexes.append(i)
                     
-                elif "name=note_sustain" in string:
+                elif pred_token == tokenizer.stoi("name=note_sustain"):
                     # still_sustain_notes.append(note)
                     pass
                     # from IPython import embed; embed(using=False); os._exit(0)
 
                 tokens = tokens[0].tolist() + [pred_token]
 
-            sustain_notes = []
+            sustain_indexes = []
 
 
             # Process notes
@@ -193,24 +200,24 @@ def inference_in_batch(args):
                 "<sos>",
                 "task=offset",
             ]
-            tokens = tokenizer.strings_to_tokens(strings)
+            tokens = tokenizer.strings_to_tokens(strings).tolist()
 
-            candidate_notes = []
-            for note in pred_onset_notes:
-                if bgn_sec <= note.start < end_sec:
-                    candidate_notes.append(note)
+            candidate_indexes = np.flatnonzero(
+                (bgn_frame <= pred_onset_notes["onset"]) & 
+                (pred_onset_notes["onset"] < bgn_frame + segment_frames)
+            )
 
             # 
-            for note in candidate_notes:
-                token = tokenizer.stoi("time={:.2f}".format(note.start - bgn_sec))
+            for i in candidate_indexes:
+                token = TIME_OFFSET + pred_onset_notes["onset"][i] - bgn_frame
                 tokens.append(token)
-                token = tokenizer.stoi("pitch={}".format(note.pitch))
+                token = PITCH_OFFSET + pred_onset_notes["pitch"][i]
                 tokens.append(token)
                 tokens = np.array(tokens)[None, :]
                 tokens = torch.LongTensor(tokens).to(device)
             
                 # 
-                with torch.no_grad():
+                with torch.no_grad(), autocast(device, precision):
                     model.eval()
                     pred_tokens = model.generate_in_batch(
                         audio_emb=audio_emb, 
@@ -220,13 +227,11 @@ def inference_in_batch(args):
                     ).data.cpu().numpy()
                     pred_token = pred_tokens[0][-1]
             
-                string = tokenizer.itos(pred_token)
-                if "time" in string:
-                    offset_time = float(re.search('time=(.*)', string).group(1))
-                    note.end = bgn_sec + offset_time
-                    all_notes.append(note)
-                elif "name=note_sustain" in string:
-                    sustain_notes.append(note)
+                if TIME_OFFSET <= pred_token < MAESTRO_LABEL_OFFSET:
+                    pred_onset_notes["offset"][i] = bgn_frame + pred_token - TIME_OFFSET
+                    all_indexes.append(i)
+                elif pred_token == tokenizer.stoi("name=note_sustain"):
+                    sustain_indexes.append(i)
 
                 tokens = tokens[0].tolist() + [pred_token]
                 
@@ -240,7 +245,9 @@ def inference_in_batch(args):
 
             bgn += segment_samples
 
-        all_notes.sort(key=lambda note: (note.start, note.pitch))
+        all_notes = pred_onset_notes[np.array(all_indexes, dtype=np.int64)]
+        all_notes = all_notes[np.lexsort((all_notes["pitch"], all_notes["onset"]))]
+        all_notes = frame_notes_to_notes(all_notes, fps)
             
         notes_to_midi(all_notes, "_zz.mid")
         # soundfile.write(file="_zz.wav", data=audio, samplerate=16000)
@@ -359,20 +366,11 @@ def load_meta(meta_csv, split):
 
 def parse_midi(midi_path):
 
-    midi_data = pretty_midi.PrettyMIDI(str(midi_path))
-
-    notes = midi_data.instruments[0].notes
-
-    intervals = []
-    pitches = []
-    velocities = []
+    notes, _ = read_midi_notes(midi_path)
 
-    for note in notes:
-        intervals.append([note.start, note.end])
-        pitches.append(note.pitch)
-        velocities.append(note.velocity)
+    intervals = np.stack((notes["start"], notes["end"]), axis=-1)
 
-    return np.array(intervals), np.array(pitches), np.array(velocities)
+    return intervals, notes["pitch"], notes["velocity"]
 
 
 def deduplicate_array(array):
@@ -20,8 +20,9 @@ import re
 
 from data.tokenizers import Tokenizer
 from models.enc_dec import EncDecConfig, EncDecPos
+from models.pytorch_utils import autocast, load_model_states
 from data.maestro import MaestroStringProcessor
-from data.io import events_to_notes, notes_to_midi, read_single_track_midi, write_notes_to_midi, fix_length
+from data.io import events_to_notes, notes_to_midi, read_single_track_midi, write_notes_to_midi, fix_length, read_midi_notes, frame_notes_to_notes, FRAME_NOTE_DTYPE
 
 
 def inference_in_batch(args):
@@ -34,19 +35,28 @@ def inference_in_batch(args):
     segment_seconds = 10.
     device = "cuda"
     sample_rate = 16000
+    fps = 100
     top_k = 1
+    # "float32", "bfloat16" or "float16" autocast
+    precision = "float32"
     batch_size = 4
     frames_num = 1001
     max_token_len = 1024
     segment_samples = int(segment_seconds * sample_rate)
+    segment_frames = int(segment_seconds * fps)
 
     tokenizer = Tokenizer()
 
     # Load checkpoint
     enc_model = CRnn()
     #checkpoint_path = Path("checkpoints/train_llama_mt_on7/AudioLlama/step=300000_encoder.pth") 
-    checkpoint_path = Path("checkpoints/train_llama_mt_on_crnn/AudioLlama/step=60000_encoder.pth")
-    enc_model.load_state_dict(torch.load(checkpoint_path))
+    checkpoint_path = Path("checkpoints/train_llama_mt_on_crnn/AudioLlama/step=60000.pth")
+    model_state, enc_model_state = load_model_states(checkpoint_path)
+    if enc_model_state is not None:
+        enc_model.load_state_dict(enc_model_state)
+    else:
+        # The decoder was trained on the frozen pretrained encoder
+        enc_model.load_state_dict2(torch.load(Path("Note_pedal.pth"))["model"])
     enc_model.to(device)
 
     for param in enc_model.parameters():
@@ -54,7 +64,6 @@ def inference_in_batch(args):
 
     # Load checkpoint
     #checkpoint_path = Path("checkpoints/train_llama_mt_on7/AudioLlama/step=300000.pth")
-    checkpoint_path = Path("checkpoints/train_llama_mt_on_crnn/AudioLlama/step=60000.pth")
     config = EncDecConfig(
         block_size=max_token_len + 1, 
         vocab_size=tokenizer.vocab_size, 
@@ -65,7 +74,7 @@ def inference_in_batch(args):
         audio_n_embd=1536
     )
     model = EncDecPos(config)
-    model.load_state_dict(torch.load(checkpoint_path))
+    model.load_state_dict(model_state)
     model.to(device)
 
     # Data
@@ -129,7 +138,7 @@ def inference_in_batch(args):
         tokens = np.repeat(np.array(tokens)[None, :], repeats=batch_size, axis=0)
         tokens = torch.LongTensor(tokens).to(device)
 
-        all_notes = []
+        all_notes = [np.zeros(0, dtype=FRAME_NOTE_DTYPE)]
 
         while bgn < audio_samples:
 
@@ -139,16 +148,17 @@ def inference_in_batch(args):
             segments = librosa.util.frame(clip, frame_length=segment_samples, hop_length=segment_samples).T
 
             bgn_sec = bgn / sample_rate
+            bgn_frame = bgn * fps // sample_rate
             print("Processing: {:.1f} s".format(bgn_sec))
 
             segments = torch.Tensor(segments).to(device)
 
-            with torch.no_grad():
+            with torch.no_grad(), autocast(device, precision):
                 enc_model.eval()
                 audio_emb = enc_model(segments)["onoffvel_emb_h"]
 
             # 
-            with torch.no_grad():
+            with torch.no_grad(), autocast(device, precision):
                 model.eval()
                 pred_tokens = model.generate_in_batch(
                     audio_emb=audio_emb, 
@@ -158,25 +168,17 @@ def inference_in_batch(args):
                 ).data.cpu().numpy()
 
                 for k in range(pred_tokens.shape[0]):
-                    for i, token in enumerate(pred_tokens[k]):
-                        if token == tokenizer.stoi("<eos>"):
-                            break                    
-
-                    new_pred_tokens = pred_tokens[k, 1 : i + 1]
-                    # from IPython import embed; embed(using=False); os._exit(0)
-                    strings = tokenizer.tokens_to_strings(new_pred_tokens)
-                    events = onset_strings_to_events(strings)
-                    notes = events_to_notes(events)
-                    
-                    for note in notes:
-                        note.start += bgn_sec + k * segment_seconds
-                        note.end += bgn_sec + k * segment_seconds
-
-                    all_notes.extend(notes)
+                    notes = tokenizer.tokens_to_notes(pred_tokens[k, 1 :], task="onset")
+                    notes["onset"] += bgn_frame + k * segment_frames
+                    notes["offset"] += bgn_frame + k * segment_frames
+
+                    all_notes.append(notes)
 
             bgn += clip_samples
             # from IPython import embed; embed(using=False); os._exit(0)
 
+        all_notes = frame_notes_to_notes(np.concatenate(all_notes), fps)
+
         notes_to_midi(all_notes, "_zz.mid")
         # soundfile.write(file="_zz.wav", data=audio, samplerate=16000)
         
@@ -227,20 +229,11 @@ def load_meta(meta_csv, split):
 
 def parse_midi(midi_path):
 
-    midi_data = pretty_midi.PrettyMIDI(str(midi_path))
-
-    notes = midi_data.instruments[0].notes
-
-    intervals = []
-    pitches = []
-    velocities = []
+    notes, _ = read_midi_notes(midi_path)
 
-    for note in notes:
-        intervals.append([note.start, note.end])
-        pitches.append(note.pitch)
-        velocities.append(note.velocity)
+    intervals = np.stack((notes["start"], notes["end"]), axis=-1)
 
-    return np.array(intervals), np.array(pitches), np.array(velocities)
+    return intervals, notes["pitch"], notes["velocity"]
 
 
 def deduplicate_array(array):
@@ -256,61 +249,6 @@ def deduplicate_array(array):
     return np.array(new_array)
 
 
-def onset_strings_to_events(strings):
-
-    event = None
-    events = []
-
-    for w in strings:
-
-        if "=" in w:
-            key = re.search('(.*)=', w).group(1)
-            value = re.search('{}=(.*)'.format(key), w).group(1)
-            value = format_value(key, value)
-
-            if key == "time":
-                if event is not None:
-                    events.append(event)
-                event = {}
-
-            event[key] = value
-
-        if w == "<eos>" and event is not None:
-            events.append(event)
-            break
-
-    new_events = []
-
-    for e in events:
-
-        if "time" in e.keys() and "pitch" in e.keys():
-            e["name"] = "note_on"
-            e["velocity"] = 100
-            new_events.append(e)
-
-            event = {
-                "name": "note_off",
-                "time": float(e["time"]) + 0.1,
-                "pitch": e["pitch"]
-            }
-            new_events.append(event)
-        
-    new_events.sort(key=lambda e: (e["time"], e["name"], e["pitch"]))
-    
-    return new_events
-
-
-def format_value(key, value): 
-    if key in ["time"]:
-        return float(value)
-
-    elif key in ["pitch", "velocity"]:
-        return int(value)
-
-    else:
-        return value
-
-
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
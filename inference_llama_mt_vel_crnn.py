@@ -13,10 +13,11 @@ from train_llama_mt_vel_crnn import get_model
 import mir_eval
 import re
 from models.crnn import CRnn
-from data.tokenizers import Tokenizer
+from data.tokenizers import Tokenizer, TIME_OFFSET, PITCH_OFFSET, VELOCITY_OFFSET, BEAT_OFFSET
 from models.enc_dec import EncDecConfig, EncDecPos
+from models.pytorch_utils import autocast, load_model_states
 from data.maestro import MaestroStringProcessor
-from data.io import events_to_notes, notes_to_midi, read_single_track_midi, write_notes_to_midi, fix_length
+from data.io import events_to_notes, notes_to_midi, read_single_track_midi, write_notes_to_midi, fix_length, read_midi_notes, notes_to_frame_notes, frame_notes_to_notes
 
 
 def inference_in_batch(args):
@@ -29,25 +30,33 @@ def inference_in_batch(args):
     segment_seconds = 10.
     device = "cuda"
     sample_rate = 16000
+    fps = 100
     top_k = 1
+    # "float32", "bfloat16" or "float16" autocast
+    precision = "float32"
     batch_size = 4
     frames_num = 1001
     max_token_len = 1536
     segment_samples = int(segment_seconds * sample_rate)
+    segment_frames = int(segment_seconds * fps)
 
     tokenizer = Tokenizer()
 
     # Load checkpoint
     enc_model = CRnn()
-    checkpoint_path = Path("checkpoints/train_llama_mt_vel_crnn/AudioLlama/step=50000_encoder.pth") 
-    enc_model.load_state_dict(torch.load(checkpoint_path))
+    checkpoint_path = Path("checkpoints/train_llama_mt_vel_crnn/AudioLlama/step=50000.pth")
+    model_state, enc_model_state = load_model_states(checkpoint_path)
+    if enc_model_state is not None:
+        enc_model.load_state_dict(enc_model_state)
+    else:
+        # The decoder was trained on the frozen pretrained encoder
+        enc_model.load_state_dict2(torch.load(Path("Note_pedal.pth"))["model"])
     enc_model.to(device)
 
     for param in enc_model.parameters():
         param.requires_grad = False
 
     # Load checkpoint
-    checkpoint_path = Path("checkpoints/train_llama_mt_vel_crnn/AudioLlama/step=50000.pth")
     config = EncDecConfig(
         block_size=max_token_len + 1, 
         vocab_size=tokenizer.vocab_size, 
@@ -58,7 +67,7 @@ def inference_in_batch(args):
         audio_n_embd=1536
     )
     model = EncDecPos(config)
-    model.load_state_dict(torch.load(checkpoint_path))
+    model.load_state_dict(model_state)
     model.to(device)
 
     # Data
@@ -108,11 +117,11 @@ def inference_in_batch(args):
         
         # 
         onset_midi_path = Path(onset_midis_dir, "{}.mid".format(Path(audio_path).stem))
-        onset_midi_data = pretty_midi.PrettyMIDI(str(onset_midi_path))
-        pred_onset_notes = onset_midi_data.instruments[0].notes
+        pred_onset_notes, _ = read_midi_notes(onset_midi_path)
+        pred_onset_notes = notes_to_frame_notes(pred_onset_notes, fps)
 
         #
-        all_notes = []
+        all_indexes = []
 
         while bgn < audio_samples:
 
@@ -126,35 +135,34 @@ def inference_in_batch(args):
 
             segments = torch.Tensor(segments).to(device)
 
-            with torch.no_grad():
+            with torch.no_grad(), autocast(device, precision):
                 enc_model.eval()
                 audio_emb = enc_model(segments)["onoffvel_emb_h"]
 
             #
-            bgn_sec = bgn / sample_rate
-            end_sec = bgn_sec + segment_seconds
-            candidate_notes = []
-            for note in pred_onset_notes:
-                if bgn_sec <= note.start < end_sec:
-                    candidate_notes.append(note)
+            bgn_frame = bgn * fps // sample_rate
+            candidate_indexes = np.flatnonzero(
+                (bgn_frame <= pred_onset_notes["onset"]) & 
+                (pred_onset_notes["onset"] < bgn_frame + segment_frames)
+            )
 
             strings = [
                 "<sos>",
                 "task=velocity",
             ]
-            tokens = tokenizer.strings_to_tokens(strings)
+            tokens = tokenizer.strings_to_tokens(strings).tolist()
             
             # 
-            for note in candidate_notes:
-                token = tokenizer.stoi("time={:.2f}".format(note.start - bgn_sec))
+            for i in candidate_indexes:
+                token = TIME_OFFSET + pred_onset_notes["onset"][i] - bgn_frame
                 tokens.append(token)
-                token = tokenizer.stoi("pitch={}".format(note.pitch))
+                token = PITCH_OFFSET + pred_onset_notes["pitch"][i]
                 tokens.append(token)
                 tokens = np.array(tokens)[None, :]
                 tokens = torch.LongTensor(tokens).to(device)
             
                 # 
-                with torch.no_grad():
+                with torch.no_grad(), autocast(device, precision):
                     model.eval()
                     pred_tokens = model.generate_in_batch(
                         audio_emb=audio_emb, 
@@ -167,12 +175,13 @@ def inference_in_batch(args):
                 tokens = tokens[0].tolist() + [pred_token]
 
                 # append new notes
-                string = tokenizer.itos(pred_token)
-                vel = int(re.search('velocity=(.*)', string).group(1))
-                note.velocity = vel
-                all_notes.append(note) 
+                assert VELOCITY_OFFSET <= pred_token < BEAT_OFFSET
+                pred_onset_notes["velocity"][i] = pred_token - VELOCITY_OFFSET
+                all_indexes.append(i)
                 
             bgn += segment_samples
+
+        all_notes = frame_notes_to_notes(pred_onset_notes[np.array(all_indexes, dtype=np.int64)], fps)
             
         notes_to_midi(all_notes, "_zz.mid")
         # soundfile.write(file="_zz.wav", data=audio, samplerate=16000)
@@ -244,20 +253,11 @@ def load_meta(meta_csv, split):
 
 def parse_midi(midi_path):
 
-    midi_data = pretty_midi.PrettyMIDI(str(midi_path))
-
-    notes = midi_data.instruments[0].notes
-
-    intervals = []
-    pitches = []
-    velocities = []
+    notes, _ = read_midi_notes(midi_path)
 
-    for note in notes:
-        intervals.append([note.start, note.end])
-        pitches.append(note.pitch)
-        velocities.append(note.velocity)
+    intervals = np.stack((notes["start"], notes["end"]), axis=-1)
 
-    return np.array(intervals), np.array(pitches), np.array(velocities)
+    return intervals, notes["pitch"], notes["velocity"]
 
 
 def deduplicate_array(array):
@@ -2,12 +2,14 @@ import os
 import sys
 import math
 import time
+import contextlib
 import numpy as np
 import matplotlib.pyplot as plt
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 from torchlibrosa.stft import Spectrogram, LogmelFilterBank
 from .pytorch_utils import move_data_to_device
@@ -56,6 +58,25 @@ def init_gru(rnn):
         torch.nn.init.constant_(getattr(rnn, 'bias_hh_l{}'.format(i)), 0)
 
 
+@contextlib.contextmanager
+def frozen_batch_norm_stats(module):
+    """
+        Do not update the running statistics of the batch norms of module,
+        e.g. while activation checkpointing recomputes its forward pass.
+    """
+    batch_norms = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    momentums = [bn.momentum for bn in batch_norms]
+
+    for bn in batch_norms:
+        bn.momentum = 0.
+
+    try:
+        yield
+    finally:
+        for bn, momentum in zip(batch_norms, momentums):
+            bn.momentum = momentum
+
+
 class ConvBlock(nn.Module):
     def __init__(self, in_channels, out_channels, momentum):
         
@@ -116,6 +137,9 @@ class AcousticModelCRnn8Dropout(nn.Module):
             bias=True, batch_first=True, dropout=0., bidirectional=True)
 
         self.fc = nn.Linear(512, classes_num, bias=True)
+
+        # Recompute the activations in the backward pass, see CRnn
+        self.activation_checkpointing = False
         
         self.init_weight()
 
@@ -133,6 +157,18 @@ class AcousticModelCRnn8Dropout(nn.Module):
           output: (batch_size, time_steps, classes_num)
         """
 
+        if self.activation_checkpointing and self.training and torch.is_grad_enabled():
+            # The running statistics of the batch norms are only updated
+            # once, not again by the recomputation
+            return checkpoint(
+                self._forward, input, use_reentrant=False,
+                context_fn=lambda: (contextlib.nullcontext(), frozen_batch_norm_stats(self))
+            )
+
+        return self._forward(input)
+
+    def _forward(self, input):
+
         x = self.conv_block1(input, pool_size=(1, 2), pool_type='avg')
         x = F.dropout(x, p=0.2, training=self.training)
         x = self.conv_block2(x, pool_size=(1, 2), pool_type='avg')
@@ -220,8 +256,11 @@ class Regress_onset_offset_frame_velocity_CRNN(nn.Module):
           }
         """
 
-        x = self.spectrogram_extractor(input)   # (batch_size, 1, time_steps, freq_bins)
-        x = self.logmel_extractor(x)    # (batch_size, 1, time_steps, mel_bins)
+        # The log mel front end runs in float32 under autocast, its amin of
+        # 1e-10 underflows in float16
+        with torch.autocast(device_type=input.device.type, enabled=False):
+            x = self.spectrogram_extractor(input.float())   # (batch_size, 1, time_steps, freq_bins)
+            x = self.logmel_extractor(x)    # (batch_size, 1, time_steps, mel_bins)
 
         x = x.transpose(1, 3)
         x = self.bn0(x)
@@ -316,8 +355,11 @@ class Regress_pedal_CRNN(nn.Module):
           }
         """
 
-        x = self.spectrogram_extractor(input)   # (batch_size, 1, time_steps, freq_bins)
-        x = self.logmel_extractor(x)    # (batch_size, 1, time_steps, mel_bins)
+        # The log mel front end runs in float32 under autocast, its amin of
+        # 1e-10 underflows in float16
+        with torch.autocast(device_type=input.device.type, enabled=False):
+            x = self.spectrogram_extractor(input.float())   # (batch_size, 1, time_steps, freq_bins)
+            x = self.logmel_extractor(x)    # (batch_size, 1, time_steps, mel_bins)
 
         x = x.transpose(1, 3)
         x = self.bn0(x)
@@ -337,8 +379,12 @@ class Regress_pedal_CRNN(nn.Module):
 
 # This model is not trained, but is combined from the trained note and pedal models.
 class CRnn(nn.Module):
-    def __init__(self):
+    def __init__(self, activation_checkpointing=False):
         """The combination of note and pedal model.
+
+        Args:
+          activation_checkpointing: bool, recompute the activations of every
+            AcousticModelCRnn8Dropout in the backward pass to save memory
         """
         super(CRnn, self).__init__()
 
@@ -348,6 +394,10 @@ class CRnn(nn.Module):
         self.note_model = Regress_onset_offset_frame_velocity_CRNN(frames_per_second, classes_num)
         self.pedal_model = Regress_pedal_CRNN(frames_per_second, classes_num)
 
+        for module in self.modules():
+            if isinstance(module, AcousticModelCRnn8Dropout):
+                module.activation_checkpointing = activation_checkpointing
+
     def load_state_dict2(self, m, strict=False):
         try:
             self.note_model.load_state_dict(m['note_model'], strict=strict)
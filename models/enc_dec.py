@@ -10,6 +10,7 @@ from typing import List, Optional, Tuple, Union
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
 from typing_extensions import Self
 import numpy as np
 import re
@@ -38,6 +39,8 @@ class EncDecConfig:
     n_head: int = 32
     n_embd: int = 4096
     audio_n_embd: int = 128
+    # Recompute the activations of every Block in the backward pass
+    activation_checkpointing: bool = False
 
     def __post_init__(self):
         if self.padded_vocab_size is None:
@@ -90,8 +93,16 @@ class EncDec(nn.Module):
 
     def forward(
             self, audio_emb, idx: torch.Tensor, target=None, target_mask=None, max_seq_length: Optional[int] = None,
-            input_pos: Optional[torch.Tensor] = None
+            input_pos: Optional[torch.Tensor] = None, segment_ids: Optional[torch.Tensor] = None,
+            cross_index: Optional[torch.Tensor] = None
     ) -> Union[torch.Tensor, Tuple[torch.Tensor, List[KVCache]]]:
+        """
+        segment_ids (B, T) and cross_index (B, S) describe rows packed with
+        several sequences (see data.collate.pack_tokens): positions of a
+        sequence only attend to the earlier positions of the same sequence,
+        restart their RoPE positions at 0 and cross attend to the audio
+        embedding cross_index[b, segment_ids[b, t]] of audio_emb.
+        """
         B, T = idx.size()
 
         audio_h = self.audio_emb_to_emb(audio_emb)
@@ -110,10 +121,14 @@ class EncDec(nn.Module):
             self.mask_cache = self.build_mask_cache(idx)
             # (1, 1, L, L)
 
+        cross_mask = None
+
         if input_pos is not None:
             rope = self.rope_cache.index_select(0, input_pos)
             mask = self.mask_cache.index_select(2, input_pos)
             mask = mask[:, :, :, :max_seq_length]
+        elif segment_ids is not None:
+            rope, mask, cross_mask = build_packed_masks(self.rope_cache, segment_ids, cross_index, audio_emb.shape[1])
         else:
             # T += audio_emb.shape[1]
             rope = self.rope_cache[:T]
@@ -130,7 +145,7 @@ class EncDec(nn.Module):
 
         if input_pos is None:  # proxy for use_cache=False
             for block in self.transformer.h:
-                x, _ = block(x, audio_emb, rope, mask, max_seq_length)
+                x, _ = block(x, audio_emb, rope, mask, max_seq_length, cross_mask=cross_mask, cross_index=cross_index)
         else:
             if not self.kv_caches:
                 head_size = self.config.n_embd // self.config.n_head
@@ -145,12 +160,14 @@ class EncDec(nn.Module):
 
         x = self.transformer.ln_f(x)
 
-        logits = self.lm_head(x)  # (b, t, vocab_size)
-
         if target is not None:
-            target *= target_mask
-            logits = logits[:, -target.shape[1]:, :].contiguous()
-            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), target.view(-1), ignore_index=0)
+            # Only the supervised positions (non zero masked targets) go
+            # through lm_head, in chunks of the vocabulary. No logits are
+            # returned.
+            x = x[:, -target.shape[1]:, :]
+            selected = (target * target_mask) != 0
+            loss = chunked_cross_entropy(x[selected], self.lm_head.weight, target[selected])
+            logits = None
         else:
             logits = self.lm_head(x[:, [-1], :])  # note: using list [-1] to preserve the time dim
             loss = None
@@ -265,8 +282,16 @@ class EncDecPos(nn.Module):
 
     def forward(
             self, audio_emb, idx: torch.Tensor, target=None, target_mask=None, max_seq_length: Optional[int] = None,
-            input_pos: Optional[torch.Tensor] = None
+            input_pos: Optional[torch.Tensor] = None, segment_ids: Optional[torch.Tensor] = None,
+            cross_index: Optional[torch.Tensor] = None
     ) -> Union[torch.Tensor, Tuple[torch.Tensor, List[KVCache]]]:
+        """
+        segment_ids (B, T) and cross_index (B, S) describe rows packed with
+        several sequences (see data.collate.pack_tokens): positions of a
+        sequence only attend to the earlier positions of the same sequence,
+        restart their RoPE positions at 0 and cross attend to the audio
+        embedding cross_index[b, segment_ids[b, t]] of audio_emb.
+        """
         B, T = idx.size()
 
         audio_h = self.audio_emb_to_emb(audio_emb)
@@ -288,10 +313,14 @@ class EncDecPos(nn.Module):
             self.mask_cache = self.build_mask_cache(idx)
             # (1, 1, L, L)
 
+        cross_mask = None
+
         if input_pos is not None:
             rope = self.rope_cache.index_select(0, input_pos)
             mask = self.mask_cache.index_select(2, input_pos)
             mask = mask[:, :, :, :max_seq_length]
+        elif segment_ids is not None:
+            rope, mask, cross_mask = build_packed_masks(self.rope_cache, segment_ids, cross_index, audio_emb.shape[1])
         else:
             # T += audio_emb.shape[1]
             rope = self.rope_cache[:T]
@@ -308,7 +337,7 @@ class EncDecPos(nn.Module):
 
         if input_pos is None:  # proxy for use_cache=False
             for block in self.transformer.h:
-                x, _ = block(x, sum_h, rope, mask, max_seq_length)
+                x, _ = block(x, sum_h, rope, mask, max_seq_length, cross_mask=cross_mask, cross_index=cross_index)
         else:
             if not self.kv_caches:
                 head_size = self.config.n_embd // self.config.n_head
@@ -323,15 +352,14 @@ class EncDecPos(nn.Module):
 
         x = self.transformer.ln_f(x)
 
-        logits = self.lm_head(x)  # (b, t, vocab_size)
-
         if target is not None:
-            target *= target_mask
-            logits = logits[:, -target.shape[1]:, :].contiguous()
-            # tar = target.contiguous().view(-1).clone()
-            # tar = target.view(-1)
-            # loss = F.cross_entropy(logits.view(-1, logits.size(-1)), tar, ignore_index=0)
-            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), target.view(-1), ignore_index=0)
+            # Only the supervised positions (non zero masked targets) go
+            # through lm_head, in chunks of the vocabulary. No logits are
+            # returned.
+            x = x[:, -target.shape[1]:, :]
+            selected = (target * target_mask) != 0
+            loss = chunked_cross_entropy(x[selected], self.lm_head.weight, target[selected])
+            logits = None
         else:
             logits = self.lm_head(x[:, [-1], :])  # note: using list [-1] to preserve the time dim
             loss = None
@@ -522,6 +550,8 @@ class Block(nn.Module):
         self.cross_rms_2 = RMSNorm(config.n_embd)
         self.cross_mlp = MLP(config)
 
+        self.activation_checkpointing = config.activation_checkpointing
+
     def forward(
             self,
             x: torch.Tensor,
@@ -531,12 +561,38 @@ class Block(nn.Module):
             max_seq_length: int,
             input_pos: Optional[torch.Tensor] = None,
             kv_cache: Optional[KVCache] = None,
+            cross_mask: Optional[torch.Tensor] = None,
+            cross_index: Optional[torch.Tensor] = None,
+    ) -> Tuple[torch.Tensor, Optional[KVCache]]:
+        if self.activation_checkpointing and self.training and kv_cache is None and torch.is_grad_enabled():
+            # Only keep the inputs of the block, its activations are
+            # recomputed in the backward pass
+            return checkpoint(
+                self._forward, x, enc_h, rope, mask, max_seq_length, input_pos, kv_cache, cross_mask, cross_index,
+                use_reentrant=False
+            )
+
+        return self._forward(x, enc_h, rope, mask, max_seq_length, input_pos, kv_cache, cross_mask, cross_index)
+
+    def _forward(
+            self,
+            x: torch.Tensor,
+            enc_h,
+            rope: RoPECache,
+            mask: MaskCache,
+            max_seq_length: int,
+            input_pos: Optional[torch.Tensor] = None,
+            kv_cache: Optional[KVCache] = None,
+            cross_mask: Optional[torch.Tensor] = None,
+            cross_index: Optional[torch.Tensor] = None,
     ) -> Tuple[torch.Tensor, Optional[KVCache]]:
         h, new_kv_cache = self.self_attn(self.self_rms_1(x), rope, mask, max_seq_length, input_pos, kv_cache)
         x = x + h
         x = x + self.self_mlp(self.self_rms_2(x))
 
-        h, new_kv_cache = self.cross_attn(self.cross_rms_1(x), enc_h, rope, max_seq_length, input_pos, kv_cache)
+        h, new_kv_cache = self.cross_attn(
+            self.cross_rms_1(x), enc_h, rope, max_seq_length, input_pos, kv_cache, cross_mask, cross_index
+        )
         x = x + h
         x = x + self.cross_mlp(self.cross_rms_2(x))
 
@@ -635,14 +691,23 @@ class CrossAttention(nn.Module):
             max_seq_length: int,
             input_pos: Optional[torch.Tensor] = None,
             kv_cache: Optional[KVCache] = None,
+            cross_mask: Optional[torch.Tensor] = None,
+            cross_index: Optional[torch.Tensor] = None,
     ) -> Tuple[torch.Tensor, Optional[KVCache]]:
         B, T, C = x.size()  # batch size, sequence length, embedding dimensionality (n_embd)
-        enc_T = enc_h.shape[1]
 
         # calculate query, key, values for all heads in batch and move head forward to be the batch dim
         q = self.c_attn(x)
         k, v = self.c_attn2(enc_h).split(self.n_embd, dim=2)
 
+        if cross_index is not None:
+            # Packed rows attend to the concatenated audio of their sequences,
+            # cross_mask routes every sequence to its own audio
+            k = k[cross_index.clamp(min=0)].flatten(1, 2)
+            v = v[cross_index.clamp(min=0)].flatten(1, 2)
+
+        enc_T = k.shape[1]
+
         head_size = C // self.n_head
         k = k.view(B, enc_T, self.n_head, head_size)
         q = q.view(B, T, self.n_head, head_size)
@@ -674,7 +739,7 @@ class CrossAttention(nn.Module):
         #  y = att @ v # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs)
 
         # efficient attention using Flash Attention CUDA kernels
-        y = F.scaled_dot_product_attention(q, k, v, dropout_p=0.0)
+        y = F.scaled_dot_product_attention(q, k, v, attn_mask=cross_mask, dropout_p=0.0)
 
         y = y.transpose(1, 2).contiguous().view(B, T, C)  # re-assemble all head outputs side by side
 
@@ -719,9 +784,72 @@ class RMSNorm(nn.Module):
         # norm_x = x.norm(2, dim=self.dim, keepdim=True)
         # rms_x = norm_x * d_x ** (-1. / 2)
         # x_normed = x / (rms_x + self.eps)
+        # Normalize in at least float32, also under autocast
+        dtype = x.dtype
+        x = x.to(torch.promote_types(dtype, torch.float32))
         norm_x = torch.mean(x * x, dim=self.dim, keepdim=True)
         x_normed = x * torch.rsqrt(norm_x + self.eps)
-        return self.scale * x_normed
+        return (self.scale * x_normed).to(dtype)
+
+
+class ChunkedCrossEntropy(torch.autograd.Function):
+    """Mean cross entropy of the logits x @ weight.T, computed in chunks of the
+    vocabulary so that the (N, vocab_size) logits are never stored. The backward
+    pass recomputes the logits of one chunk at a time. Autocast is disabled
+    inside, so that the loss keeps the precision of its inputs.
+    """
+
+    @staticmethod
+    def forward(ctx, x, weight, target, chunk_size):
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            # Softmax statistics are accumulated in at least float32
+            dtype = torch.promote_types(x.dtype, torch.float32)
+            lse = torch.full((x.shape[0],), float("-inf"), device=x.device, dtype=dtype)
+
+            for bgn in range(0, weight.shape[0], chunk_size):
+                logits = (x @ weight[bgn : bgn + chunk_size].T).to(dtype)
+                lse = torch.logaddexp(lse, torch.logsumexp(logits, dim=-1))
+
+            target_logits = (x * weight[target]).sum(dim=-1).to(dtype)
+
+            ctx.save_for_backward(x, weight, target, lse)
+            ctx.chunk_size = chunk_size
+
+            return (lse - target_logits).mean()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        with torch.autocast(device_type=grad_output.device.type, enabled=False):
+            x, weight, target, lse = ctx.saved_tensors
+            chunk_size = ctx.chunk_size
+            scale = grad_output / x.shape[0]
+
+            grad_x = torch.zeros_like(x)
+            grad_weight = torch.zeros_like(weight)
+            rows = torch.arange(x.shape[0], device=x.device)
+
+            for bgn in range(0, weight.shape[0], chunk_size):
+                w = weight[bgn : bgn + chunk_size]
+
+                # d loss / d logits = softmax - one hot
+                grad_logits = torch.exp((x @ w.T).to(lse.dtype) - lse[:, None])
+                in_chunk = (bgn <= target) & (target < bgn + w.shape[0])
+                grad_logits[rows[in_chunk], target[in_chunk] - bgn] -= 1
+                grad_logits = (grad_logits * scale).to(x.dtype)
+
+                grad_x += grad_logits @ w
+                grad_weight[bgn : bgn + chunk_size] = grad_logits.T @ x
+
+            return grad_x, grad_weight, None, None
+
+
+def chunked_cross_entropy(x: torch.Tensor, weight: torch.Tensor, target: torch.Tensor, chunk_size: int = 1024) -> torch.Tensor:
+    """Mean cross entropy of (N, C) hidden states x through a bias free output
+    layer of (vocab_size, C) weight for (N,) targets, see ChunkedCrossEntropy.
+    Half precision inputs, e.g. from autocast, are computed in float32.
+    """
+    dtype = torch.promote_types(x.dtype, torch.float32)
+    return ChunkedCrossEntropy.apply(x.to(dtype), weight.to(dtype), target, chunk_size)
 
 
 def build_rope_cache(
@@ -751,14 +879,50 @@ def build_rope_cache(
     return cache
 
 
+def build_packed_masks(
+        rope_cache: RoPECache, segment_ids: torch.Tensor, cross_index: torch.Tensor, enc_T: int
+) -> Tuple[RoPECache, MaskCache, torch.Tensor]:
+    """Attention masks and RoPE of rows packed with several sequences.
+
+    segment_ids (B, T) is the slot of the sequence of each position in its row
+    (-1 on padding) and cross_index (B, S) the audio of each slot. Returns the
+    (B, T, n_elem / 2, 2) RoPE, the (B, 1, T, T) block diagonal causal mask and
+    the (B, 1, T, S * enc_T) cross attention mask over the concatenated audio of
+    the slots of a row.
+    """
+    B, T = segment_ids.shape
+    idx = torch.arange(T, device=segment_ids.device)
+
+    # Positions restart at the first token of every sequence
+    is_start = torch.ones_like(segment_ids, dtype=torch.bool)
+    is_start[:, 1:] = segment_ids[:, 1:] != segment_ids[:, :-1]
+    starts = torch.cummax(torch.where(is_start, idx, 0), dim=1).values
+    rope = rope_cache[idx - starts]
+
+    causal = idx[:, None] >= idx[None, :]
+    mask = causal[None, :, :] & (segment_ids[:, :, None] == segment_ids[:, None, :])
+
+    # Padding attends to the first slot so that no query is fully masked
+    slots = torch.arange(cross_index.shape[1], device=segment_ids.device).repeat_interleave(enc_T)
+    cross_mask = segment_ids.clamp(min=0)[:, :, None] == slots[None, None, :]
+
+    return rope, mask.unsqueeze(1), cross_mask.unsqueeze(1)
+
+
 def apply_rope(x: torch.Tensor, rope_cache: RoPECache) -> torch.Tensor:
+    # cast because the reference does
+    xshaped = x.float().reshape(*x.shape[:-1], -1, 2)
+
     # truncate to support variable sizes
     T = x.size(1)
-    rope_cache = rope_cache[:T]
 
-    # cast because the reference does
-    xshaped = x.float().reshape(*x.shape[:-1], -1, 2)
-    rope_cache = rope_cache.view(1, xshaped.size(1), 1, xshaped.size(3), 2)
+    if rope_cache.dim() == 4:
+        # (B, T, n_elem / 2, 2) per row positions of packed rows
+        rope_cache = rope_cache[:, :T]
+        rope_cache = rope_cache.view(rope_cache.size(0), T, 1, xshaped.size(3), 2)
+    else:
+        rope_cache = rope_cache[:T]
+        rope_cache = rope_cache.view(1, T, 1, xshaped.size(3), 2)
     x_out2 = torch.stack(
         [
             xshaped[..., 0] * rope_cache[..., 0] - xshaped[..., 1] * rope_cache[..., 1],
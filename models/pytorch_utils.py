@@ -1,7 +1,13 @@
 import os
+import re
+import queue
+import random
+import threading
 import numpy as np
 import time
 import torch
+import torch.distributed as dist
+from pathlib import Path
 
 def move_data_to_device(x, device):
     """
@@ -92,3 +98,432 @@ def pad_truncate_sequence(x, max_len):
         return np.concatenate((x, np.zeros(max_len - len(x))))
     else:
         return x[0 : max_len]
+
+
+PRECISIONS = {
+    "float32": torch.float32,
+    "bfloat16": torch.bfloat16,
+    "float16": torch.float16,
+}
+
+
+def autocast(device, precision):
+    """
+        Mixed precision context for the forward passes. RMSNorm, the log
+        mel front end of CRnn and the loss stay in float32 inside it.
+
+        Args:
+        -----
+            device (str): typical cuda or cpu
+            precision (str): "float32" (no autocast), "bfloat16" or "float16"
+
+        Returns:
+        --------
+            context (torch.autocast)
+    """
+    return torch.autocast(
+        device_type=torch.device(device).type,
+        dtype=PRECISIONS[precision],
+        enabled=precision != "float32"
+    )
+
+
+def to_cpu(x):
+    """
+        Copy the tensors of a (nested) state dict to cpu, so that the copy
+        is not changed by later training steps
+
+        Args:
+        -----
+            x (dict | list | tuple | torch.Tensor | object)
+
+        Returns:
+        --------
+            x: same structure with copied cpu tensors
+    """
+    if isinstance(x, torch.Tensor):
+        return x.detach().to("cpu", copy=True)
+    elif isinstance(x, dict):
+        return {key: to_cpu(value) for key, value in x.items()}
+    elif isinstance(x, (list, tuple)):
+        return type(x)(to_cpu(value) for value in x)
+    else:
+        return x
+
+
+def get_rng_state():
+    """
+        States of the python, numpy and torch random number generators
+    """
+    return {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+    }
+
+
+def set_rng_state(state):
+    """
+        Restore the states returned by get_rng_state
+    """
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+
+    if state["cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def load_model_states(checkpoint_path, map_location="cpu"):
+    """
+        Decoder and encoder state dicts of a checkpoint, saved either by
+        CheckpointManager ({"model": ..., "encoder": ...}) or by earlier
+        training code (the decoder state dict at step=N.pth and the
+        encoder one at step=N_encoder.pth).
+
+        Args:
+        -----
+            checkpoint_path (str): e.g. ".../step=60000.pth"
+            map_location (str): typical cuda or cpu
+
+        Returns:
+        --------
+            model (dict): decoder state dict
+            encoder (dict | None): encoder state dict, None if the decoder
+                was trained on the frozen pretrained encoder
+    """
+    checkpoint = torch.load(checkpoint_path, map_location=map_location, weights_only=False)
+
+    if "model" in checkpoint:
+        return checkpoint["model"], checkpoint["encoder"]
+
+    encoder_path = Path(checkpoint_path).with_name("{}_encoder.pth".format(Path(checkpoint_path).stem))
+
+    return checkpoint, torch.load(encoder_path, map_location=map_location, weights_only=False)
+
+
+class StepTimer:
+    def __init__(self, device, synchronize=False):
+        """
+            Wall time of the phases of training steps, e.g. waiting for
+            data, copies to the device, forward, backward and optimizer,
+            and throughput counts of the steps.
+
+            Args:
+            -----
+                device (str): typical cuda or cpu
+                synchronize (bool): synchronize cuda at the end of every
+                    phase, so that its kernels are timed in the phase that
+                    launched them. Costs some throughput. Otherwise phase
+                    times are launch times, and the wait for the kernels
+                    falls in the first phase that blocks on them
+        """
+        self.synchronize = synchronize and torch.device(device).type == "cuda"
+        self.last = None
+        self.reset()
+
+    def reset(self):
+
+        self.times = {}
+        self.counts = {}
+        self.steps_num = 0
+
+    def start(self):
+        """
+            Start the first phase
+        """
+        self.last = time.perf_counter()
+
+    def mark(self, phase):
+        """
+            End phase, which started at the previous mark
+        """
+        if self.synchronize:
+            torch.cuda.synchronize()
+
+        now = time.perf_counter()
+        self.times[phase] = self.times.get(phase, 0.) + now - self.last
+        self.last = now
+
+    def step(self, **counts):
+        """
+            End a step, with its counts, e.g. step(samples=4, tokens=1000)
+        """
+        self.steps_num += 1
+
+        for key, value in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + value
+
+    def summary(self):
+        """
+            Statistics of the steps since the last summary
+
+            Returns:
+            --------
+                stats (dict): {"time/<phase> ms": mean time of a step,
+                    "time/step ms": mean time of a step,
+                    "<count>/s": counts per second}
+        """
+        seconds = sum(self.times.values())
+        steps_num = max(self.steps_num, 1)
+
+        stats = {"time/{} ms".format(phase): 1e3 * t / steps_num for phase, t in self.times.items()}
+        stats["time/step ms"] = 1e3 * seconds / steps_num
+
+        for key, value in self.counts.items():
+            stats["{}/s".format(key)] = value / max(seconds, 1e-9)
+
+        self.reset()
+
+        return stats
+
+
+def gather_rng_states():
+    """
+        States of the random number generators of every rank, gathered on
+        rank 0. Called by all ranks.
+
+        Returns:
+        --------
+            states (list | None): get_rng_state() of every rank on rank 0,
+                None on the other ranks
+    """
+    state = get_rng_state()
+
+    if not dist.is_initialized():
+        return [state]
+
+    states = [None] * dist.get_world_size() if dist.get_rank() == 0 else None
+    dist.gather_object(state, states, dst=0)
+
+    return states
+
+
+def set_rank_rng_state(states, rank):
+    """
+        Restore the state of rank from the states of gather_rng_states.
+        Checkpoints holding a single state (dict) only restore rank 0.
+    """
+    if isinstance(states, dict):
+        states = [states]
+
+    if rank < len(states):
+        set_rng_state(states[rank])
+    else:
+        print("No random state of rank {} in the checkpoint".format(rank))
+
+
+class CheckpointManager:
+    def __init__(self, checkpoints_dir, keep_num=5):
+        """
+            Write training checkpoints "step={step}.pth" in a background
+            thread, hard link the newest one to "latest.pth" and only
+            keep the last keep_num of them.
+
+            Args:
+            -----
+                checkpoints_dir (str): directory of the checkpoints
+                keep_num (int): number of checkpoints to keep
+        """
+        self.checkpoints_dir = Path(checkpoints_dir)
+        self.keep_num = keep_num
+
+        self.checkpoints_dir.mkdir(parents=True, exist_ok=True)
+
+        # Checkpoints of earlier runs count towards keep_num
+        self.paths = sorted(
+            [path for path in self.checkpoints_dir.glob("step=*.pth") if re.fullmatch(r"step=\d+\.pth", path.name)],
+            key=lambda path: int(path.stem.split("=")[1])
+        )
+
+        self.thread = None
+        self.error = None
+
+    def save(self, step, state):
+        """
+            Copy state to cpu and write it in the background. Waits for
+            the previous write, if it is still running.
+
+            Args:
+            -----
+                step (int): training step
+                state (dict): e.g. {"model": ..., "optimizer": ...}
+        """
+        self.wait()
+
+        state = to_cpu(state)
+        state["step"] = step
+
+        self.thread = threading.Thread(target=self._write, args=(step, state), daemon=True)
+        self.thread.start()
+
+    def _write(self, step, state):
+
+        try:
+            path = Path(self.checkpoints_dir, "step={}.pth".format(step))
+            tmp_path = Path(str(path) + ".tmp")
+            torch.save(state, tmp_path)
+            os.replace(tmp_path, path)
+
+            latest_path = Path(self.checkpoints_dir, "latest.pth")
+            tmp_path = Path(str(latest_path) + ".tmp")
+            if tmp_path.exists():
+                os.remove(tmp_path)
+            os.link(path, tmp_path)
+            os.replace(tmp_path, latest_path)
+
+            if path not in self.paths:
+                self.paths.append(path)
+
+            while len(self.paths) > self.keep_num:
+                os.remove(self.paths.pop(0))
+
+            print("Save checkpoint to {}".format(path))
+
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        """
+            Wait for the running write and raise its error, if any
+        """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def load_latest(self, map_location=None):
+        """
+            Returns:
+            --------
+                state (dict): the state of the newest checkpoint
+        """
+        return torch.load(Path(self.checkpoints_dir, "latest.pth"), map_location=map_location, weights_only=False)
+
+
+class AsyncEvaluator:
+    def __init__(self, evaluate, models, device="cpu"):
+        """
+            Evaluate snapshots of the weights of models in a background
+            process, while training continues. The process builds the
+            models once, and loads the weights of every snapshot into
+            them before calling evaluate.
+
+            Args:
+            -----
+                evaluate (callable): evaluate(models, device) returning the
+                    results of a snapshot, e.g. a dict of losses. Picklable,
+                    i.e. a module level function or a functools.partial of one
+                models (dict): {name: picklable constructor of the model}
+                device (str): device of the evaluation, typical cuda or cpu
+        """
+        context = torch.multiprocessing.get_context("spawn")
+
+        # A single pending snapshot, see submit
+        self.snapshots = context.Queue(maxsize=1)
+        self.results_queue = context.Queue()
+
+        self.process = context.Process(
+            target=_evaluate_snapshots,
+            args=(evaluate, models, device, self.snapshots, self.results_queue),
+            daemon=True
+        )
+        self.process.start()
+
+    def submit(self, step, states):
+        """
+            Send a cpu snapshot of states to the evaluator. The snapshot is
+            dropped if the evaluator has not started on the previous one.
+
+            Args:
+            -----
+                step (int): training step of the snapshot
+                states (dict): {name: state dict} of the models
+
+            Returns:
+            --------
+                submitted (bool)
+        """
+        if self.snapshots.full():
+            print("Evaluator busy, skip the snapshot of step {}".format(step))
+            return False
+
+        self.snapshots.put((step, to_cpu(states)))
+
+        return True
+
+    def results(self):
+        """
+            Returns:
+            --------
+                results (list): (step, results) of the evaluated snapshots
+                    since the last call
+        """
+        results = []
+
+        while True:
+            try:
+                results.append(self.results_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        self.check_alive()
+
+        return results
+
+    def check_alive(self):
+
+        if not self.process.is_alive():
+            raise RuntimeError("Evaluator exited with code {}".format(self.process.exitcode))
+
+    def close(self):
+        """
+            Wait for the submitted snapshots and stop the evaluator
+
+            Returns:
+            --------
+                results (list): (step, results) not returned by results yet
+        """
+        self.snapshots.put(None)
+        results = []
+
+        while True:
+            try:
+                item = self.results_queue.get(timeout=10)
+            except queue.Empty:
+                self.check_alive()
+                continue
+
+            if item is None:
+                break
+
+            results.append(item)
+
+        self.process.join()
+
+        return results
+
+
+def _evaluate_snapshots(evaluate, models, device, snapshots, results):
+
+    models = {name: build().to(device) for name, build in models.items()}
+
+    while True:
+
+        item = snapshots.get()
+
+        if item is None:
+            # End of the results, see AsyncEvaluator.close
+            results.put(None)
+            break
+
+        step, states = item
+
+        for name, model in models.items():
+            model.load_state_dict(states[name])
+
+        results.put((step, evaluate(models, device)))
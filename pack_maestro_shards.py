@@ -0,0 +1,80 @@
+import random
+import numpy as np
+from pathlib import Path
+from tqdm import tqdm
+import argparse
+
+from data.maestro import MaestroMultiTask
+from data.shards import ShardWriter
+from data.tokenizers import Tokenizer
+
+
+def pack_shards(args):
+
+    # Arguments
+    hop_seconds = args.hop_seconds
+    split = args.split
+
+    # Default parameters
+    segment_seconds = 10.
+    max_token_len = 1536
+    tasks = ["onset", "velocity", "offset"]
+    segments_per_shard = 512
+    # Number of segments decoded at once from a file
+    segments_per_read = 16
+
+    root = "/home/nkcemeka/Documents/Datasets/maestro-v3.0.0"
+    shards_dir = Path("./shards", "maestro_{}".format(split))
+
+    # Segments and targets are made exactly as for training
+    dataset = MaestroMultiTask(
+        root=root,
+        split=split,
+        segment_seconds=segment_seconds,
+        tokenizer=Tokenizer(),
+        max_token_len=max_token_len,
+        task=tasks,
+        fields=["audio", "segment_start_time", "token", "mask"],
+        dynamic_padding=True
+    )
+
+    writer = ShardWriter(
+        shards_dir=shards_dir,
+        tasks=tasks,
+        sample_rate=dataset.sample_rate,
+        segment_seconds=segment_seconds,
+        segments_per_shard=segments_per_shard
+    )
+
+    # Files in random order, so that consecutive shards mix pieces
+    indexes = list(range(len(dataset)))
+    random.Random(1234).shuffle(indexes)
+
+    for index in tqdm(indexes):
+
+        segment_start_times = np.arange(0, dataset.durations[index], hop_seconds).tolist()
+
+        for bgn in range(0, len(segment_start_times), segments_per_read):
+
+            items = dataset.load_segments(index, segment_start_times[bgn : bgn + segments_per_read])
+
+            for data in items:
+                writer.write(
+                    audio=data["audio"],
+                    tokens=data["token"],
+                    masks=data["mask"],
+                    file_index=index,
+                    segment_start_time=data["segment_start_time"]
+                )
+
+    writer.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--split', type=str, default="train")
+    parser.add_argument('--hop_seconds', type=float, default=5.)
+    args = parser.parse_args()
+
+    pack_shards(args)
@@ -0,0 +1,602 @@
+import torch
+import numpy as np
+from pathlib import Path
+import torch.optim as optim
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
+from data.maestro import MaestroMultiTask, load_note_densities
+from data.samplers import BucketBatchSampler
+from data.shards import MaestroShards, ShardSegments, draw_segments, write_segments, load_segments_config
+from data.collate import collate_fn
+from models.crnn import CRnn
+from models.pytorch_utils import autocast, AsyncEvaluator, CheckpointManager, StepTimer, gather_rng_states, set_rank_rng_state
+from tqdm import tqdm
+import argparse
+import wandb
+import os
+import json
+from functools import partial
+
+from data.tokenizers import Tokenizer
+from models.enc_dec import EncDecConfig, EncDecPos
+
+
+def train(args):
+
+    # Arguments
+    resume = args.resume
+
+    # Default parameters
+    device = "cuda" 
+    batch_size = 4
+    num_workers = 32
+    evaluate_step_frequency = 1000
+    save_step_frequency = 10000
+    # Number of most recent checkpoints to keep
+    keep_checkpoints_num = 5
+    training_steps = 300000
+    filename = Path(__file__).stem
+    segment_seconds = 10.
+    lr = 1e-4
+    max_token_len = 1536
+    # All tasks are trained by one decoder, prompted by their task tokens,
+    # on the same segments and the same encoder forward
+    tasks = ["onset", "velocity", "offset"]
+    wandb_log = True
+    # Pack the token sequences of a batch into as few rows as possible
+    packing = True
+    # Train the decoder only, on encoder embeddings cached by
+    # cache_crnn_embeddings.py instead of audio
+    frozen_encoder = False
+    emb_dir = Path("./embeddings", "CRnn_Note_pedal")
+    # "float32", "bfloat16" or "float16" (with loss scaling) autocast
+    precision = "float32"
+    # Recompute activations of the decoder blocks and the CRnn acoustic
+    # models in the backward pass, to fit larger batches in memory
+    activation_checkpointing = False
+    # Distributed data parallel training when launched with torchrun, e.g.
+    # torchrun --nproc_per_node=4 train_llama_mt_crnn.py. With device = "cpu"
+    # the processes communicate over gloo
+    distributed = "WORLD_SIZE" in os.environ
+    # Seed of the samplers, shared by all ranks
+    seed = 1234
+    # Number of segments read at once from a file (one decode, resample
+    # and MIDI parse), drawn in windows of segments_window_seconds
+    segments_per_file = 1
+    segments_window_seconds = 40.
+    # Stream the training segments from the shards written by
+    # pack_maestro_shards.py instead of reading the audio files
+    shards_dir = None
+    # Number of fixed validation segments of each split, written to
+    # ./shards/<filename> and rewritten when the settings of eval_config
+    # change. Delete them to redraw after changing the data
+    eval_segments_num = 5 * batch_size
+    # Evaluate snapshots of the weights in a background process on
+    # async_validate_device, while training continues
+    async_validate = False
+    async_validate_device = "cpu"
+    # Log the phase times and throughput of the steps every
+    # log_step_frequency steps, to wandb and metrics.jsonl of the
+    # checkpoints directory
+    log_step_frequency = 100
+    # Synchronize cuda at the end of every phase, for exact phase times at
+    # a cost in throughput. Off, cuda phases are timed by their kernel
+    # launches, and the wait for the kernels falls in a later phase
+    synchronize_timing = False
+
+    model_name = "AudioLlama"
+    checkpoints_dir = Path("./checkpoints", filename, model_name)
+    
+    root = "/home/nkcemeka/Documents/Datasets/maestro-v3.0.0"
+
+    if distributed:
+        dist.init_process_group(backend="nccl" if device == "cuda" else "gloo")
+        rank = dist.get_rank()
+        world_size = dist.get_world_size()
+        if device == "cuda":
+            device = "cuda:{}".format(os.environ["LOCAL_RANK"])
+            torch.cuda.set_device(device)
+    else:
+        rank = 0
+        world_size = 1
+
+    # Only rank 0 logs to wandb and saves checkpoints
+    wandb_log = wandb_log and rank == 0
+
+    if wandb_log:
+        wandb.init(
+            project="mini_piano_transcription",
+            name=filename
+        )
+
+    tokenizer = Tokenizer()
+
+    if frozen_encoder:
+        fields = ["onoffvel_emb_h", "token", "mask"]
+    else:
+        fields = ["audio", "token", "mask"]
+    
+    # Dataset
+    train_dataset = MaestroMultiTask(
+        root=root,
+        split="train",
+        segment_seconds=segment_seconds,
+        tokenizer=tokenizer,
+        max_token_len=max_token_len,
+        task=tasks,
+        fields=fields,
+        emb_dir=emb_dir,
+        dynamic_padding=True
+    )
+
+    test_dataset = MaestroMultiTask(
+        root=root,
+        split="test",
+        segment_seconds=segment_seconds,
+        tokenizer=tokenizer,
+        max_token_len=max_token_len,
+        task=tasks,
+        fields=fields,
+        emb_dir=emb_dir,
+        dynamic_padding=True
+    )
+
+    # Sampler. Batches group files of similar note density, so that they
+    # are padded to similar token lengths
+    note_densities = load_note_densities(
+        root=root, 
+        midi_filenames=train_dataset.midi_filenames, 
+        durations=train_dataset.durations, 
+        cache_path=Path("./cache", "maestro_train_note_densities.npz")
+    )
+    train_sampler = BucketBatchSampler(
+        lengths=note_densities, 
+        batch_size=batch_size, 
+        rank=rank, 
+        world_size=world_size, 
+        seed=seed, 
+        durations=train_dataset.durations, 
+        segments_per_file=segments_per_file, 
+        window_seconds=segments_window_seconds
+    )
+
+    # Fixed validation segments, read from memory-mapped shards
+    eval_dirs = {}
+    eval_config = {
+        "fields": fields, 
+        "seed": seed, 
+        "segments_num": eval_segments_num, 
+        "max_token_len": max_token_len
+    }
+
+    for split, dataset in [("train", train_dataset), ("test", test_dataset)]:
+        eval_dirs[split] = Path("./shards", filename, "eval_{}".format(split))
+        if rank == 0 and load_segments_config(eval_dirs[split]) != eval_config:
+            # Not written yet, or by a run with other settings
+            segments = draw_segments(dataset.durations, eval_segments_num, seed)
+            write_segments(dataset, segments, eval_dirs[split], config=eval_config)
+
+    if distributed:
+        # Wait for rank 0 to write them
+        dist.barrier()
+
+    # Dataloader
+    if shards_dir is None:
+        train_dataloader = torch.utils.data.DataLoader(
+            dataset=train_dataset, 
+            batch_sampler=train_sampler,
+            collate_fn=partial(collate_fn, pack_len=max_token_len) if packing else collate_fn,
+            num_workers=num_workers, 
+            pin_memory=True
+        )
+    else:
+        assert not frozen_encoder, "Shards hold audio"
+        train_stream = MaestroShards(
+            shards_dir=shards_dir, 
+            task=tasks, 
+            max_token_len=max_token_len, 
+            fields=fields, 
+            rank=rank, 
+            world_size=world_size, 
+            seed=seed
+        )
+        train_dataloader = torch.utils.data.DataLoader(
+            dataset=train_stream, 
+            batch_size=batch_size,
+            collate_fn=partial(collate_fn, pack_len=max_token_len) if packing else collate_fn,
+            num_workers=num_workers, 
+            pin_memory=True
+        )
+
+    # Every rank evaluates its part of the segments
+    eval_train_dataloader = torch.utils.data.DataLoader(
+        dataset=ShardSegments(eval_dirs["train"], task=tasks, max_token_len=max_token_len, fields=fields), 
+        batch_size=batch_size, 
+        sampler=range(rank, eval_segments_num, world_size),
+        collate_fn=collate_fn,
+        num_workers=0, 
+        pin_memory=True
+    )
+
+    eval_test_dataloader = torch.utils.data.DataLoader(
+        dataset=ShardSegments(eval_dirs["test"], task=tasks, max_token_len=max_token_len, fields=fields), 
+        batch_size=batch_size, 
+        sampler=range(rank, eval_segments_num, world_size),
+        collate_fn=collate_fn,
+        num_workers=0, 
+        pin_memory=True
+    )
+
+    # Load checkpoint
+    if frozen_encoder:
+        enc_model = None
+    else:
+        enc_model_name = "CRnn"
+        checkpoint_path = Path("Note_pedal.pth")
+        enc_model = get_model(enc_model_name, activation_checkpointing=activation_checkpointing)
+        enc_model.load_state_dict2(torch.load(checkpoint_path)["model"])
+        enc_model.to(device)
+
+    config = EncDecConfig(
+        block_size=max_token_len + 1, 
+        vocab_size=tokenizer.vocab_size, 
+        padded_vocab_size=tokenizer.vocab_size, 
+        n_layer=6, 
+        n_head=16, 
+        n_embd=1024, 
+        audio_n_embd=1536,
+        activation_checkpointing=activation_checkpointing
+    )
+
+    model = EncDecPos(config)
+    model.to(device)
+
+    # Checkpoints are saved from the unwrapped models
+    raw_enc_model = enc_model
+    raw_model = model
+
+    if distributed:
+        device_ids = [torch.cuda.current_device()] if device.startswith("cuda") else None
+        model = DDP(model, device_ids=device_ids)
+        if enc_model is not None:
+            # Parts of CRnn, e.g. the pedal model, are not in the loss
+            enc_model = DDP(enc_model, device_ids=device_ids, find_unused_parameters=True)
+
+    task_ids = {task: tokenizer.stoi("task={}".format(task)) for task in tasks}
+
+    # Optimizer
+    if frozen_encoder:
+        params = list(model.parameters())
+    else:
+        params = list(enc_model.parameters()) + list(model.parameters())
+    optimizer = optim.AdamW(params, lr=lr)
+    scaler = torch.amp.GradScaler(torch.device(device).type, enabled=precision == "float16")
+
+    # Checkpoints are written in the background
+    checkpoint_manager = CheckpointManager(checkpoints_dir, keep_num=keep_checkpoints_num)
+
+    if async_validate and rank == 0:
+        models = {"model": partial(EncDecPos, config)}
+        if raw_enc_model is not None:
+            models["encoder"] = partial(get_model, enc_model_name)
+        evaluator = AsyncEvaluator(
+            evaluate=partial(
+                evaluate_snapshot, 
+                eval_dirs=eval_dirs, 
+                task=tasks, 
+                fields=fields, 
+                max_token_len=max_token_len, 
+                batch_size=batch_size, 
+                precision=precision, 
+                task_ids=task_ids
+            ), 
+            models=models, 
+            device=async_validate_device
+        )
+    else:
+        evaluator = None
+
+    start_step = 0
+
+    if resume:
+        checkpoint = checkpoint_manager.load_latest(map_location="cpu")
+        raw_model.load_state_dict(checkpoint["model"])
+        if raw_enc_model is not None:
+            raw_enc_model.load_state_dict(checkpoint["encoder"])
+        optimizer.load_state_dict(checkpoint["optimizer"])
+        scaler.load_state_dict(checkpoint["scaler"])
+        # Every rank continues from its own random state
+        set_rank_rng_state(checkpoint["rng"], rank)
+
+        # Continue with the batch after the saved step
+        start_step = checkpoint["step"] + 1
+        if shards_dir is None:
+            train_sampler.resume(start_step)
+        else:
+            train_stream.resume(start_step)
+        print("Resume from step {}".format(checkpoint["step"]))
+
+    # Count the padded positions of the batches
+    real_tokens_num = 0
+    padded_tokens_num = 0
+
+    # Phase times and throughput of the steps
+    timer = StepTimer(device, synchronize=synchronize_timing)
+    metrics_path = Path(checkpoints_dir, "metrics.jsonl")
+
+    # Train
+    timer.start()
+
+    for step, data in enumerate(tqdm(train_dataloader, disable=rank != 0), start=start_step):
+
+        # Time blocked on the dataloader
+        timer.mark("data")
+
+        # Batches are collated as int32 in pinned memory, see collate_fn
+        token = data["token"].to(device, non_blocking=True).long()
+        input_token = token[:, 0 : -1]
+        target_token = token[:, 1 :]
+        target_mask = data["mask"].to(device, non_blocking=True).long()[:, 1 :]
+
+        if packing:
+            segment_ids = data["segment_id"].to(device, non_blocking=True).long()[:, 0 : -1]
+            cross_index = data["cross_index"].to(device, non_blocking=True).long()
+        else:
+            segment_ids = None
+            cross_index = None
+
+        real_tokens = (data["token"] != tokenizer.stoi("<pad>")).sum().item()
+        real_tokens_num += real_tokens
+        padded_tokens_num += data["token"].numel()
+
+        if frozen_encoder:
+            audio_emb = data["onoffvel_emb_h"].to(device, non_blocking=True).float()
+        else:
+            audio = data["audio"].to(device, non_blocking=True)
+
+        timer.mark("copy")
+
+        optimizer.zero_grad()
+
+        with autocast(device, precision):
+            model.train()
+            if not frozen_encoder:
+                enc_model.train()
+                audio_emb = enc_model(audio)["onoffvel_emb_h"]
+
+            timer.mark("encoder")
+
+            if not packing:
+                # One row per task, each with the embedding of its segment
+                audio_emb = audio_emb[data["audio_index"].to(device, non_blocking=True).long()]
+
+            logits, loss = model(
+                audio_emb=audio_emb, 
+                idx=input_token, 
+                target=target_token, 
+                target_mask=target_mask, 
+                segment_ids=segment_ids, 
+                cross_index=cross_index
+            )
+
+        timer.mark("decoder")
+
+        scaler.scale(loss).backward()
+
+        timer.mark("backward")
+
+        scaler.step(optimizer)
+        scaler.update()
+
+        timer.mark("optimizer")
+        timer.step(
+            samples=len(data["onoffvel_emb_h"] if frozen_encoder else data["audio"]), 
+            tokens=real_tokens, 
+            padded_tokens=data["token"].numel()
+        )
+
+        if step % log_step_frequency == 0:
+            stats = timer.summary()
+            stats["step"] = step
+
+            if rank == 0:
+                with open(metrics_path, "a") as f:
+                    f.write(json.dumps(stats) + "\n")
+
+            if wandb_log:
+                wandb.log(stats)
+
+        if step % evaluate_step_frequency == 0:
+            padding_waste = 1. - real_tokens_num / max(padded_tokens_num, 1)
+            real_tokens_num = 0
+            padded_tokens_num = 0
+            print("Padding waste: {:.3f}".format(padding_waste))
+
+            if wandb_log:
+                wandb.log({"padding waste": padding_waste, "step": step})
+
+            if not async_validate:
+                print("Evaluating ...")
+                losses = {
+                    "train": validate(raw_enc_model, raw_model, eval_train_dataloader, task_ids, precision=precision),
+                    "test": validate(raw_enc_model, raw_model, eval_test_dataloader, task_ids, precision=precision),
+                }
+                log_losses(step, losses, wandb_log, tasks)
+            elif evaluator is not None:
+                # Logged with their step once evaluated, see below
+                evaluator.submit(step, {
+                    "model": raw_model.state_dict(),
+                    "encoder": raw_enc_model.state_dict() if raw_enc_model is not None else None,
+                })
+
+        if evaluator is not None:
+            for eval_step, losses in evaluator.results():
+                log_losses(eval_step, losses, wandb_log, tasks)
+        
+
+        # Save checkpoint
+        if step % save_step_frequency == 0:
+            # Gathered from all ranks, see gather_rng_states
+            rng_states = gather_rng_states()
+
+            if rank == 0:
+                checkpoint_manager.save(step, {
+                    "model": raw_model.state_dict(),
+                    "encoder": raw_enc_model.state_dict() if raw_enc_model is not None else None,
+                    "optimizer": optimizer.state_dict(),
+                    "scaler": scaler.state_dict(),
+                    "rng": rng_states,
+                })
+
+        # Evaluation and checkpoints
+        timer.mark("other")
+
+        if step == training_steps:
+            break
+
+    checkpoint_manager.wait()
+
+    if evaluator is not None:
+        for eval_step, losses in evaluator.close():
+            log_losses(eval_step, losses, wandb_log, tasks)
+
+    if distributed:
+        dist.destroy_process_group()
+
+
+def get_model(model_name, **kwargs):
+    if model_name == "CRnn":
+        return CRnn(**kwargs)
+    else:
+        raise NotImplementedError
+
+
+def log_losses(step, losses, wandb_log, tasks):
+    """
+        Args:
+            losses (dict): {split: {task: loss}}
+    """
+    train_loss = np.mean(list(losses["train"].values()))
+    test_loss = np.mean(list(losses["test"].values()))
+
+    print("--- step: {} ---".format(step))
+    print("Train loss: {:.4f}".format(train_loss))
+    print("Test loss: {:.4f}".format(test_loss))
+    for task in tasks:
+        print("{} train loss: {:.4f}, test loss: {:.4f}".format(task, losses["train"][task], losses["test"][task]))
+
+    if wandb_log:
+        log_dict = {
+            "train loss": train_loss,
+            "test loss": test_loss,
+            "step": step
+        }
+        for task in tasks:
+            log_dict["{} train loss".format(task)] = losses["train"][task]
+            log_dict["{} test loss".format(task)] = losses["test"][task]
+        wandb.log(log_dict)
+
+
+def evaluate_snapshot(models, device, eval_dirs, task, fields, max_token_len, batch_size, precision, task_ids):
+    """
+        Losses of a weight snapshot on the fixed validation segments, run
+        by the AsyncEvaluator process.
+
+        Args:
+            models (dict): {"model": ..., "encoder": ...} on device
+            eval_dirs (dict): {split: directory of the segments}
+
+        Returns:
+            losses (dict): {split: {task: loss}}
+    """
+    losses = {}
+
+    for split, eval_dir in eval_dirs.items():
+        dataloader = torch.utils.data.DataLoader(
+            dataset=ShardSegments(eval_dir, task=task, max_token_len=max_token_len, fields=fields), 
+            batch_size=batch_size, 
+            collate_fn=collate_fn
+        )
+        losses[split] = validate(models.get("encoder"), models["model"], dataloader, task_ids, precision=precision)
+
+    return losses
+
+
+def validate(enc_model, model, dataloader, task_ids, precision="float32"):
+    """
+        Loss of every task, on the rows prompted by its task token.
+
+        Args:
+            task_ids (dict): {task: token of "task=<task>"}
+            precision (str): autocast precision, see autocast
+
+        Returns:
+            losses (dict): {task: loss}
+    """
+
+    device = next(model.parameters()).device
+
+    # Sum of the token losses and number of supervised tokens of every task
+    loss_sums = {task: 0. for task in task_ids}
+    tokens_nums = {task: 0 for task in task_ids}
+
+    for step, data in tqdm(enumerate(dataloader)):
+
+        token = data["token"].to(device, non_blocking=True).long()
+        input_token = token[:, 0 : -1]
+        target_token = token[:, 1 :]
+        target_mask = data["mask"].to(device, non_blocking=True).long()[:, 1 :]
+
+        with torch.no_grad(), autocast(device, precision):
+            if "onoffvel_emb_h" in data:
+                audio_emb = data["onoffvel_emb_h"].to(device, non_blocking=True).float()
+            else:
+                enc_model.eval()
+                audio_emb = enc_model(data["audio"].to(device, non_blocking=True))["onoffvel_emb_h"]
+
+            audio_emb = audio_emb[data["audio_index"].to(device, non_blocking=True).long()]
+
+        for task, task_id in task_ids.items():
+
+            rows = input_token[:, 1] == task_id
+
+            if not rows.any():
+                continue
+
+            with torch.no_grad(), autocast(device, precision):
+                model.eval()
+                logits, loss = model(
+                    audio_emb=audio_emb[rows], 
+                    idx=input_token[rows], 
+                    target=target_token[rows], 
+                    target_mask=target_mask[rows]
+                )
+
+            # The loss is a mean over the supervised tokens of the rows
+            n = ((target_token[rows] * target_mask[rows]) != 0).sum().item()
+            loss_sums[task] += loss.item() * n
+            tokens_nums[task] += n
+
+    if dist.is_initialized():
+        # Ranks may hold different numbers of tokens, or none
+        totals = torch.tensor([[loss_sums[task], tokens_nums[task]] for task in task_ids], dtype=torch.float64, device=device)
+        dist.all_reduce(totals)
+        loss_sums = {task: total[0].item() for task, total in zip(task_ids, totals)}
+        tokens_nums = {task: total[1].item() for task, total in zip(task_ids, totals)}
+
+    losses = {
+        task: loss_sums[task] / tokens_nums[task] if tokens_nums[task] > 0 else float("nan")
+        for task in task_ids
+    }
+
+    return losses
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resume', action='store_true', default=False)
+    args = parser.parse_args()
+
+    train(args)
+
@@ -8,15 +8,22 @@ import soundfile
 import matplotlib.pyplot as plt
 from pathlib import Path
 import torch.optim as optim
-from data.maestro import MaestroMultiTask
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
+from data.maestro import MaestroMultiTask, load_note_densities
+from data.samplers import BucketBatchSampler
+from data.shards import MaestroShards, ShardSegments, draw_segments, write_segments, load_segments_config
 from data.collate import collate_fn
 from data.io import events_to_notes
 from models.crnn import CRnn
+from models.pytorch_utils import autocast, AsyncEvaluator, CheckpointManager, StepTimer, gather_rng_states, set_rank_rng_state
 from tqdm import tqdm
 import museval
 import argparse
 import wandb
 import os
+import json
+from functools import partial
 
 from data.tokenizers import Tokenizer
 from models.enc_dec import EncDecConfig, EncDecPos
@@ -26,6 +33,7 @@ def train(args):
 
     # Arguments
     # model_name = args.model_name
+    resume = args.resume
 
     # Default parameters
     device = "cuda"
@@ -34,6 +42,8 @@ def train(args):
     num_workers = 32
     evaluate_step_frequency = 1000
     save_step_frequency = 10000
+    # Number of most recent checkpoints to keep
+    keep_checkpoints_num = 5
     training_steps = 300000
     #training_steps = 68000
     debug = False
@@ -43,12 +53,66 @@ def train(args):
     frames_num = 1001
     max_token_len = 1536
     wandb_log = True
+    # Pack the token sequences of a batch into as few rows as possible
+    packing = True
+    # Train the decoder only, on encoder embeddings cached by
+    # cache_crnn_embeddings.py instead of audio
+    frozen_encoder = False
+    emb_dir = Path("./embeddings", "CRnn_Note_pedal")
+    # "float32", "bfloat16" or "float16" (with loss scaling) autocast
+    precision = "float32"
+    # Recompute activations of the decoder blocks and the CRnn acoustic
+    # models in the backward pass, to fit larger batches in memory
+    activation_checkpointing = False
+    # Distributed data parallel training when launched with torchrun, e.g.
+    # torchrun --nproc_per_node=4 train_llama_mt_vel_crnn.py. With device = "cpu"
+    # the processes communicate over gloo
+    distributed = "WORLD_SIZE" in os.environ
+    # Seed of the samplers, shared by all ranks
+    seed = 1234
+    # Number of segments read at once from a file (one decode, resample
+    # and MIDI parse), drawn in windows of segments_window_seconds
+    segments_per_file = 1
+    segments_window_seconds = 40.
+    # Stream the training segments from the shards written by
+    # pack_maestro_shards.py instead of reading the audio files
+    shards_dir = None
+    # Number of fixed validation segments of each split, written to
+    # ./shards/<filename> and rewritten when the settings of eval_config
+    # change. Delete them to redraw after changing the data
+    eval_segments_num = 5 * batch_size
+    # Evaluate snapshots of the weights in a background process on
+    # async_validate_device, while training continues
+    async_validate = False
+    async_validate_device = "cpu"
+    # Log the phase times and throughput of the steps every
+    # log_step_frequency steps, to wandb and metrics.jsonl of the
+    # checkpoints directory
+    log_step_frequency = 100
+    # Synchronize cuda at the end of every phase, for exact phase times at
+    # a cost in throughput. Off, cuda phases are timed by their kernel
+    # launches, and the wait for the kernels falls in a later phase
+    synchronize_timing = False
 
     model_name = "AudioLlama"
     checkpoints_dir = Path("./checkpoints", filename, model_name)
     
     root = "/home/nkcemeka/Documents/Datasets/maestro-v3.0.0"
 
+    if distributed:
+        dist.init_process_group(backend="nccl" if device == "cuda" else "gloo")
+        rank = dist.get_rank()
+        world_size = dist.get_world_size()
+        if device == "cuda":
+            device = "cuda:{}".format(os.environ["LOCAL_RANK"])
+            torch.cuda.set_device(device)
+    else:
+        rank = 0
+        world_size = 1
+
+    # Only rank 0 logs to wandb and saves checkpoints
+    wandb_log = wandb_log and rank == 0
+
     if wandb_log:
         wandb.init(
             project="mini_piano_transcription",
@@ -56,6 +120,11 @@ def train(args):
         )
 
     tokenizer = Tokenizer()
+
+    if frozen_encoder:
+        fields = ["onoffvel_emb_h", "token", "mask"]
+    else:
+        fields = ["audio", "token", "mask"]
     
     # Dataset
     train_dataset = MaestroMultiTask(
@@ -64,7 +133,10 @@ def train(args):
         segment_seconds=segment_seconds,
         tokenizer=tokenizer,
         max_token_len=max_token_len,
-        task="velocity"
+        task="velocity",
+        fields=fields,
+        emb_dir=emb_dir,
+        dynamic_padding=True
     )
 
     test_dataset = MaestroMultiTask(
@@ -73,37 +145,93 @@ def train(args):
         segment_seconds=segment_seconds,
         tokenizer=tokenizer,
         max_token_len=max_token_len,
-        task="velocity"
+        task="velocity",
+        fields=fields,
+        emb_dir=emb_dir,
+        dynamic_padding=True
     )
 
-    # Sampler
-    train_sampler = Sampler(dataset_size=len(train_dataset))
-    eval_train_sampler = Sampler(dataset_size=len(train_dataset))
-    eval_test_sampler = Sampler(dataset_size=len(test_dataset))
-
-    # Dataloader
-    train_dataloader = torch.utils.data.DataLoader(
-        dataset=train_dataset, 
+    # Sampler. Batches group files of similar note density, so that they
+    # are padded to similar token lengths
+    note_densities = load_note_densities(
+        root=root, 
+        midi_filenames=train_dataset.midi_filenames, 
+        durations=train_dataset.durations, 
+        cache_path=Path("./cache", "maestro_train_note_densities.npz")
+    )
+    train_sampler = BucketBatchSampler(
+        lengths=note_densities, 
         batch_size=batch_size, 
-        sampler=train_sampler,
-        collate_fn=collate_fn,
-        num_workers=num_workers, 
-        pin_memory=True
+        rank=rank, 
+        world_size=world_size, 
+        seed=seed, 
+        durations=train_dataset.durations, 
+        segments_per_file=segments_per_file, 
+        window_seconds=segments_window_seconds
     )
 
+    # Fixed validation segments, read from memory-mapped shards
+    eval_dirs = {}
+    eval_config = {
+        "fields": fields, 
+        "seed": seed, 
+        "segments_num": eval_segments_num, 
+        "max_token_len": max_token_len
+    }
+
+    for split, dataset in [("train", train_dataset), ("test", test_dataset)]:
+        eval_dirs[split] = Path("./shards", filename, "eval_{}".format(split))
+        if rank == 0 and load_segments_config(eval_dirs[split]) != eval_config:
+            # Not written yet, or by a run with other settings
+            segments = draw_segments(dataset.durations, eval_segments_num, seed)
+            write_segments(dataset, segments, eval_dirs[split], config=eval_config)
+
+    if distributed:
+        # Wait for rank 0 to write them
+        dist.barrier()
+
+    # Dataloader
+    if shards_dir is None:
+        train_dataloader = torch.utils.data.DataLoader(
+            dataset=train_dataset, 
+            batch_sampler=train_sampler,
+            collate_fn=partial(collate_fn, pack_len=max_token_len) if packing else collate_fn,
+            num_workers=num_workers, 
+            pin_memory=True
+        )
+    else:
+        assert not frozen_encoder, "Shards hold audio"
+        train_stream = MaestroShards(
+            shards_dir=shards_dir, 
+            task="velocity", 
+            max_token_len=max_token_len, 
+            fields=fields, 
+            rank=rank, 
+            world_size=world_size, 
+            seed=seed
+        )
+        train_dataloader = torch.utils.data.DataLoader(
+            dataset=train_stream, 
+            batch_size=batch_size,
+            collate_fn=partial(collate_fn, pack_len=max_token_len) if packing else collate_fn,
+            num_workers=num_workers, 
+            pin_memory=True
+        )
+
+    # Every rank evaluates its part of the segments
     eval_train_dataloader = torch.utils.data.DataLoader(
-        dataset=train_dataset, 
+        dataset=ShardSegments(eval_dirs["train"], task="velocity", max_token_len=max_token_len, fields=fields), 
         batch_size=batch_size, 
-        sampler=eval_train_sampler,
+        sampler=range(rank, eval_segments_num, world_size),
         collate_fn=collate_fn,
         num_workers=0, 
         pin_memory=True
     )
 
     eval_test_dataloader = torch.utils.data.DataLoader(
-        dataset=test_dataset, 
+        dataset=ShardSegments(eval_dirs["test"], task="velocity", max_token_len=max_token_len, fields=fields), 
         batch_size=batch_size, 
-        sampler=eval_test_sampler,
+        sampler=range(rank, eval_segments_num, world_size),
         collate_fn=collate_fn,
         num_workers=0, 
         pin_memory=True
@@ -112,11 +240,14 @@ def train(args):
 
     # adsf
     # Load checkpoint
-    enc_model_name = "CRnn"
-    checkpoint_path = Path("Note_pedal.pth")
-    enc_model = get_model(enc_model_name)
-    enc_model.load_state_dict2(torch.load(checkpoint_path)["model"])
-    enc_model.to(device)
+    if frozen_encoder:
+        enc_model = None
+    else:
+        enc_model_name = "CRnn"
+        checkpoint_path = Path("Note_pedal.pth")
+        enc_model = get_model(enc_model_name, activation_checkpointing=activation_checkpointing)
+        enc_model.load_state_dict2(torch.load(checkpoint_path)["model"])
+        enc_model.to(device)
 
     config = EncDecConfig(
         block_size=max_token_len + 1, 
@@ -125,70 +256,208 @@ def train(args):
         n_layer=6, 
         n_head=16, 
         n_embd=1024, 
-        audio_n_embd=1536
+        audio_n_embd=1536,
+        activation_checkpointing=activation_checkpointing
     )
 
     model = EncDecPos(config)
     model.to(device)
 
-    # Optimizer
-    optimizer = optim.AdamW(list(enc_model.parameters()) + list(model.parameters()), lr=lr)
+    # Checkpoints are saved from the unwrapped models
+    raw_enc_model = enc_model
+    raw_model = model
 
-    # Create checkpoints directory
-    Path(checkpoints_dir).mkdir(parents=True, exist_ok=True)
+    if distributed:
+        device_ids = [torch.cuda.current_device()] if device.startswith("cuda") else None
+        model = DDP(model, device_ids=device_ids)
+        if enc_model is not None:
+            # Parts of CRnn, e.g. the pedal model, are not in the loss
+            enc_model = DDP(enc_model, device_ids=device_ids, find_unused_parameters=True)
+
+    # Optimizer
+    if frozen_encoder:
+        params = list(model.parameters())
+    else:
+        params = list(enc_model.parameters()) + list(model.parameters())
+    optimizer = optim.AdamW(params, lr=lr)
+    scaler = torch.amp.GradScaler(torch.device(device).type, enabled=precision == "float16")
+
+    # Checkpoints are written in the background
+    checkpoint_manager = CheckpointManager(checkpoints_dir, keep_num=keep_checkpoints_num)
+
+    if async_validate and rank == 0:
+        models = {"model": partial(EncDecPos, config)}
+        if raw_enc_model is not None:
+            models["encoder"] = partial(get_model, enc_model_name)
+        evaluator = AsyncEvaluator(
+            evaluate=partial(
+                evaluate_snapshot, 
+                eval_dirs=eval_dirs, 
+                task="velocity", 
+                fields=fields, 
+                max_token_len=max_token_len, 
+                batch_size=batch_size, 
+                precision=precision
+            ), 
+            models=models, 
+            device=async_validate_device
+        )
+    else:
+        evaluator = None
+
+    start_step = 0
+
+    if resume:
+        checkpoint = checkpoint_manager.load_latest(map_location="cpu")
+        raw_model.load_state_dict(checkpoint["model"])
+        if raw_enc_model is not None:
+            raw_enc_model.load_state_dict(checkpoint["encoder"])
+        optimizer.load_state_dict(checkpoint["optimizer"])
+        scaler.load_state_dict(checkpoint["scaler"])
+        # Every rank continues from its own random state
+        set_rank_rng_state(checkpoint["rng"], rank)
+
+        # Continue with the batch after the saved step
+        start_step = checkpoint["step"] + 1
+        if shards_dir is None:
+            train_sampler.resume(start_step)
+        else:
+            train_stream.resume(start_step)
+        print("Resume from step {}".format(checkpoint["step"]))
 
     tmp = []
 
+    # Count the padded positions of the batches
+    real_tokens_num = 0
+    padded_tokens_num = 0
+
+    # Phase times and throughput of the steps
+    timer = StepTimer(device, synchronize=synchronize_timing)
+    metrics_path = Path(checkpoints_dir, "metrics.jsonl")
+
     # Train
-    for step, data in enumerate(tqdm(train_dataloader)):
-        
-        audio = data["audio"].to(device)
-        input_token = data["token"][:, 0 : -1].to(device)
-        target_token = data["token"][:, 1 :].to(device)
-        target_mask = data["mask"][:, 1 :].to(device)
+    timer.start()
+
+    for step, data in enumerate(tqdm(train_dataloader, disable=rank != 0), start=start_step):
+
+        # Time blocked on the dataloader
+        timer.mark("data")
+
+        # Batches are collated as int32 in pinned memory, see collate_fn
+        token = data["token"].to(device, non_blocking=True).long()
+        input_token = token[:, 0 : -1]
+        target_token = token[:, 1 :]
+        target_mask = data["mask"].to(device, non_blocking=True).long()[:, 1 :]
+
+        if packing:
+            segment_ids = data["segment_id"].to(device, non_blocking=True).long()[:, 0 : -1]
+            cross_index = data["cross_index"].to(device, non_blocking=True).long()
+        else:
+            segment_ids = None
+            cross_index = None
+
+        real_tokens = (data["token"] != tokenizer.stoi("<pad>")).sum().item()
+        real_tokens_num += real_tokens
+        padded_tokens_num += data["token"].numel()
+
+        if frozen_encoder:
+            audio_emb = data["onoffvel_emb_h"].to(device, non_blocking=True).float()
+        else:
+            audio = data["audio"].to(device, non_blocking=True)
+
+        timer.mark("copy")
 
         optimizer.zero_grad()
 
-        enc_model.train()
-        model.train()
-        audio_emb = enc_model(audio)["onoffvel_emb_h"]
-        logits, loss = model(audio_emb=audio_emb, idx=input_token, target=target_token, target_mask=target_mask)
-        
-        loss.backward()
+        with autocast(device, precision):
+            model.train()
+            if not frozen_encoder:
+                enc_model.train()
+                audio_emb = enc_model(audio)["onoffvel_emb_h"]
+
+            timer.mark("encoder")
+            logits, loss = model(
+                audio_emb=audio_emb, 
+                idx=input_token, 
+                target=target_token, 
+                target_mask=target_mask, 
+                segment_ids=segment_ids, 
+                cross_index=cross_index
+            )
 
-        optimizer.step()
+        timer.mark("decoder")
+
+        scaler.scale(loss).backward()
+
+        timer.mark("backward")
+
+        scaler.step(optimizer)
+        scaler.update()
+
+        timer.mark("optimizer")
+        timer.step(
+            samples=len(data["onoffvel_emb_h"] if frozen_encoder else data["audio"]), 
+            tokens=real_tokens, 
+            padded_tokens=data["token"].numel()
+        )
+
+        if step % log_step_frequency == 0:
+            stats = timer.summary()
+            stats["step"] = step
+
+            if rank == 0:
+                with open(metrics_path, "a") as f:
+                    f.write(json.dumps(stats) + "\n")
+
+            if wandb_log:
+                wandb.log(stats)
 
         # from IPython import embed; embed(using=False); os._exit(0)
         
         if step % evaluate_step_frequency == 0:
-            print("Evaluating ...")
-            train_loss = validate(enc_model, model, eval_train_dataloader)
-            test_loss = validate(enc_model, model, eval_test_dataloader)
-            print("--- step: {} ---".format(step))
-            print("Train loss: {:.4f}".format(train_loss))
-            print("Test loss: {:.4f}".format(test_loss))
+            padding_waste = 1. - real_tokens_num / max(padded_tokens_num, 1)
+            real_tokens_num = 0
+            padded_tokens_num = 0
+            print("Padding waste: {:.3f}".format(padding_waste))
 
             if wandb_log:
-                wandb.log({
-                    "train loss": train_loss,
-                    "test loss": test_loss
+                wandb.log({"padding waste": padding_waste, "step": step})
+
+            if not async_validate:
+                print("Evaluating ...")
+                losses = {
+                    "train": validate(raw_enc_model, raw_model, eval_train_dataloader, precision=precision),
+                    "test": validate(raw_enc_model, raw_model, eval_test_dataloader, precision=precision),
+                }
+                log_losses(step, losses, wandb_log)
+            elif evaluator is not None:
+                # Logged with their step once evaluated, see below
+                evaluator.submit(step, {
+                    "model": raw_model.state_dict(),
+                    "encoder": raw_enc_model.state_dict() if raw_enc_model is not None else None,
                 })
 
-        # Save model
+        if evaluator is not None:
+            for eval_step, losses in evaluator.results():
+                log_losses(eval_step, losses, wandb_log)
+
+        # Save checkpoint
         if step % save_step_frequency == 0:
-            checkpoint_path = Path(checkpoints_dir, "step={}.pth".format(step))
-            torch.save(model.state_dict(), checkpoint_path)
-            print("Save model to {}".format(checkpoint_path))
-
-            checkpoint_path = Path(checkpoints_dir, "latest.pth")
-            torch.save(model.state_dict(), Path(checkpoint_path))
-            print("Save model to {}".format(checkpoint_path))
-
-            #
-            checkpoint_path = Path(checkpoints_dir, "step={}_encoder.pth".format(step))
-            torch.save(enc_model.state_dict(), checkpoint_path)
-            print("Save model to {}".format(checkpoint_path))
-        
+            # Gathered from all ranks, see gather_rng_states
+            rng_states = gather_rng_states()
+
+            if rank == 0:
+                checkpoint_manager.save(step, {
+                    "model": raw_model.state_dict(),
+                    "encoder": raw_enc_model.state_dict() if raw_enc_model is not None else None,
+                    "optimizer": optimizer.state_dict(),
+                    "scaler": scaler.state_dict(),
+                    "rng": rng_states,
+                })
+
+        # Evaluation and checkpoints
+        timer.mark("other")
+
         # tmp.extend(data["answer_tokens_num"])
         # from IPython import embed; embed(using=False); os._exit(0)
 
@@ -199,10 +468,19 @@ def train(args):
         #     from IPython import embed; embed(using=False); os._exit(0)
         #     hist, bin_edges = np.histogram(tmp)
 
+    checkpoint_manager.wait()
 
-def get_model(model_name):
+    if evaluator is not None:
+        for eval_step, losses in evaluator.close():
+            log_losses(eval_step, losses, wandb_log)
+
+    if distributed:
+        dist.destroy_process_group()
+
+
+def get_model(model_name, **kwargs):
     if model_name == "CRnn":
-        return CRnn()
+        return CRnn(**kwargs)
     elif model_name == "CRnn2":
         from models.crnn2 import CRnn2
         return CRnn2()
@@ -220,28 +498,6 @@ def get_model(model_name):
         raise NotImplementedError
 
 
-class Sampler:
-    def __init__(self, dataset_size):
-        self.indexes = list(range(dataset_size))
-        random.shuffle(self.indexes)
-        
-    def __iter__(self):
-
-        pointer = 0
-
-        while True:
-
-            if pointer == len(self.indexes):
-                random.shuffle(self.indexes)
-                pointer = 0
-                
-            # print(pointer)
-            index = self.indexes[pointer]
-            pointer += 1
-
-            yield index
-
-
 def bce_loss(output, target):
     return F.binary_cross_entropy(output, target)
 
@@ -252,40 +508,90 @@ def play_audio(mixture, target):
     from IPython import embed; embed(using=False); os._exit(0)
 
 
-def validate(enc_model, model, dataloader): 
+def log_losses(step, losses, wandb_log):
+
+    print("--- step: {} ---".format(step))
+    print("Train loss: {:.4f}".format(losses["train"]))
+    print("Test loss: {:.4f}".format(losses["test"]))
+
+    if wandb_log:
+        wandb.log({
+            "train loss": losses["train"],
+            "test loss": losses["test"],
+            "step": step
+        })
+
+
+def evaluate_snapshot(models, device, eval_dirs, task, fields, max_token_len, batch_size, precision):
+    """
+        Losses of a weight snapshot on the fixed validation segments, run
+        by the AsyncEvaluator process.
+
+        Args:
+            models (dict): {"model": ..., "encoder": ...} on device
+            eval_dirs (dict): {split: directory of the segments}
+
+        Returns:
+            losses (dict): {split: loss}
+    """
+    losses = {}
+
+    for split, eval_dir in eval_dirs.items():
+        dataloader = torch.utils.data.DataLoader(
+            dataset=ShardSegments(eval_dir, task=task, max_token_len=max_token_len, fields=fields), 
+            batch_size=batch_size, 
+            collate_fn=collate_fn
+        )
+        losses[split] = validate(models.get("encoder"), models["model"], dataloader, precision=precision)
+
+    return losses
+
+
+def validate(enc_model, model, dataloader, precision="float32"): 
 
-    pred_ids = []
-    target_ids = []
     device = next(model.parameters()).device
-    losses = []
 
-    for step, data in tqdm(enumerate(dataloader)):
+    # Sum of the token losses and number of supervised tokens
+    loss_sum = 0.
+    tokens_num = 0
 
-        if step == 5:
-            break
+    for step, data in tqdm(enumerate(dataloader)):
 
-        audio = data["audio"].to(device)
-        input_token = data["token"][:, 0 : -1].to(device)
-        target_token = data["token"][:, 1 :].to(device)
-        target_mask = data["mask"][:, 1 :].to(device)
+        token = data["token"].to(device, non_blocking=True).long()
+        input_token = token[:, 0 : -1]
+        target_token = token[:, 1 :]
+        target_mask = data["mask"].to(device, non_blocking=True).long()[:, 1 :]
 
-        with torch.no_grad():
-            enc_model.eval()
-            audio_emb = enc_model(audio)["onoffvel_emb_h"]
+        with torch.no_grad(), autocast(device, precision):
+            if "onoffvel_emb_h" in data:
+                audio_emb = data["onoffvel_emb_h"].to(device, non_blocking=True).float()
+            else:
+                enc_model.eval()
+                audio_emb = enc_model(data["audio"].to(device, non_blocking=True))["onoffvel_emb_h"]
 
-        with torch.no_grad():
+        with torch.no_grad(), autocast(device, precision):
             model.eval()
             logits, loss = model(audio_emb=audio_emb, idx=input_token, target=target_token, target_mask=target_mask)
 
-        losses.append(loss.item())
+        # The loss is a mean over the supervised tokens of the batch
+        n = ((target_token * target_mask) != 0).sum().item()
+        loss_sum += loss.item() * n
+        tokens_num += n
+
+    if dist.is_initialized():
+        # Ranks may hold different numbers of tokens, or none
+        totals = torch.tensor([loss_sum, tokens_num], dtype=torch.float64, device=device)
+        dist.all_reduce(totals)
+        loss_sum, tokens_num = totals.tolist()
 
-    return np.mean(losses)
+    return loss_sum / tokens_num if tokens_num > 0 else float("nan")
 
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     # parser.add_argument('--model_name', type=str, default="AudioLlama")
+    parser.add_argument('--resume', action='store_true', default=False)
     args = parser.parse_args()
 
     train(args)